@@ -1,38 +1,84 @@
 """Main application file for the Hack Or News 2 aplication that contains all the imports, routes, and view functions wrapped up in a 
 create_app function to create separate instances/application contexts for development and testing."""
 
+import math
 import os
-from flask import Flask, render_template, request, flash, redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+from datetime import datetime
+from flask import Flask, render_template, request, flash, redirect, session, g, abort, jsonify, url_for, Response, stream_with_context
+from flask_wtf.csrf import generate_csrf
+from markupsafe import Markup
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import desc
 
 # import forms here
 from forms.authenticate_forms import SignupForm, LoginForm
+from forms.story_forms import StoryToggleForm
 
 from models.init_db import db
 from models.user import User
-from models.story import Story
+from models.story import Story, InvalidCursor, decode_cursor
 from models.favorite import Favorite
 from models.bookmark import Bookmark
 from models.comment import Comment
-from models.connect import connect_db
+from models.connect import connect_db, database_engine_options, read_from_replica
+
+from services.instrumentation import instrumentation
+from services.email_verification import email_verifier
+from services.password_hashing import password_hasher, HashingQueueFull
+from services.current_user import current_user_cache, UserDeleted
+from services.http_caching import http_caching
+from services.fragment_cache import fragment_cache
+from services.hot_ranking import hot_ranking_rebaser
+from services.rate_limiting import rate_limiter
+from services.link_metadata import link_metadata_fetcher
+from services.profile_pictures import profile_picture_processor
+from services.exports import EXPORT_FORMATS, USER_ACTIVITY_QUERIES, export_rows, export_slots, story_export_query
 
 """This key will be in the Flask session and contain the logged in user's id once a user successfully logs in, will be removed once a user
 successfully logs out."""
 CURRENT_USER_ID = "logged_in_user"
 
-def create_app(db_name, testing=False):
+# Number of stories shown on each page of the story feed.
+STORIES_PER_PAGE = 20
+
+# Number of top-level comments shown on each page of a story's discussion, and how many levels of replies are shown below them.
+COMMENTS_PER_PAGE = 20
+COMMENT_REPLY_DEPTH = 3
+
+# Longest search query accepted, and the shortest partial title that gets autocomplete suggestions.
+MAX_SEARCH_LENGTH = 200
+MIN_AUTOCOMPLETE_LENGTH = 3
+
+def create_app(db_name='hackornews2', testing=False, production=None):
   """Creates an instance of the app to ensure separate production database and testing database, and that sample data inserted into 
-  the deatabase for unit/integration testing purposes doesn't interfere with the actual production database."""
+  the deatabase for unit/integration testing purposes doesn't interfere with the actual production database.
+
+  production (by default, whether the APP_ENV environment variable is 'production') boots lean for gunicorn: no debug toolbar, no
+  schema migrations when connecting (run `flask --app wsgi migrate` when deploying instead), and PASSWORD_HASH_ROUNDS can be
+  pinned from the environment to skip calibrating bcrypt in every worker (PASSWORD_HASH_WORKERS sizes each worker's bcrypt pool). See wsgi.py and gunicorn.conf.py."""
+  if production is None:
+    production = os.environ.get('APP_ENV') == 'production'
+
   app = Flask(__name__)
   app.testing = testing
+  app.config['PRODUCTION'] = production
   app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
   app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-  # Make sure redirects are followed instead of getting a confirmation page whenever a redirect is initiated.
-  app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-  # debugging toolbar used during development process.
-  toolbar = DebugToolbarExtension(app)
+  # Bearer token Prometheus has to send to scrape /metrics; without one, production doesn't serve the metrics at all.
+  app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+  if production:
+    # The schema is migrated by explicitly running `flask migrate` when deploying, not by every worker on every boot.
+    app.config['DATABASE_MIGRATE'] = False
+    if os.environ.get('PASSWORD_HASH_ROUNDS'):
+      app.config['PASSWORD_HASH_ROUNDS'] = int(os.environ['PASSWORD_HASH_ROUNDS'])
+    if os.environ.get('PASSWORD_HASH_WORKERS'):
+      app.config['PASSWORD_HASH_WORKERS'] = int(os.environ['PASSWORD_HASH_WORKERS'])
+  else:
+    # debugging toolbar used during development process. Imported here so production workers never load it.
+    from flask_debugtoolbar import DebugToolbarExtension
+    # Make sure redirects are followed instead of getting a confirmation page whenever a redirect is initiated.
+    app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
+    toolbar = DebugToolbarExtension(app)
   if app.testing:
     # Database used for testing is local, not development/production database on Supabase.
     app.config['SQLALCHEMY_DATABASE_URI'] = f'postgresql:///{db_name}'
@@ -42,11 +88,68 @@ def create_app(db_name, testing=False):
     app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
     # bypass CSRF security checking for forms when running tests
     app.config['WTF_CSRF_ENABLED'] = False
+    # Hash passwords on the calling thread with bcrypt's cheapest work factor to keep tests fast.
+    app.config['PASSWORD_HASH_ROUNDS'] = 4
+    app.config['PASSWORD_HASH_WORKERS'] = 0
   else:
     # Get DB_URI from environ variable (useful for production/testing) or if not set there, set up db locally.
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', f'postgresql:///{db_name}')
-    # Logging tool which prints to the terminal any requests sent, errors, etc.
-    app.config['SQLALCHEMY_ECHO'] = True
+    # Comma separated URLs of read replicas that read-only queries can be sent to (see models/routing.py).
+    app.config['DATABASE_REPLICA_URLS'] = [url for url in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if url]
+    # Logging every SQL statement to the terminal is a noticeable slowdown, so it's off unless SQLALCHEMY_ECHO=1 is set in the environment.
+    # Query counts and timings per request are always available from the instrumentation below instead.
+    app.config['SQLALCHEMY_ECHO'] = os.environ.get('SQLALCHEMY_ECHO') == '1'
+
+  # Connection pool settings (DB_POOL_* environment variables, see models/connect.py).
+  app.config['SQLALCHEMY_ENGINE_OPTIONS'] = database_engine_options(os.environ)
+  # How long a user's reads keep going to the primary database after they write something, so they see their own changes.
+  app.config['DATABASE_REPLICA_STICKY_SECONDS'] = int(os.environ.get('DATABASE_REPLICA_STICKY_SECONDS', 10))
+
+  # Per-request wall time, query count and database time per view, slow query logging and a Prometheus /metrics endpoint (guarded by
+  # METRICS_TOKEN). Registered first so its timer starts before any other before_request hook runs.
+  instrumentation.init_app(app)
+
+  # Signup email verification runs on a bounded thread pool configured by the EMAIL_VERIFICATION_* settings.
+  email_verifier.init_app(app)
+  # Password hashing runs on a pool of worker processes with a work factor calibrated at startup (PASSWORD_HASH_* settings).
+  password_hasher.init_app(app)
+  # Snapshots of logged in users are cached per process so g.user doesn't cost a query on every request (CURRENT_USER_CACHE_* settings).
+  current_user_cache.init_app(app)
+  # Cache headers for static files and pages (replaces the old blanket no-cache headers), and a server-side cache of anonymous fragments.
+  http_caching.init_app(app)
+  fragment_cache.init_app(app)
+  # The favorite and bookmark buttons are small forms in every listed story, which get their CSRF token from this rather than a form object.
+  app.jinja_env.globals['csrf_token'] = generate_csrf
+  # Background thread that occasionally rebases the stored hot scores (HOT_RANKING_* settings, see models/hot_ranking.py).
+  hot_ranking_rebaser.init_app(app)
+
+  # Token bucket limits on login, signup and story export attempts per IP address and username (RATE_LIMIT_* settings).
+  rate_limiter.init_app(app)
+  # Cap on the exports each process streams at once, since each holds a database connection throughout (EXPORT_* settings).
+  export_slots.init_app(app)
+  # Background thread that fetches the title, description and favicon of story links and spots dead ones (LINK_METADATA_* settings).
+  link_metadata_fetcher.init_app(app)
+  # Background thread that turns remote profile pictures into local thumbnails (PROFILE_PICTURE_* settings).
+  profile_picture_processor.init_app(app)
+
+  instrumentation.add_gauge('hackornews_current_user_cache_hit_rate', "Hit rate of the logged in user snapshot cache.",
+                            lambda: current_user_cache.stats()['hit_rate'])
+  instrumentation.add_gauge('hackornews_password_hash_queue_depth', "Passwords currently being hashed or waiting to be.",
+                            lambda: password_hasher.metrics()['queue_depth'])
+  instrumentation.add_gauge('hackornews_email_verifications_in_flight', "Signup email verifications currently running.",
+                            lambda: email_verifier.stats()['in_flight'])
+  instrumentation.add_counter('hackornews_rate_limit_allowed_total', "Login, signup and export attempts let through by the rate limits.",
+                              lambda: sum(rate_limiter.allowed.values()))
+  instrumentation.add_counter('hackornews_rate_limit_rejected_total', "Login, signup and export attempts rejected by the rate limits.",
+                              lambda: sum(rate_limiter.rejected.values()))
+  instrumentation.add_counter('hackornews_link_metadata_fetches_total', "Story links fetched by this process's metadata fetcher.",
+                              lambda: link_metadata_fetcher.fetched + link_metadata_fetcher.not_modified)
+  instrumentation.add_counter('hackornews_link_metadata_failures_total', "Story link fetches that failed in this process.",
+                              lambda: link_metadata_fetcher.failed)
+  instrumentation.add_counter('hackornews_profile_pictures_ready_total', "Profile pictures turned into thumbnails by this process.",
+                              lambda: profile_picture_processor.ready)
+  instrumentation.add_counter('hackornews_profile_pictures_invalid_total', "Profile picture URLs this process found unusable.",
+                              lambda: profile_picture_processor.invalid)
   
   # Routes and view functions for the application.
 
@@ -55,16 +158,37 @@ def create_app(db_name, testing=False):
 
   @app.before_request
   def store_logged_in_user_to_g_object():
-    if CURRENT_USER_ID in session:
-      g.user = User.query.get_or_404(session[CURRENT_USER_ID])
+    """g.user is a CurrentUser built from a cached snapshot of the logged in user (the full User is only loaded if a view needs it).
+    Static files never need the user, so they skip the lookup entirely."""
+
+    if request.endpoint == 'static':
+      current_user_cache.skip()
+      g.user = None
+    elif CURRENT_USER_ID in session:
+      g.user = current_user_cache.load(session[CURRENT_USER_ID])
+      if g.user is None:
+        # The logged in user's account no longer exists.
+        remove_logged_out_user_from_session()
     else:
       g.user = None
   
   def add_logged_in_user_to_session(logged_in_user):
     session[CURRENT_USER_ID] = logged_in_user.id
+    # The user was just loaded to check their password, so cache it to save a query on the next request.
+    current_user_cache.store(logged_in_user)
 
   def remove_logged_out_user_from_session():
     del session[CURRENT_USER_ID]
+
+  def too_many_attempts(template, form, retry_after):
+    """The response to a login or signup attempt rejected by the rate limiter, before the form is validated."""
+    flash(f"Too many attempts. Please try again in {math.ceil(retry_after)} seconds.", "danger")
+    return render_template(template, form=form), 429, {'Retry-After': str(math.ceil(retry_after))}
+
+  def too_busy(template, form):
+    """The response to a login or signup attempt turned away because too many passwords were already waiting to be hashed."""
+    flash("The server is busy. Please try again in a few seconds.", "danger")
+    return render_template(template, form=form), 503, {'Retry-After': str(math.ceil(password_hasher.queue_timeout))}
   
   @app.route('/signup', methods=['GET', 'POST'])
   def handle_signup():
@@ -78,6 +202,11 @@ def create_app(db_name, testing=False):
     
     signup_form = SignupForm()
 
+    if request.method == 'POST':
+      allowed, retry_after = rate_limiter.check_signup(request.remote_addr)
+      if not allowed:
+        return too_many_attempts('users/signup.html', signup_form, retry_after)
+
     if signup_form.validate_on_submit():
       try:
         new_user = User.create_user(
@@ -87,6 +216,9 @@ def create_app(db_name, testing=False):
           password = signup_form.password.data
         )
         db.session.commit()
+        # The database queued a remote picture for processing; no need to wait for the next interval.
+        if new_user.profile_picture_url != User.profile_picture_url.default.arg:
+          profile_picture_processor.wake()
 
         flash("Account successfully created. Please log in", "success")
         return redirect('/login')
@@ -100,6 +232,8 @@ def create_app(db_name, testing=False):
         else:
           flash("Something went wrong with the database in the signup process. Please try again later", "danger")
         print(f"ERROR: {exc}")
+      except HashingQueueFull:
+        return too_busy('users/signup.html', signup_form)
       except Exception as exc:
         # Internal issue.
         flash("There was an internal server error. Please try again later.", "danger")
@@ -119,12 +253,19 @@ def create_app(db_name, testing=False):
     
     login_form = LoginForm()
 
+    if request.method == 'POST':
+      allowed, retry_after = rate_limiter.check_login(request.remote_addr, request.form.get('username'))
+      if not allowed:
+        return too_many_attempts('users/login.html', login_form, retry_after)
+
     if login_form.validate_on_submit():
       try:
         user_logging_in = User.authenticate_user(login_form.username.data, login_form.password.data)
 
         # User.authenticate_user returns 0 if username isn't found in database, 1 if passwords don't match.
         if user_logging_in != 0 and user_logging_in != 1:
+          # Saves the user's password if authenticate_user rehashed it with a newer work factor.
+          db.session.commit()
           add_logged_in_user_to_session(user_logging_in)
           flash(f"Hello, {user_logging_in.username}!", "success")
           return redirect("/")
@@ -133,6 +274,8 @@ def create_app(db_name, testing=False):
         elif user_logging_in == 1:
           flash("The password you entered is incorrect", "danger")
         
+      except HashingQueueFull:
+        return too_busy('users/login.html', login_form)
       except Exception as exc:
         # Internal issue.
         flash("There was an internal server error. Please try again later.", "danger")
@@ -155,39 +298,226 @@ def create_app(db_name, testing=False):
   # Homepage route
   @app.route('/')
   def homepage():
+    """Shows the story feed, newest first. The optional 'after' query string parameter is the cursor of the previous page. The feed is the
+    same for every logged out visitor, so for them it's rendered once and served from the fragment cache until stories change."""
+
+    cursor = request.args.get('after')
+
+    def render_feed():
+      viewer_id = g.user.id if g.user else None
+      with read_from_replica():
+        feed = Story.get_feed(cursor=cursor, per_page=STORIES_PER_PAGE, viewer_id=viewer_id)
+      return Markup(render_template("stories/feed.html", feed=feed))
+
+    try:
+      if g.user:
+        feed_html = render_feed()
+      else:
+        # Keyed by the parsed cursor, so that different spellings of a cursor share a fragment and invalid ones never get one.
+        feed_html = fragment_cache.get_or_render(('homepage-feed', decode_cursor(cursor) if cursor else None), render_feed)
+    except InvalidCursor:
+      abort(404)
+
     if g.user:
-      return render_template("logged-in-home.html")
+      return render_template("logged-in-home.html", feed_html=feed_html)
     else:
-      return render_template("logged-out-home.html")
+      return render_template("logged-out-home.html", feed_html=feed_html)
+
+  @app.route('/hot')
+  def hot_stories():
+    """Shows the stories with the most recent engagement first. The optional 'after' query string parameter is the cursor of the previous
+    page. Like the homepage, logged out visitors share one cached rendering of each page."""
+
+    cursor = request.args.get('after')
+
+    def render_feed():
+      viewer_id = g.user.id if g.user else None
+      with read_from_replica():
+        feed = Story.get_hot_feed(cursor=cursor, per_page=STORIES_PER_PAGE, viewer_id=viewer_id)
+      return Markup(render_template("stories/feed.html", feed=feed, feed_endpoint='hot_stories'))
+
+    try:
+      if g.user:
+        feed_html = render_feed()
+      else:
+        feed_html = fragment_cache.get_or_render(('hot-feed', decode_cursor(cursor, parse_sort_value=float) if cursor else None),
+                                                 render_feed)
+    except InvalidCursor:
+      abort(404)
+
+    return render_template("stories/hot.html", feed_html=feed_html)
+
+  #######################################################################################################
+  # Stories and their comments
+
+  @app.route('/stories/<int:story_id>')
+  def show_story(story_id):
+    """Shows a story and a page of its discussion: COMMENTS_PER_PAGE top-level comments with COMMENT_REPLY_DEPTH levels of replies.
+    The optional 'after' query string parameter is the cursor of the page."""
+
+    cursor = request.args.get('after', type=int)
+    viewer_id = g.user.id if g.user else None
+    with read_from_replica():
+      story = Story.get_story(story_id, viewer_id=viewer_id)
+      if story is None:
+        abort(404)
+      comment_page = Comment.get_thread_page(story_id, cursor=cursor, per_page=COMMENTS_PER_PAGE, max_depth=COMMENT_REPLY_DEPTH)
+
+    return render_template("stories/detail.html", story=story, comment_page=comment_page, comments=comment_page.comments,
+                           max_depth=COMMENT_REPLY_DEPTH)
+
+  @app.route('/comments/<int:comment_id>')
+  def show_comment_thread(comment_id):
+    """Shows a comment and COMMENT_REPLY_DEPTH levels of replies below it, e.g. to continue a thread cut off on the story's page."""
+
+    with read_from_replica():
+      comments = Comment.get_thread(comment_id, max_depth=COMMENT_REPLY_DEPTH)
+    if not comments:
+      abort(404)
+
+    return render_template("comments/detail.html", comments=comments, max_depth=COMMENT_REPLY_DEPTH)
+
+  #######################################################################################################
+  # Favoriting and bookmarking stories
+
+  def set_story_toggle(model, story_id):
+    """Favorites/bookmarks (model) story_id for the logged in user, or undoes it, depending on the form's is_set. Requests asking for
+    JSON (the buttons' script) get {is_set, count} back, others are redirected back to the page they came from."""
+
+    if not g.user:
+      flash("You must be logged in to do that", "danger")
+      return redirect('/login')
+
+    form = StoryToggleForm()
+    if not form.validate_on_submit():
+      abort(400)
+
+    result = model.set_state(g.user.id, story_id, form.is_set.data == '1')
+    if result is None:
+      abort(404)
+    db.session.commit()
+
+    if request.accept_mimetypes.best == 'application/json':
+      return jsonify({'is_set': result.is_set, 'count': result.count})
+    return redirect(request.referrer or url_for('show_story', story_id=story_id))
+
+  @app.route('/stories/<int:story_id>/favorite', methods=['POST'])
+  def favorite_story(story_id):
+    return set_story_toggle(Favorite, story_id)
+
+  @app.route('/stories/<int:story_id>/bookmark', methods=['POST'])
+  def bookmark_story(story_id):
+    return set_story_toggle(Bookmark, story_id)
+
+  #######################################################################################################
+  # Streaming NDJSON/CSV exports (see services/exports.py)
+
+  def export_response(query, export_format, filename):
+    """Streams query as an export, unless this process is already streaming as many exports as it may, which gets a 503."""
+
+    if not export_slots.acquire():
+      return ("Too many exports are running. Please try again later.\n", 503,
+              {'Content-Type': 'text/plain', 'Retry-After': str(export_slots.retry_after)})
+
+    def generate():
+      # The query only runs once the response starts streaming, after the view has returned.
+      with read_from_replica():
+        yield from export_rows(query, export_format)
+
+    response = Response(stream_with_context(generate()), mimetype=EXPORT_FORMATS[export_format],
+                        headers={'Content-Disposition': f'attachment; filename="{filename}.{export_format}"'})
+    # Called when the server is done with the response, whether the client downloaded all of it, disconnected, or it never started.
+    response.call_on_close(export_slots.release)
+    return response
+
+  def parse_export_time(name):
+    value = request.args.get(name)
+    if not value:
+      return None
+    try:
+      return datetime.fromisoformat(value)
+    except ValueError:
+      abort(400)
+
+  @app.route('/export/stories.<any(ndjson, csv):export_format>')
+  def export_stories(export_format):
+    """Streams every story, oldest first. Optional query string parameters: 'user' (a username) to export only that user's stories, and
+    'since'/'until' (ISO dates or times, UTC) to export only the stories created in that range. Anyone can export stories, so exports are
+    rate limited per IP address."""
+
+    allowed, retry_after = rate_limiter.check_export(request.remote_addr)
+    if not allowed:
+      return (f"Too many exports. Please try again in {math.ceil(retry_after)} seconds.\n", 429,
+              {'Content-Type': 'text/plain', 'Retry-After': str(math.ceil(retry_after))})
+
+    user_id = None
+    if request.args.get('user'):
+      user_id = db.session.execute(db.select(User.id).where(User.username == request.args['user'])).scalar()
+      if user_id is None:
+        abort(404)
+    query = story_export_query(user_id=user_id, since=parse_export_time('since'), until=parse_export_time('until'))
+
+    return export_response(query, export_format, 'stories')
+
+  @app.route('/export/<any(favorites, bookmarks, comments):activity>.<any(ndjson, csv):export_format>')
+  def export_user_activity(activity, export_format):
+    """Streams the logged in user's favorites, bookmarks or comments."""
+
+    if not g.user:
+      flash("You must be logged in to do that", "danger")
+      return redirect('/login')
+
+    return export_response(USER_ACTIVITY_QUERIES[activity](g.user.id), export_format, activity)
+
+  #######################################################################################################
+  # Story search
+
+  @app.route('/search')
+  def search_stories():
+    """Shows the stories matching the 'q' query string parameter, best matches first, STORIES_PER_PAGE per page ('page' parameter)."""
+
+    terms = request.args.get('q', '').strip()[:MAX_SEARCH_LENGTH]
+    page = request.args.get('page', 1, type=int)
+    results = None
+
+    if terms:
+      viewer_id = g.user.id if g.user else None
+      with read_from_replica():
+        results = Story.search(terms, page=page, per_page=STORIES_PER_PAGE, viewer_id=viewer_id)
+
+    return render_template("stories/search.html", terms=terms, results=results, max_length=MAX_SEARCH_LENGTH)
+
+  @app.route('/search/autocomplete')
+  def autocomplete_story_titles():
+    """Returns JSON [{id, title}, ...] of story titles similar to the partially typed 'q' query string parameter."""
+
+    prefix = request.args.get('q', '').strip()[:MAX_SEARCH_LENGTH]
+    if len(prefix) < MIN_AUTOCOMPLETE_LENGTH:
+      return jsonify([])
+
+    with read_from_replica():
+      matches = Story.autocomplete_titles(prefix)
+    return jsonify([{'id': story_id, 'title': title} for story_id, title in matches])
 
   #######################################################################################################
   # 404 Page Not Found Error Handler
 
+  @app.errorhandler(UserDeleted)
+  def logged_in_user_deleted(e):
+    """The logged in user's account was deleted while a snapshot of it was still cached: log them out and show the page anonymously."""
+    session.pop(CURRENT_USER_ID, None)
+    return redirect(request.url if request.method == 'GET' else '/')
+
   @app.errorhandler(404)
   def page_not_found(e):
     flash("404 Not Found: The URL you requested was not found", "danger")
 
     return redirect("/")
 
-  #######################################################################################################
-  # Turn off all caching in Flask
-  #   (useful for dev; in production, this kind of stuff is typically handled elsewhere.)
-  #   Credit to Springboard mentor Jesse B. and Springboard support for directing me to this link:
-  #   https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-  @app.after_request
-  def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
-  
   return app
 
-app = create_app('hackornews2')
+# Importing this file doesn't build an app, so seed.py, the benchmarks and gunicorn (through wsgi.py) only pay for the app they create.
 if __name__ == '__main__':
+  app = create_app('hackornews2')
   connect_db(app)
   app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,117 @@
+"""Benchmarks loading the discussion of a story with 10,000 threaded comments.
+
+Creates (once) a story whose comments are a realistic tree: top-level comments plus replies in several rounds, each replying to an
+earlier comment picked with the same power law as seed.py, so a few comments get long threads. Then compares the old way of showing a
+discussion, lazy loading story.comments and each commenter, with the materialized path loaders: the first and a deep page of top-level
+comments with three levels of replies, and the whole thread under the busiest comment. Also counts the queries each one takes.
+
+Run from the repository root against a local Postgres: python -m benchmarks.bench_comment_threads"""
+
+import argparse
+import random
+
+from sqlalchemy import event, text
+
+from benchmarks.common import make_bench_app, time_call, DEFAULT_BENCH_DB
+from models.init_db import db
+from models.comment import Comment
+from models.story import Story
+from seed import power_law_index
+
+BENCH_STORY_TITLE = 'Comment thread benchmark'
+
+def ensure_discussion(comment_count, top_level_count, reply_rounds, seed=0):
+  """Returns the id of the benchmark story, creating it with comment_count comments if it doesn't exist yet."""
+
+  story_id = db.session.execute(text("SELECT id FROM stories WHERE title = :title"), {'title': BENCH_STORY_TITLE}).scalar()
+  if story_id is not None:
+    return story_id
+
+  rng = random.Random(seed)
+  db.session.execute(text(
+    "INSERT INTO users (username, email, password) SELECT 'thread_bench' || n, 'thread_bench' || n || '@example.com', 'not a real hash' "
+    "FROM generate_series(1, 500) AS n ON CONFLICT (username) DO NOTHING"
+  ))
+  user_ids = db.session.execute(text("SELECT id FROM users WHERE username LIKE 'thread_bench%'")).scalars().all()
+  story_id = db.session.execute(text(
+    "INSERT INTO stories (user_id, title, url, created_at, updated_at) "
+    "VALUES (:user_id, :title, 'https://example.com/threads', now() AT TIME ZONE 'utc', now() AT TIME ZONE 'utc') RETURNING id"
+  ), {'user_id': user_ids[0], 'title': BENCH_STORY_TITLE}).scalar()
+
+  insert_comment = text("INSERT INTO comments (user_id, story_id, parent_id, content, created_at, updated_at) "
+                        "VALUES (:user_id, :story_id, :parent_id, :content, now() AT TIME ZONE 'utc', now() AT TIME ZONE 'utc')")
+  def comment_rows(count, parent_ids):
+    return [{'user_id': rng.choice(user_ids), 'story_id': story_id, 'content': f"Comment {number}",
+             'parent_id': parent_ids[power_law_index(rng, len(parent_ids))] if parent_ids else None}
+            for number in range(count)]
+
+  db.session.execute(insert_comment, comment_rows(top_level_count, None))
+  replies_per_round = (comment_count - top_level_count) // reply_rounds
+  for _ in range(reply_rounds):
+    parent_ids = db.session.execute(text("SELECT id FROM comments WHERE story_id = :story_id"), {'story_id': story_id}).scalars().all()
+    rng.shuffle(parent_ids)
+    db.session.execute(insert_comment, comment_rows(replies_per_round, parent_ids))
+  db.session.commit()
+  db.session.execute(text("ANALYZE comments"))
+  return story_id
+
+def load_lazily(story_id):
+  """The old way: story.comments lazy loads every comment in no particular order, then each commenter is lazy loaded too."""
+
+  story = db.session.get(Story, story_id)
+  comments = story.comments
+  for comment in comments:
+    comment.user.username
+  return comments
+
+def count_queries(function):
+  query_count = 0
+  def count_query(*args):
+    nonlocal query_count
+    query_count += 1
+
+  db.session.expunge_all()
+  event.listen(db.engine, 'before_cursor_execute', count_query)
+  try:
+    function()
+  finally:
+    event.remove(db.engine, 'before_cursor_execute', count_query)
+  return query_count
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--db', default=DEFAULT_BENCH_DB)
+  parser.add_argument('--comments', type=int, default=10000)
+  parser.add_argument('--top-level', type=int, default=2000)
+  parser.add_argument('--reply-rounds', type=int, default=5)
+  parser.add_argument('--per-page', type=int, default=20)
+  args = parser.parse_args()
+
+  make_bench_app(args.db)
+  story_id = ensure_discussion(args.comments, args.top_level, args.reply_rounds)
+
+  depth_counts = db.session.execute(text("SELECT depth, count(*) FROM comments WHERE story_id = :story_id GROUP BY depth ORDER BY depth"),
+                                    {'story_id': story_id}).all()
+  print(f"story {story_id}: comments per depth {dict(depth_counts)}")
+
+  top_level_ids = db.session.execute(text("SELECT id FROM comments WHERE story_id = :story_id AND parent_id IS NULL ORDER BY id"),
+                                     {'story_id': story_id}).scalars().all()
+  deep_cursor = top_level_ids[min(len(top_level_ids) - 1, 50 * args.per_page)]
+  busiest_id = db.session.execute(text("SELECT id FROM comments WHERE story_id = :story_id ORDER BY descendant_count DESC LIMIT 1"),
+                                  {'story_id': story_id}).scalar()
+
+  benchmarks = [
+    ("lazy load everything (before)", lambda: load_lazily(story_id)),
+    ("first page, 3 reply levels", lambda: Comment.get_thread_page(story_id, per_page=args.per_page)),
+    ("page 51, 3 reply levels", lambda: Comment.get_thread_page(story_id, cursor=deep_cursor, per_page=args.per_page)),
+    ("busiest thread, all levels", lambda: Comment.get_thread(busiest_id)),
+  ]
+  print(f"{'':>30} {'comments':>9} {'ms':>8} {'queries':>8}")
+  for label, load in benchmarks:
+    result = load()
+    comments = result.comments if hasattr(result, 'comments') else result
+    milliseconds = time_call(lambda: (load(), db.session.expunge_all()))
+    print(f"{label:>30} {len(comments):>9} {milliseconds:>8.2f} {count_queries(load):>8}")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,90 @@
+"""Benchmarks signup email verification before and after moving it onto services.email_verification.
+
+Simulates a burst of signups handled by several gunicorn worker threads. Addresses come from a handful of domains and some are
+resubmitted (users fixing another field in the signup form), like real traffic. "Before" does an uncached MX lookup and SMTP
+conversation for every signup, as does_email_exist_check used to; "after" uses the cached, bounded EmailVerifier. DNS is replaced by a
+static resolver with a simulated lookup latency and SMTP by a local stand-in server, so no traffic leaves the machine.
+
+Run from the repository root: python -m benchmarks.bench_email_verification"""
+
+import argparse
+import random
+import smtplib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.standins import StandInSMTPServer
+from services.email_verification import EmailVerifier, SMTPBackend, StaticMXResolver
+
+DOMAINS = [f"domain{number}.com" for number in range(20)]
+
+class SlowStaticMXResolver(StaticMXResolver):
+  """Static resolver that sleeps like a real DNS lookup would."""
+
+  def __init__(self, records, delay):
+    super().__init__(records)
+    self.delay = delay
+
+  def lookup_mx(self, domain):
+    time.sleep(self.delay)
+    return super().lookup_mx(domain)
+
+def make_signup_addresses(count, repeat_fraction, seed=0):
+  rng = random.Random(seed)
+  addresses = []
+  for number in range(count):
+    if addresses and rng.random() < repeat_fraction:
+      addresses.append(rng.choice(addresses))
+    else:
+      local_part = f"missing{number}" if rng.random() < 0.1 else f"user{number}"
+      addresses.append(f"{local_part}@{rng.choice(DOMAINS)}")
+  return addresses
+
+def legacy_check(resolver, smtp_port, address):
+  """The old does_email_exist_check: MX lookup and full SMTP conversation inline, no caching and no timeout."""
+
+  mx_host = resolver.lookup_mx(address.split('@')[1])
+  server = smtplib.SMTP()
+  server.connect(mx_host, smtp_port)
+  server.helo(server.local_hostname)
+  server.mail('test@example.com')
+  code, message = server.rcpt(address)
+  server.quit()
+  return code == 250
+
+def run(check, addresses, workers):
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    list(pool.map(check, addresses))
+  return len(addresses) / (time.perf_counter() - start)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--signups', type=int, default=400)
+  parser.add_argument('--workers', type=int, default=4, help="concurrent request threads, like gunicorn workers")
+  parser.add_argument('--repeat-fraction', type=float, default=0.3)
+  parser.add_argument('--dns-delay', type=float, default=0.02)
+  parser.add_argument('--smtp-delay', type=float, default=0.05)
+  args = parser.parse_args()
+
+  addresses = make_signup_addresses(args.signups, args.repeat_fraction)
+
+  with StandInSMTPServer(delay=args.smtp_delay) as smtp_server:
+    resolver = SlowStaticMXResolver({domain: smtp_server.host for domain in DOMAINS}, args.dns_delay)
+
+    before = run(lambda address: legacy_check(resolver, smtp_server.port, address), addresses, args.workers)
+    before_connections = smtp_server.connections
+
+    verifier = EmailVerifier(resolver=resolver, smtp=SMTPBackend(port=smtp_server.port, timeout=2.0))
+    verifier.configure(max_workers=8, timeout=2.0)
+    after = run(verifier.verify, addresses, args.workers)
+    after_connections = smtp_server.connections - before_connections
+    verifier.shutdown()
+
+  print(f"signups: {args.signups}, request workers: {args.workers}")
+  print(f"before: {before:8.1f} signups/sec ({before_connections} SMTP connections)")
+  print(f"after:  {after:8.1f} signups/sec ({after_connections} SMTP connections)")
+  print(f"speedup: {after / before:.1f}x, verifier stats: {verifier.stats()}")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,121 @@
+"""Benchmarks the streaming exports (services/exports.py) on the synthetic dataset.
+
+Downloads /export/stories.ndjson and .csv through the Flask test client for ever larger date ranges, up to every story, while a thread
+samples the process's resident memory. Streaming should keep the peak flat no matter how many rows are exported. For comparison, the
+naive export, loading Story objects and dumping them as one JSON document, is run last (its memory isn't given back, and would hide the
+streaming numbers) on a smaller number of rows.
+
+Expects a database filled by seed.py, e.g.
+
+  python seed.py --db hackornews2_bench --users 100000 --stories 1000000 --favorites 2000000 --comments 500000
+
+Run from the repository root against a local Postgres (Linux, memory is read from /proc): python -m benchmarks.bench_exports"""
+
+import argparse
+import json
+import os
+import threading
+import time
+
+from sqlalchemy import text
+
+from benchmarks.common import make_bench_app, DEFAULT_BENCH_DB
+from models.init_db import db
+from models.story import Story
+from models.story_engagement import StoryEngagement
+from models.user import User
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+def resident_memory():
+  """This process's resident set size in bytes."""
+  with open('/proc/self/statm') as statm:
+    return int(statm.read().split()[1]) * PAGE_SIZE
+
+class PeakMemory:
+  """Samples the resident memory every few milliseconds while in the block; peak_growth is the largest increase over the start."""
+
+  def __init__(self, interval=0.005):
+    self.interval = interval
+    self.peak_growth = 0
+
+  def __enter__(self):
+    self._start = resident_memory()
+    self._done = threading.Event()
+    self._thread = threading.Thread(target=self._sample)
+    self._thread.start()
+    return self
+
+  def _sample(self):
+    while not self._done.wait(self.interval):
+      self.peak_growth = max(self.peak_growth, resident_memory() - self._start)
+
+  def __exit__(self, *exc_info):
+    self._done.set()
+    self._thread.join()
+    self.peak_growth = max(self.peak_growth, resident_memory() - self._start)
+
+def download(client, url):
+  """Streams url's response body like a client would, keeping only its size. Returns (rows, bytes)."""
+
+  response = client.get(url, buffered=False)
+  assert response.status_code == 200, f"{url} returned {response.status_code}"
+  size = lines = 0
+  try:
+    for chunk in response.response:
+      size += len(chunk)
+      lines += chunk.count(b'\n')
+  finally:
+    response.close()
+  return lines - url.split('?')[0].endswith('.csv'), size
+
+def naive_export(since):
+  stories = (db.session.query(Story, User.username, StoryEngagement).join(User, User.id == Story.user_id).join(Story.engagement)
+             .filter(Story.created_at >= since).order_by(Story.created_at, Story.id).all())
+  document = json.dumps([{'id': story.id, 'title': story.title, 'author': story.author, 'url': story.url, 'username': username,
+                          'created_at': story.created_at.isoformat(), 'favorite_count': engagement.favorite_count,
+                          'bookmark_count': engagement.bookmark_count, 'comment_count': engagement.comment_count}
+                         for story, username, engagement in stories])
+  db.session.expunge_all()
+  return len(stories), len(document)
+
+def created_at_of_nth_newest(row_count):
+  """The created_at of the row_count-th newest story, so that since=it exports about row_count stories."""
+  return db.session.execute(text("SELECT created_at FROM stories ORDER BY created_at DESC, id DESC OFFSET :offset LIMIT 1"),
+                            {'offset': row_count - 1}).scalar()
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--db', default=DEFAULT_BENCH_DB)
+  parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+  parser.add_argument('--naive-rows', type=int, default=100000)
+  args = parser.parse_args()
+
+  app = make_bench_app(args.db)
+  client = app.test_client()
+  story_count = db.session.query(db.func.count(Story.id)).scalar()
+  if not story_count:
+    print("The database is empty; fill it with seed.py first (see this file's docstring).")
+    return
+
+  print(f"{'export':>22} {'rows':>10} {'MB':>8} {'seconds':>8} {'rows/s':>9} {'peak MB':>8}")
+  def report(label, run):
+    start = time.perf_counter()
+    with PeakMemory() as memory:
+      rows, size = run()
+    seconds = time.perf_counter() - start
+    print(f"{label:>22} {rows:>10,} {size / 2**20:>8.1f} {seconds:>8.2f} {rows / seconds:>9.0f} {memory.peak_growth / 2**20:>8.1f}")
+
+  for row_count in args.rows:
+    since = created_at_of_nth_newest(min(row_count, story_count)).isoformat()
+    db.session.commit()
+    for export_format in ('ndjson', 'csv'):
+      url = f"/export/stories.{export_format}?since={since}"
+      report(f"streamed {export_format}", lambda: download(client, url))
+
+  since = created_at_of_nth_newest(min(args.naive_rows, story_count))
+  db.session.commit()
+  report("all() + json.dumps", lambda: naive_export(since))
+
+if __name__ == '__main__':
+  main()
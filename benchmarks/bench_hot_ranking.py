@@ -0,0 +1,127 @@
+"""Benchmarks the incrementally maintained hot ranking (models/hot_ranking.py) on the synthetic dataset.
+
+Several threads, each with its own database connection, favorite and unfavorite stories as fast as they can, one event per transaction
+like the favorite button would, so each event pays for the whole write path: the favorites row, and the trigger updating the story's
+counter and hot score in story_engagement. Stories are picked either uniformly or with the same power law as seed.py, where a few hot
+stories get most of the events and transactions queue up for their engagement rows. Reports the event throughput and latency, compares
+it with the cost of recomputing every score from scratch, checks that the incrementally updated scores still match a full recompute, and
+times the hot feed.
+
+Expects a database filled by seed.py, e.g.
+
+  python seed.py --db hackornews2_bench --users 100000 --stories 1000000 --favorites 2000000 --comments 500000
+
+Run from the repository root against a local Postgres: python -m benchmarks.bench_hot_ranking"""
+
+import argparse
+import math
+import random
+import threading
+import time
+
+from sqlalchemy import text
+
+from benchmarks.common import make_bench_app, time_call, DEFAULT_BENCH_DB
+from models.connect import database_engine_options
+from models.init_db import db
+from models.hot_ranking import DECAY_RATE, MIN_HOT_SCORE, HotRankingEpoch, recompute_hot_scores
+from models.story import Story
+from models.story_engagement import StoryEngagement
+from models.user import User
+from seed import power_law_index, shuffled_ids
+from services.metrics import LatencyStats
+
+def favorite_worker(app, user_ids, story_ids, skewed, events, seed, latency):
+  """Toggles events random favorites, committing after each one."""
+
+  rng = random.Random(seed)
+  with app.app_context():
+    for _ in range(events):
+      user_id = user_ids[rng.randrange(len(user_ids))]
+      story_id = story_ids[power_law_index(rng, len(story_ids)) if skewed else rng.randrange(len(story_ids))]
+      start = time.perf_counter()
+      removed = db.session.execute(text("DELETE FROM favorites WHERE user_id = :user_id AND story_id = :story_id"),
+                                   {'user_id': user_id, 'story_id': story_id}).rowcount
+      if not removed:
+        db.session.execute(text("INSERT INTO favorites (user_id, story_id, created_at) VALUES (:user_id, :story_id, now() AT TIME ZONE 'utc') "
+                                "ON CONFLICT DO NOTHING"), {'user_id': user_id, 'story_id': story_id})
+      db.session.commit()
+      latency.observe(time.perf_counter() - start)
+    db.session.remove()
+
+def run_concurrent_favoriting(app, threads, events_per_thread, user_ids, story_ids, skewed):
+  latency = LatencyStats(recent_samples=threads * events_per_thread)
+  workers = [threading.Thread(target=favorite_worker, args=(app, user_ids, story_ids, skewed, events_per_thread, seed, latency))
+             for seed in range(threads)]
+  start = time.perf_counter()
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  return latency, time.perf_counter() - start
+
+def hot_feed_plan():
+  compiled = (Story._listing_query(None)
+              .order_by(StoryEngagement.hot_score.desc(), StoryEngagement.story_id.desc()).limit(21).statement.compile(db.engine))
+  return [line for (line,) in db.session.connection().exec_driver_sql(f"EXPLAIN {compiled}", compiled.params)]
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--db', default=DEFAULT_BENCH_DB)
+  parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 8, 16])
+  parser.add_argument('--events', type=int, default=500, help="favorite toggles per thread")
+  args = parser.parse_args()
+
+  # One connection per thread.
+  app = make_bench_app(args.db, SQLALCHEMY_ENGINE_OPTIONS=database_engine_options({'DB_POOL_SIZE': max(args.threads) + 1}))
+  story_count = db.session.query(db.func.count(Story.id)).scalar()
+  if not story_count:
+    print("The database is empty; fill it with seed.py first (see this file's docstring).")
+    return
+
+  rng = random.Random(0)
+  user_ids = shuffled_ids(rng, User)
+  story_ids = shuffled_ids(rng, Story)
+  db.session.commit()
+
+  start = time.perf_counter()
+  recompute_hot_scores()
+  db.session.commit()
+  recompute_seconds = time.perf_counter() - start
+  print(f"{story_count:,} stories; recomputing every hot score from scratch takes {recompute_seconds:.2f}s")
+
+  print(f"\n{'stories':>8} {'threads':>7} {'events/s':>9} {'p50 ms':>7} {'p99 ms':>7} {'max ms':>7}")
+  for skewed in (False, True):
+    for threads in args.threads:
+      latency, seconds = run_concurrent_favoriting(app, threads, args.events, user_ids, story_ids, skewed)
+      summary = latency.summary()
+      print(f"{'skewed' if skewed else 'uniform':>8} {threads:>7} {summary['count'] / seconds:>9.0f} {summary['p50'] * 1000:>7.2f} "
+            f"{summary['p99'] * 1000:>7.2f} {summary['max'] * 1000:>7.2f}")
+
+  # The incrementally maintained scores of the most engaged stories should equal a full recompute, once both are relative to the same
+  # epoch. Adding and then subtracting a favorite's weight from the score of a story nobody has engaged with for months leaves rounding
+  # error far larger than that score, so scores differing by less than MIN_HOT_SCORE, which rebasing treats as 0, count as equal.
+  top_story_ids = story_ids[:100]
+  old_epoch = db.session.execute(db.select(HotRankingEpoch.epoch)).scalar_one()
+  incremental = dict(db.session.query(StoryEngagement.story_id, StoryEngagement.hot_score)
+                     .filter(StoryEngagement.story_id.in_(top_story_ids)))
+  recompute_hot_scores()
+  new_epoch = db.session.execute(db.select(HotRankingEpoch.epoch)).scalar_one()
+  recomputed = dict(db.session.query(StoryEngagement.story_id, StoryEngagement.hot_score)
+                    .filter(StoryEngagement.story_id.in_(top_story_ids)))
+  db.session.commit()
+  decay = math.exp(-DECAY_RATE * (new_epoch - old_epoch).total_seconds())
+  mismatches = [story_id for story_id in top_story_ids
+                if not math.isclose(incremental[story_id] * decay, recomputed[story_id], rel_tol=1e-6, abs_tol=MIN_HOT_SCORE)]
+  print(f"\nincremental scores matching a full recompute: {len(top_story_ids) - len(mismatches)}/{len(top_story_ids)}")
+
+  first_page_ms = time_call(lambda: Story.get_hot_feed(per_page=20))
+  cursor = Story.get_hot_feed(per_page=20).next_cursor
+  next_page_ms = time_call(lambda: Story.get_hot_feed(cursor=cursor, per_page=20))
+  db.session.expunge_all()
+  print(f"hot feed: page 1 {first_page_ms:.2f} ms, page 2 {next_page_ms:.2f} ms")
+  print('\n'.join(hot_feed_plan()))
+  assert not mismatches, f"hot scores drifted from a full recompute for stories {mismatches}"
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,136 @@
+"""Benchmarks the story link metadata fetcher (services/link_metadata.py) against local stand-in web servers, one per simulated site,
+so no traffic leaves the machine.
+
+Stories linking to pages on the stand-ins are posted (a few of the links are dead), which queues their URLs in link_metadata, and the
+fetcher drains the queue:
+
+1. with one fetch thread and with --workers threads, reporting throughput. Each site only ever serves one of the fetcher's requests at a
+   time, at least --domain-delay seconds apart, however many threads there are;
+2. with two fetchers claiming batches at the same time, like the fetcher threads of two worker processes: each site still sees one
+   request at a time, since politeness is enforced by the database when URLs are claimed;
+3. once every URL has expired again, when the stand-ins answer the fetcher's conditional requests with 304 Not Modified.
+
+Each stand-in site listens on its own loopback address (127.0.0.1, 127.0.0.2...), so that it's a separate domain.
+
+It uses its own database, which must exist (createdb hackornews2_links_bench), since adding link_metadata to a database that already
+has stories queues every one of their URLs.
+
+Run from the repository root against a local Postgres: python -m benchmarks.bench_link_metadata"""
+
+import argparse
+import threading
+import time
+from datetime import timedelta
+
+from benchmarks.common import make_bench_app
+from benchmarks.standins import StandInHTTPServer
+from models.init_db import db
+from models.hot_ranking import utc_now
+from models.link_metadata import LinkMetadata
+from models.story import Story
+from models.user import User
+from services.link_metadata import link_metadata_fetcher
+from services.password_hashing import password_hasher
+
+BENCH_USERNAME = 'link_metadata_bench'
+
+def post_stories(servers, pages, dead_every):
+  """Replaces all stories with pages stories linking to each server, every dead_every-th of them to a missing page."""
+
+  db.session.execute(db.text("TRUNCATE stories, link_metadata, link_domains CASCADE"))
+  user = User.query.filter_by(username=BENCH_USERNAME).first()
+  if user is None:
+    user = User.create_user(username=BENCH_USERNAME, email=f'{BENCH_USERNAME}@example.com', profile_picture_url=None,
+                            password='correct horse')
+    db.session.flush()
+  stories = []
+  for server in servers:
+    for page in range(pages):
+      path = f'/missing/{page}' if dead_every and page % dead_every == dead_every - 1 else f'/articles/{page}'
+      stories.append({'user_id': user.id, 'title': f'Story {page} on {server.url}', 'url': f'{server.url}{path}'})
+  db.session.execute(db.insert(Story), stories)
+  db.session.commit()
+
+def expire_all(keep_validators):
+  values = {'expires_at': utc_now() - timedelta(seconds=1)}
+  if not keep_validators:
+    values.update(etag=None, last_modified=None)
+  db.session.execute(db.update(LinkMetadata).values(**values))
+  db.session.commit()
+
+def nothing_due():
+  with link_metadata_fetcher.app.app_context():
+    return not db.session.scalar(db.select(db.func.count()).where(LinkMetadata.expires_at <= utc_now()))
+
+def drain(servers, workers, domain_delay, batch_size, fetchers):
+  """Runs fetchers threads, each claiming and fetching batches like a worker process's fetcher thread, until nothing is due. Returns
+  (URLs fetched, seconds)."""
+
+  link_metadata_fetcher.configure(batch_size=batch_size, workers=workers, domain_delay=domain_delay, timeout=5.0,
+                                  allow_private_addresses=True)
+  for server in servers:
+    server.reset_counts()
+  claimed = []
+
+  def fetch_until_nothing_due():
+    while True:
+      count = link_metadata_fetcher.run_once()
+      claimed.append(count)
+      if not count:
+        if nothing_due():
+          return
+        # URLs are due but their domains were just asked, or are being fetched by the other fetcher.
+        time.sleep(domain_delay / 10)
+
+  start = time.perf_counter()
+  threads = [threading.Thread(target=fetch_until_nothing_due) for _ in range(fetchers)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return sum(claimed), time.perf_counter() - start
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--db', default='hackornews2_links_bench')
+  parser.add_argument('--sites', type=int, default=20)
+  parser.add_argument('--pages', type=int, default=10, help="stories per site")
+  parser.add_argument('--dead-every', type=int, default=10, help="every nth page of a site is missing")
+  parser.add_argument('--latency', type=float, default=0.05, help="seconds each stand-in takes to respond")
+  parser.add_argument('--domain-delay', type=float, default=0.1)
+  parser.add_argument('--workers', type=int, default=16)
+  parser.add_argument('--batch-size', type=int, default=200)
+  args = parser.parse_args()
+
+  make_bench_app(args.db)
+  password_hasher.configure(rounds=4, workers=0)
+  servers = [StandInHTTPServer(delay=args.latency, name=f'Site {number}', host=f'127.0.0.{number + 1}') for number in range(args.sites)]
+  for server in servers:
+    server.__enter__()
+
+  try:
+    post_stories(servers, args.pages, args.dead_every)
+    print(f"{args.sites} sites x {args.pages} pages, {args.latency * 1000:.0f} ms latency, {args.domain_delay:.2f} s between requests "
+          f"to a site:")
+    print(f"{'':>24} {'URLs':>5} {'seconds':>8} {'URLs/s':>7} {'fetched':>7} {'304s':>5} {'failed':>6} {'max/site':>9} {'min gap':>8}")
+    for label, workers, fetchers, keep_validators in [("1 thread", 1, 1, False), (f"{args.workers} threads", args.workers, 1, False),
+                                                      (f"2 fetchers x {args.workers}", args.workers, 2, False),
+                                                      (f"revalidate, {args.workers} threads", args.workers, 1, True)]:
+      expire_all(keep_validators)
+      urls, seconds = drain(servers, workers, args.domain_delay, args.batch_size, fetchers)
+      stats = link_metadata_fetcher.stats()
+      min_gap = min(server.min_gap for server in servers if server.min_gap is not None)
+      max_concurrent = max(server.max_concurrent for server in servers)
+      print(f"{label:>24} {urls:>5} {seconds:>8.2f} {urls / seconds:>7.1f} {stats['fetched']:>7} {stats['not_modified']:>5} "
+            f"{stats['failed']:>6} {max_concurrent:>9} {min_gap:>8.3f}")
+      assert max_concurrent == 1, f"a site served {max_concurrent} requests at once"
+
+    counts = db.session.execute(db.select(db.func.count(LinkMetadata.title), db.func.count().filter(LinkMetadata.is_dead),
+                                          db.func.count())).one()
+    print(f"\n{counts[0]} of {counts[2]} links have a title, {counts[1]} are dead")
+  finally:
+    for server in servers:
+      server.__exit__()
+
+if __name__ == '__main__':
+  main()
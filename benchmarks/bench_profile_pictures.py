@@ -0,0 +1,137 @@
+"""Benchmarks the profile picture pipeline (services/profile_pictures.py) against a local stand-in web server serving a mix of
+good and bad pictures, so no traffic leaves the machine.
+
+Users are signed up with picture URLs on the stand-in, most of them sharing one popular photo, which queues each distinct URL once. The
+processor then drains the queue. Reports:
+
+1. how many requests the stand-in served for the distinct URLs, and the time taken;
+2. what became of each URL: a thumbnail for real images (identical images sharing one file), rejection for anything that isn't a usable
+   image (wrong content type, too many bytes or pixels, undecodable, missing);
+3. what a browser downloads for a user's picture before (the source URL) and after (the thumbnail), and the thumbnail's cache headers.
+
+tests/test_profile_pictures.py checks that each URL is fetched once, identical images share a file, and every kind of unusable image is
+rejected.
+
+Thumbnails are written under static/images/profile-pictures. Run from the repository root against a local Postgres:
+python -m benchmarks.bench_profile_pictures"""
+
+import argparse
+import io
+import re
+import time
+
+from PIL import Image
+
+from benchmarks.common import make_bench_app, DEFAULT_BENCH_DB
+from benchmarks.standins import StandInHTTPServer
+from models.init_db import db
+from models.profile_picture import ProfilePicture, PICTURE_READY, PICTURE_INVALID
+from models.user import User
+from services.password_hashing import password_hasher
+from services.profile_pictures import profile_picture_processor, make_thumbnail
+
+BENCH_USERNAME_PREFIX = 'picture_bench_'
+PASSWORD = 'correct horse'
+
+def encode(image, format, **options):
+  output = io.BytesIO()
+  image.save(output, format, **options)
+  return output.getvalue()
+
+def make_files():
+  """{path: (content type, body, expected status)} for the stand-in."""
+
+  size = (2400, 1600)
+  photo = Image.merge('RGB', [Image.effect_mandelbrot(size, (-2.2, -1.2, 1.0, 1.2), 64),
+                              Image.linear_gradient('L').resize(size), Image.effect_noise(size, 32)])
+  photo_jpeg = encode(photo, 'JPEG', quality=92)
+  logo = Image.new('RGBA', (800, 800), (0, 0, 0, 0))
+  logo.paste((200, 30, 30, 255), (200, 200, 600, 600))
+  return {
+    '/photo.jpg': ('image/jpeg', photo_jpeg, PICTURE_READY),
+    '/same-photo-elsewhere.jpg': ('image/jpeg', photo_jpeg, PICTURE_READY),
+    '/logo.png': ('image/png', encode(logo, 'PNG'), PICTURE_READY),
+    '/avatar.gif': ('image/gif', encode(photo.resize((300, 200)).convert('P'), 'GIF'), PICTURE_READY),
+    '/huge.jpg': ('image/jpeg', photo_jpeg + bytes(6 * 2**20), PICTURE_INVALID),
+    '/bomb.png': ('image/png', encode(Image.new('1', (10000, 10000)), 'PNG'), PICTURE_INVALID),
+    '/drawing.svg': ('image/svg+xml', b'<svg xmlns="http://www.w3.org/2000/svg"><script>alert(1)</script></svg>', PICTURE_INVALID),
+    '/not-really.png': ('image/png', b'<html>this is not a picture</html>', PICTURE_INVALID),
+    '/page.jpg': ('text/html', b'<html>a page</html>', PICTURE_INVALID),
+    '/missing.png': (None, b'', PICTURE_INVALID),
+  }
+
+def sign_up_users(server, files, users, popular_share):
+  """Replaces the benchmark users with users picture URLs: popular_share of them /photo.jpg, the rest spread over every path."""
+
+  db.session.execute(db.delete(User).where(User.username.startswith(BENCH_USERNAME_PREFIX)))
+  db.session.execute(db.delete(ProfilePicture).where(ProfilePicture.source_url.startswith('http://127.0.0.1:')))
+  paths = list(files)
+  password = password_hasher.hash(PASSWORD)
+  rows = []
+  for number in range(users):
+    path = '/photo.jpg' if number < users * popular_share else paths[number % len(paths)]
+    rows.append({'username': f'{BENCH_USERNAME_PREFIX}{number}', 'email': f'{BENCH_USERNAME_PREFIX}{number}@example.com',
+                 'profile_picture_url': f'{server.url}{path}', 'password': password})
+  db.session.execute(db.insert(User), rows)
+  db.session.commit()
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--db', default=DEFAULT_BENCH_DB)
+  parser.add_argument('--users', type=int, default=500)
+  parser.add_argument('--popular-share', type=float, default=0.8, help="share of users with the same popular picture")
+  parser.add_argument('--latency', type=float, default=0.05, help="seconds the stand-in takes to respond")
+  parser.add_argument('--workers', type=int, default=4)
+  args = parser.parse_args()
+
+  app = make_bench_app(args.db)
+  password_hasher.configure(rounds=4, workers=0)
+  files = make_files()
+  served_files = {path: (content_type, body) for path, (content_type, body, expected) in files.items() if content_type}
+
+  with StandInHTTPServer(delay=args.latency, files=served_files) as server:
+    sign_up_users(server, files, args.users, args.popular_share)
+    queued = db.session.scalar(db.select(db.func.count()).where(ProfilePicture.source_url.startswith(server.url)))
+    print(f"{args.users} users signed up with {len(files)} distinct picture URLs, {queued} queued for processing")
+
+    profile_picture_processor.configure(workers=args.workers, allow_private_addresses=True)
+    start = time.perf_counter()
+    while profile_picture_processor.run_once():
+      pass
+    seconds = time.perf_counter() - start
+    print(f"processed in {seconds:.2f} s with {args.workers} threads, {server.requests} requests to the stand-in "
+          f"({profile_picture_processor.stats()})")
+
+    print(f"\n{'URL':>26} {'status':>8} {'expected':>8} {'source KB':>10} {'thumb KB':>9} {'size':>8}  error")
+    pictures = {picture.source_url[len(server.url):]: picture for picture in
+                ProfilePicture.query.filter(ProfilePicture.source_url.startswith(server.url))}
+    thumbnail_sizes = {}
+    for path, (content_type, body, expected) in files.items():
+      picture = pictures[path]
+      thumbnail_kb = ''
+      if picture.status == PICTURE_READY:
+        with open(f'{profile_picture_processor.folder}/{picture.thumbnail_hash}.webp', 'rb') as thumbnail:
+          thumbnail_sizes[path] = len(thumbnail.read())
+        thumbnail_kb = f'{thumbnail_sizes[path] / 1024:.1f}'
+      size = f'{picture.width}x{picture.height}' if picture.width else ''
+      print(f"{path:>26} {picture.status:>8} {expected:>8} {len(body) / 1024:>10.1f} {thumbnail_kb:>9} {size:>8}  {picture.error or ''}")
+    print(f"{len({picture.thumbnail_hash for picture in pictures.values() if picture.thumbnail_hash})} thumbnail files")
+
+    photo = files['/photo.jpg'][1]
+    start = time.perf_counter()
+    make_thumbnail(photo, 256, 40 * 1000 * 1000)
+    print(f"\nthumbnail of the {len(photo) / 2**20:.1f} MB 2400x1600 photo made in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    client = app.test_client()
+    client.post('/login', data={'username': f'{BENCH_USERNAME_PREFIX}0', 'password': PASSWORD})
+    src = re.search(r'<img src="([^"]+)" alt="[^"]*profile picture', client.get('/').get_data(as_text=True)).group(1)
+    response = client.get(src)
+    print(f"a user with the popular photo: browsers used to download {len(photo) / 1024:.0f} KB from a third party, now "
+          f"{len(response.data) / 1024:.1f} KB from {src.split('?')[0]} with Cache-Control: {response.headers['Cache-Control']}")
+    assert response.status_code == 200 and 'immutable' in response.headers['Cache-Control']
+
+    db.session.execute(db.delete(User).where(User.username.startswith(BENCH_USERNAME_PREFIX)))
+    db.session.commit()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,105 @@
+"""Benchmarks the login and signup rate limiter (services/rate_limiting.py).
+
+1. A credential stuffing burst: many wrong-password login attempts against one account, from one IP address and then spread over many,
+   posted through the Flask test client with a realistic bcrypt work factor. Compares the time spent (nearly all of it bcrypt) and the
+   number of password checks with the limiter off and on.
+2. The cost of a check on each backend, which is what every normal login pays.
+3. Several threads standing in for gunicorn workers hammer the same bucket. With per-process memory backends each worker allows the full
+   burst; the shared database backend must allow exactly one burst in total.
+
+Run from the repository root against a local Postgres: python -m benchmarks.bench_rate_limiting"""
+
+import argparse
+import threading
+import time
+
+from benchmarks.common import make_bench_app, DEFAULT_BENCH_DB
+from models.init_db import db
+from models.user import User
+from services.password_hashing import password_hasher
+from services.rate_limiting import rate_limiter, MemoryRateLimitBackend, DatabaseRateLimitBackend
+
+BENCH_USERNAME = 'rate_limit_bench'
+LIMITS = {'login_ip': (20, 60), 'login_username': (10, 300), 'signup_ip': (10, 3600)}
+
+def ensure_user():
+  if User.query.filter_by(username=BENCH_USERNAME).first() is None:
+    User.create_user(username=BENCH_USERNAME, email=f'{BENCH_USERNAME}@example.com', profile_picture_url=None, password='correct horse')
+  db.session.commit()
+
+def login_burst(client, attempts, ip_addresses):
+  """Posts attempts wrong passwords for the bench user, cycling through ip_addresses. Returns (seconds, status code counts)."""
+
+  statuses = {}
+  start = time.perf_counter()
+  for attempt in range(attempts):
+    response = client.post('/login', data={'username': BENCH_USERNAME, 'password': f'guess {attempt}'},
+                           environ_base={'REMOTE_ADDR': ip_addresses[attempt % len(ip_addresses)]})
+    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+  return time.perf_counter() - start, statuses
+
+def time_checks(backend, checks):
+  """Average microseconds per check, each of a different key like the logins of many users."""
+
+  rate_limiter.configure(backend=backend, limits=LIMITS)
+  start = time.perf_counter()
+  for number in range(checks):
+    rate_limiter.check('login_ip', f'10.1.{number // 256 % 256}.{number % 256}')
+  return (time.perf_counter() - start) / checks * 1e6
+
+def concurrent_workers(app, make_backend, workers, attempts_per_worker):
+  """Each thread is a worker process with its own RateLimiter (and backend from make_backend). Returns the total attempts allowed."""
+
+  allowed = []
+  def worker():
+    with app.app_context():
+      limiter = type(rate_limiter)()
+      limiter.configure(backend=make_backend(), limits=LIMITS)
+      allowed.append(sum(limiter.check('login_ip', '203.0.113.7')[0] for _ in range(attempts_per_worker)))
+  threads = [threading.Thread(target=worker) for _ in range(workers)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return sum(allowed)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--db', default=DEFAULT_BENCH_DB)
+  parser.add_argument('--attempts', type=int, default=200)
+  parser.add_argument('--rounds', type=int, default=12, help="bcrypt work factor")
+  parser.add_argument('--workers', type=int, default=8)
+  args = parser.parse_args()
+
+  app = make_bench_app(args.db)
+  password_hasher.configure(rounds=args.rounds, workers=0)
+  ensure_user()
+  client = app.test_client()
+
+  print(f"{args.attempts} wrong-password logins for one account, bcrypt work factor {args.rounds}:")
+  print(f"{'':>30} {'seconds':>8} {'hashes':>7} {'statuses':>20}")
+  for label, enabled, ip_addresses in [("no limiter, one IP", False, ['198.51.100.1']),
+                                       ("limiter, one IP", True, ['198.51.100.1']),
+                                       ("limiter, 100 IPs", True, [f'198.51.100.{n}' for n in range(100)])]:
+    rate_limiter.configure(backend=MemoryRateLimitBackend(), enabled=enabled, limits=LIMITS)
+    password_hasher.configure(rounds=args.rounds, workers=0)
+    seconds, statuses = login_burst(client, args.attempts, ip_addresses)
+    hashes = password_hasher.metrics()['verify_latency']['count']
+    print(f"{label:>30} {seconds:>8.2f} {hashes:>7} {str(statuses):>20}")
+
+  database_backend = DatabaseRateLimitBackend()
+  database_backend.clear()
+  print(f"\ncost of one check: memory backend {time_checks(MemoryRateLimitBackend(), 20000):.1f} us, "
+        f"database backend {time_checks(database_backend, 2000):.1f} us")
+
+  capacity = LIMITS['login_ip'][0]
+  database_backend.clear()
+  separate = concurrent_workers(app, MemoryRateLimitBackend, args.workers, capacity * 2)
+  shared = concurrent_workers(app, DatabaseRateLimitBackend, args.workers, capacity * 2)
+  print(f"\n{args.workers} workers x {capacity * 2} attempts from one IP (burst of {capacity}): "
+        f"per-process memory backends allowed {separate}, shared database backend allowed {shared}")
+  database_backend.clear()
+  assert shared == capacity, f"the shared backend allowed {shared} attempts instead of {capacity}"
+
+if __name__ == '__main__':
+  main()
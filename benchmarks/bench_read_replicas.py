@@ -0,0 +1,155 @@
+"""Checks read replica routing (models/routing.py) against two local databases, one standing in for the primary and the other for a
+replica. Real replication isn't needed: each database is told apart by current_database() and by a marker story that only it has.
+Checks, and reports how each read was answered:
+
+1. with no replica configured, reads inside read_from_replica() go to the primary;
+2. writes go to the primary, and the replica's connections refuse to write (default_transaction_read_only);
+3. plain SELECTs inside read_from_replica() go to the replica, while SELECT ... FOR UPDATE and reads outside the block stay on the primary;
+4. once a session has written, even before it commits, its reads stay on the primary (read-your-writes);
+5. after a request commits a write, the user's later requests read from the primary for DATABASE_REPLICA_STICKY_SECONDS, then go back to
+   the replica;
+6. the time a read routed to the replica takes compared with the same read on the primary.
+
+The replica database must exist (createdb hackornews2_replica_bench); its tables are created here. Run from the repository root against a
+local Postgres: python -m benchmarks.bench_read_replicas"""
+
+import argparse
+import time
+
+from flask import session as flask_session
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import InternalError
+
+from app import create_app
+from benchmarks.common import make_bench_app, time_call, DEFAULT_BENCH_DB
+from models.connect import connect_db, read_from_replica
+from models.init_db import db
+from models.routing import READ_PRIMARY_UNTIL
+from models.story import Story
+from models.user import User
+from services.password_hashing import password_hasher
+
+BENCH_USERNAME = 'replica_bench'
+MARKER_TITLE = 'Read replica benchmark marker'
+
+def answered_by():
+  """The database that answers a plain SELECT made through db.session right now, and the marker story it has."""
+
+  database = db.session.scalar(db.select(db.func.current_database()))
+  marker = db.session.scalar(db.select(Story.url).where(Story.title == MARKER_TITLE))
+  return database, marker
+
+def add_marker(bind, database):
+  """Adds the benchmark user and a marker story whose URL names database, replacing any left by an earlier run."""
+
+  with bind.begin() as connection:
+    connection.execute(db.delete(Story).where(Story.title.startswith(MARKER_TITLE)))
+    connection.execute(db.delete(User).where(User.username == BENCH_USERNAME))
+    user_id = connection.execute(db.insert(User).values(username=BENCH_USERNAME, email=f'{BENCH_USERNAME}@example.com',
+                                                        profile_picture_url=None, password=password_hasher.hash('correct horse'))
+                                 .returning(User.id)).scalar_one()
+    connection.execute(db.insert(Story).values(user_id=user_id, title=MARKER_TITLE, url=f'https://example.com/{database}'))
+
+def check(label, actual, expected):
+  print(f"{label:>58}  {actual[0] if isinstance(actual, tuple) else actual}")
+  assert actual == expected, f"{label}: got {actual}, expected {expected}"
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--db', default=DEFAULT_BENCH_DB, help="database standing in for the primary")
+  parser.add_argument('--replica-db', default='hackornews2_replica_bench', help="database standing in for the replica")
+  parser.add_argument('--sticky-seconds', type=float, default=1.0)
+  args = parser.parse_args()
+
+  primary = (args.db, f'https://example.com/{args.db}')
+  replica = (args.replica_db, f'https://example.com/{args.replica_db}')
+  password_hasher.configure(rounds=4, workers=0)
+
+  # The replica gets the same schema, created over a normal connection since the app only opens read-only ones to it.
+  replica_setup = create_engine(f'postgresql:///{args.replica_db}')
+  db.metadata.create_all(replica_setup)
+  add_marker(replica_setup, args.replica_db)
+
+  print("without a replica:")
+  app = create_app(args.db, testing=True)
+  connect_db(app)
+  with app.app_context():
+    add_marker(db.engine, args.db)
+    with read_from_replica():
+      check("read inside read_from_replica()", answered_by(), primary)
+
+  print("\nwith a replica:")
+  app = make_bench_app(args.db, DATABASE_REPLICA_URLS=[f'postgresql:///{args.replica_db}'],
+                       DATABASE_REPLICA_STICKY_SECONDS=args.sticky_seconds)
+  check("replica connections default to read only", db.session.scalar(text("SHOW default_transaction_read_only"),
+                                                                       bind_arguments={'bind': db.engines['replica_0']}), 'on')
+  try:
+    with db.engines['replica_0'].connect() as connection:
+      connection.execute(db.update(Story).where(Story.title == MARKER_TITLE).values(title=MARKER_TITLE))
+    refused = 'no'
+  except InternalError as exc:
+    refused = type(exc.orig).__name__
+  check("a write sent to a replica connection is refused", refused, 'ReadOnlySqlTransaction')
+
+  db.session.remove()
+  check("read outside read_from_replica()", answered_by(), primary)
+  with read_from_replica():
+    check("read inside read_from_replica()", answered_by(), replica)
+    locked = db.session.scalar(db.select(db.func.current_database()).select_from(Story).where(Story.title == MARKER_TITLE)
+                               .with_for_update())
+    check("SELECT ... FOR UPDATE inside read_from_replica()", locked, args.db)
+  db.session.rollback()
+
+  with read_from_replica():
+    marker = db.session.scalars(db.select(Story).where(Story.title == MARKER_TITLE)).one()
+    check("story loaded inside read_from_replica()", marker.url, replica[1])
+  db.session.remove()
+  with read_from_replica():
+    user = db.session.scalars(db.select(User).where(User.username == BENCH_USERNAME)).one()
+    db.session.add(Story(user_id=user.id, title=f'{MARKER_TITLE} (written)', url='https://example.com/written'))
+    db.session.flush()
+    check("read after a flushed write, same session", answered_by(), primary)
+    written = db.session.scalar(db.select(db.func.count()).where(Story.title == f'{MARKER_TITLE} (written)'))
+    check("the write is visible to the session's next read", written, 1)
+  db.session.rollback()
+  db.session.remove()
+
+  with app.test_request_context('/'):
+    with read_from_replica():
+      check("read in a request before the user wrote anything", answered_by(), replica)
+    db.session.execute(db.update(Story).where(Story.title == MARKER_TITLE).values(title=MARKER_TITLE))
+    db.session.commit()
+    check("primary pinned in the user's session after a commit", flask_session.get(READ_PRIMARY_UNTIL, 0) > time.time(), True)
+    cookie = dict(flask_session)
+  db.session.remove()
+
+  with app.test_request_context('/'):
+    flask_session.update(cookie)
+    with read_from_replica():
+      check("the user's next request", answered_by(), primary)
+  db.session.remove()
+  time.sleep(args.sticky_seconds)
+  with app.test_request_context('/'):
+    flask_session.update(cookie)
+    with read_from_replica():
+      check(f"the user's request {args.sticky_seconds:g} s later", answered_by(), replica)
+  db.session.remove()
+
+  def primary_read():
+    db.session.scalar(db.select(User.id).where(User.username == BENCH_USERNAME))
+    db.session.remove()
+
+  def replica_read():
+    with read_from_replica():
+      primary_read()
+
+  print(f"\nlooking up a user by name, median of 50: primary {time_call(primary_read, 50):.3f} ms, "
+        f"routed to the replica {time_call(replica_read, 50):.3f} ms")
+
+  with db.engine.begin() as connection:
+    connection.execute(db.delete(Story).where(Story.title.startswith(MARKER_TITLE)))
+    connection.execute(db.delete(User).where(User.username == BENCH_USERNAME))
+  replica_setup.dispose()
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,117 @@
+"""Benchmarks process startup: how long it takes to import and build the app, and how long gunicorn takes to get its workers serving
+and how much memory they use, in development mode and in the lean production mode (APP_ENV=production, see create_app in app.py).
+
+1. Cold boot: fresh interpreters import wsgi.py (which builds and connects the app) and report the time taken, their resident memory
+   and the number of modules loaded.
+2. gunicorn: starts gunicorn with gunicorn.conf.py and --workers N, with and without preloading the app, and measures the time until
+   every worker has booted and a request succeeds, plus the workers' memory. PSS (proportional set size) splits pages shared with the
+   master between the processes sharing them, so it shows how much a worker really costs.
+
+Run from the repository root against a local Postgres (Linux, memory is read from /proc): python -m benchmarks.bench_startup"""
+
+import argparse
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+from benchmarks.common import DEFAULT_BENCH_DB
+
+BOOT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import wsgi
+seconds = time.perf_counter() - start
+rss = int([line for line in open('/proc/self/status') if line.startswith('VmRSS')][0].split()[1]) * 1024
+print(json.dumps({'seconds': seconds, 'rss': rss, 'modules': len(sys.modules),
+                  'dns': 'dns.resolver' in sys.modules, 'toolbar': 'flask_debugtoolbar' in sys.modules}))
+"""
+
+# Extends the repository's gunicorn.conf.py with a hook that reports each worker as soon as it's ready to serve (gunicorn has no command
+# line flag to turn preloading back off, so it's set here too).
+GUNICORN_CONFIG = """
+import runpy, sys
+globals().update({{name: value for name, value in runpy.run_path({conf!r}).items() if not name.startswith("__")}})
+preload_app = {preload}
+
+def post_worker_init(worker):
+  print(f"WORKER READY {{worker.pid}}", file=sys.stderr, flush=True)
+"""
+
+def mode_environ(db_name, production):
+  environ = dict(os.environ, DATABASE_URL=f'postgresql:///{db_name}', PYTHONPATH=os.getcwd())
+  environ.pop('APP_ENV', None)
+  if production:
+    environ.update(APP_ENV='production', PASSWORD_HASH_ROUNDS='12')
+  return environ
+
+def cold_boot(environ):
+  output = subprocess.run([sys.executable, '-c', BOOT_SCRIPT], env=environ, capture_output=True, text=True, check=True).stdout
+  return json.loads(output.strip().splitlines()[-1])
+
+def memory_of(pid, field):
+  """A field of /proc/<pid>/smaps_rollup ('Rss' or 'Pss') in bytes."""
+  with open(f'/proc/{pid}/smaps_rollup') as rollup:
+    for line in rollup:
+      if line.startswith(f'{field}:'):
+        return int(line.split()[1]) * 1024
+  return 0
+
+def gunicorn_boot(environ, workers, preload, port):
+  """Starts gunicorn, waits until all workers are ready and the app answers, and returns (seconds, worker RSS, worker PSS) before
+  stopping it."""
+
+  with tempfile.NamedTemporaryFile('w', suffix='.py', delete=False) as config:
+    config.write(GUNICORN_CONFIG.format(conf=os.path.abspath('gunicorn.conf.py'), preload=preload))
+  command = [sys.executable, '-m', 'gunicorn', '-c', config.name, '--workers', str(workers), '--bind', f'127.0.0.1:{port}']
+  start = time.perf_counter()
+  server = subprocess.Popen(command, env=environ, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True)
+  try:
+    worker_pids = []
+    for line in server.stderr:
+      if line.startswith('WORKER READY'):
+        worker_pids.append(int(line.split()[-1]))
+        if len(worker_pids) == workers:
+          break
+    if len(worker_pids) < workers:
+      raise RuntimeError(f"gunicorn exited before its workers were ready (exit code {server.wait()})")
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/') as response:
+      response.read()
+    seconds = time.perf_counter() - start
+    return seconds, [memory_of(pid, 'Rss') for pid in worker_pids], [memory_of(pid, 'Pss') for pid in worker_pids]
+  finally:
+    server.send_signal(signal.SIGTERM)
+    server.wait()
+    os.unlink(config.name)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--db', default=DEFAULT_BENCH_DB)
+  parser.add_argument('--boots', type=int, default=5)
+  parser.add_argument('--workers', type=int, default=4)
+  parser.add_argument('--port', type=int, default=8765)
+  args = parser.parse_args()
+
+  print(f"cold boot (import wsgi), median of {args.boots}:")
+  print(f"{'mode':>12} {'seconds':>8} {'RSS MB':>7} {'modules':>8} {'dnspython':>10} {'toolbar':>8}")
+  for production in (False, True):
+    boots = [cold_boot(mode_environ(args.db, production)) for _ in range(args.boots)]
+    print(f"{'production' if production else 'development':>12} {statistics.median(boot['seconds'] for boot in boots):>8.3f} "
+          f"{statistics.median(boot['rss'] for boot in boots) / 2**20:>7.1f} {boots[0]['modules']:>8} {str(boots[0]['dns']):>10} "
+          f"{str(boots[0]['toolbar']):>8}")
+
+  print(f"\ngunicorn with {args.workers} workers:")
+  print(f"{'mode':>12} {'preload':>8} {'seconds':>8} {'RSS MB/worker':>14} {'PSS MB/worker':>14}")
+  for production in (False, True):
+    for preload in (False, True):
+      seconds, rss, pss = gunicorn_boot(mode_environ(args.db, production), args.workers, preload, args.port)
+      print(f"{'production' if production else 'development':>12} {str(preload):>8} {seconds:>8.2f} "
+            f"{statistics.mean(rss) / 2**20:>14.1f} {statistics.mean(pss) / 2**20:>14.1f}")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,71 @@
+"""Benchmarks the story feed's keyset pagination against OFFSET pagination from page 1 to page 10,000.
+
+Fills the benchmark database with enough stories for the deepest page (inserted server-side with generate_series, so this is quick),
+then times fetching each page both ways. Keyset pagination should stay flat while OFFSET grows with the page number. That a page takes
+one query whatever its size is checked by tests/test_story_feed.py.
+
+Run from the repository root against a local Postgres: python -m benchmarks.bench_story_feed"""
+
+import argparse
+
+from sqlalchemy import text
+
+from benchmarks.common import make_bench_app, time_call, DEFAULT_BENCH_DB
+from models.init_db import db
+from models.story import Story, encode_cursor
+
+PAGES = [1, 10, 100, 1000, 10000]
+
+def ensure_stories(count):
+  """Makes sure the benchmark database has at least count stories, all posted by a single benchmark user."""
+
+  existing = db.session.query(db.func.count(Story.id)).scalar()
+  if existing >= count:
+    return
+
+  db.session.execute(text(
+    "INSERT INTO users (username, email, password) VALUES ('feed_bench', 'feed_bench@example.com', 'not a real hash') "
+    "ON CONFLICT (username) DO NOTHING"
+  ))
+  user_id = db.session.execute(text("SELECT id FROM users WHERE username = 'feed_bench'")).scalar()
+  db.session.execute(text(
+    "INSERT INTO stories (user_id, title, author, url, created_at, updated_at) "
+    "SELECT :user_id, 'Story ' || n, 'Author ' || (n % 1000), 'https://example.com/' || n, "
+    "       now() - n * interval '1 second', now() - n * interval '1 second' "
+    "FROM generate_series(1, :missing) AS n"
+  ), {'user_id': user_id, 'missing': count - existing})
+  db.session.commit()
+  db.session.execute(text("ANALYZE stories"))
+
+def cursor_before_page(page, per_page):
+  """The cursor that get_feed would have returned for the page before page (found once with OFFSET, outside the timed section)."""
+
+  if page == 1:
+    return None
+  last_story = (Story.query.order_by(Story.created_at.desc(), Story.id.desc())
+                .offset((page - 1) * per_page - 1).limit(1).one())
+  return encode_cursor(last_story.created_at, last_story.id)
+
+def offset_page(page, per_page):
+  return (Story.query.order_by(Story.created_at.desc(), Story.id.desc())
+          .offset((page - 1) * per_page).limit(per_page).all())
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--db', default=DEFAULT_BENCH_DB)
+  parser.add_argument('--per-page', type=int, default=20)
+  args = parser.parse_args()
+
+  make_bench_app(args.db)
+  ensure_stories(max(PAGES) * args.per_page + 1)
+
+  print(f"{'page':>6} {'keyset ms':>10} {'offset ms':>10}")
+  for page in PAGES:
+    cursor = cursor_before_page(page, args.per_page)
+    keyset_ms = time_call(lambda: Story.get_feed(cursor=cursor, per_page=args.per_page))
+    offset_ms = time_call(lambda: offset_page(page, args.per_page))
+    db.session.expunge_all()
+    print(f"{page:>6} {keyset_ms:>10.2f} {offset_ms:>10.2f}")
+
+if __name__ == '__main__':
+  main()
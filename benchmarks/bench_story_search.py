@@ -0,0 +1,71 @@
+"""Benchmarks story search and title autocomplete on the synthetic dataset, against the LIKE '%term%' scans they replace.
+
+Expects a database filled by seed.py, e.g. for the 1M story dataset:
+
+  python seed.py --db hackornews2_bench --users 100000 --stories 1000000
+
+then times the first and a deep page of ranked full-text searches (common words, rare words, phrases, OR and exclusions), typo tolerant
+autocomplete, and the equivalent LIKE '%term%' queries that have to scan titles until they find enough matches. Also prints whether each search plan uses the GIN indexes.
+
+Run from the repository root against a local Postgres: python -m benchmarks.bench_story_search"""
+
+import argparse
+
+from benchmarks.common import make_bench_app, time_call, DEFAULT_BENCH_DB
+from models.init_db import db
+from models.story import Story
+
+# seed.py's title vocabulary spreads these real words from very common ("python") to rare ("compiler").
+SEARCHES = ['python', 'climate', 'database', 'compiler', '"open source"', 'privacy or hardware', 'science -space', 'nonexistentword']
+AUTOCOMPLETE_PREFIXES = ['pyth', 'clima', 'databse', 'compiller']
+
+def substring_search(term, per_page):
+  """The naive search: stories whose title contains term, newest first. Written with position() rather than ILIKE '%term%' so that
+  the trigram index can't speed it up, which is how LIKE searches performed before the search indexes existed."""
+  return (Story.query.filter(db.func.position(db.func.lower(term).op('IN')(db.func.lower(Story.title))) > 0)
+          .order_by(Story.created_at.desc(), Story.id.desc()).limit(per_page).all())
+
+def uses_index(query, index_name):
+  compiled = query.statement.compile(db.engine)
+  plan = db.session.connection().exec_driver_sql(f"EXPLAIN {compiled}", compiled.params).scalars()
+  return any(index_name in line for line in plan)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--db', default=DEFAULT_BENCH_DB)
+  parser.add_argument('--per-page', type=int, default=20)
+  parser.add_argument('--repeat', type=int, default=5)
+  args = parser.parse_args()
+
+  make_bench_app(args.db)
+  story_count = db.session.query(db.func.count(Story.id)).scalar()
+  print(f"{story_count:,} stories")
+  if not story_count:
+    print("The database is empty; fill it with seed.py first (see this file's docstring).")
+    return
+
+  print(f"{'search':>22} {'matches':>9} {'page 1 ms':>10} {'page 10 ms':>11} {'like ms':>9} {'gin':>4}")
+  for terms in SEARCHES:
+    search_query = db.func.websearch_to_tsquery('english', terms)
+    matching = Story.query.filter(Story.search_vector.op('@@')(search_query))
+    match_count = matching.count()
+    first_page_ms = time_call(lambda: Story.search(terms, page=1, per_page=args.per_page), args.repeat)
+    deep_page_ms = time_call(lambda: Story.search(terms, page=10, per_page=args.per_page), args.repeat)
+    # The LIKE baseline only understands a single substring, so it gets the first word.
+    like_term = terms.strip('"').split()[0]
+    like_ms = time_call(lambda: substring_search(like_term, args.per_page), args.repeat)
+    db.session.expunge_all()
+    print(f"{terms:>22} {match_count:>9} {first_page_ms:>10.2f} {deep_page_ms:>11.2f} {like_ms:>9.2f} "
+          f"{'yes' if uses_index(matching, 'ix_stories_search_vector') else 'no':>4}")
+
+  print(f"\n{'autocomplete':>22} {'top suggestion':>40} {'ms':>8} {'like ms':>9}")
+  for prefix in AUTOCOMPLETE_PREFIXES:
+    suggestions = Story.autocomplete_titles(prefix)
+    autocomplete_ms = time_call(lambda: Story.autocomplete_titles(prefix), args.repeat)
+    like_ms = time_call(lambda: substring_search(prefix, 10), args.repeat)
+    db.session.expunge_all()
+    top_suggestion = suggestions[0].title[:40] if suggestions else '-'
+    print(f"{prefix:>22} {top_suggestion:>40} {autocomplete_ms:>8.2f} {like_ms:>9.2f}")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,165 @@
+"""Benchmarks the favorite/bookmark toggle API (models/story_toggle.py).
+
+First the throughput and latency of many threads, each with its own database connection, favoriting and unfavoriting the same story as
+fast as they can (tests/test_story_toggles.py checks that none of those toggles fail or get lost, and that double clicks are harmless).
+
+Then compares the API with the obvious ORM way, user.favorite_stories.append(story), which loads the user's whole collection first, for
+one toggle by a user with many favorites and for bookmarking 50 stories and clearing all bookmarks at once.
+
+Run from the repository root against a local Postgres: python -m benchmarks.bench_story_toggles"""
+
+import argparse
+import random
+import threading
+import time
+
+from sqlalchemy import text
+
+from benchmarks.common import make_bench_app, time_call, DEFAULT_BENCH_DB
+from models.connect import database_engine_options
+from models.init_db import db
+from models.favorite import Favorite
+from models.bookmark import Bookmark
+from models.story import Story
+from models.user import User
+from services.metrics import LatencyStats
+
+BENCH_STORY_TITLE = 'Toggle benchmark'
+
+def ensure_fixtures(user_count, story_count):
+  """Returns (user ids, story ids) of the benchmark's users and stories, creating them if they don't exist yet."""
+
+  db.session.execute(text(
+    "INSERT INTO users (username, email, password) SELECT 'toggle_bench' || n, 'toggle_bench' || n || '@example.com', 'not a real hash' "
+    "FROM generate_series(1, :count) AS n ON CONFLICT (username) DO NOTHING"
+  ), {'count': user_count})
+  user_ids = db.session.execute(text("SELECT id FROM users WHERE username LIKE 'toggle_bench%' ORDER BY id")).scalars().all()
+
+  story_ids = db.session.execute(text("SELECT id FROM stories WHERE title = :title ORDER BY id"), {'title': BENCH_STORY_TITLE}).scalars().all()
+  if len(story_ids) < story_count:
+    db.session.execute(text(
+      "INSERT INTO stories (user_id, title, url, created_at, updated_at) "
+      "SELECT :user_id, :title, 'https://example.com/toggles/' || n, now() AT TIME ZONE 'utc', now() AT TIME ZONE 'utc' "
+      "FROM generate_series(1, :count) AS n"
+    ), {'user_id': user_ids[0], 'title': BENCH_STORY_TITLE, 'count': story_count - len(story_ids)})
+    story_ids = db.session.execute(text("SELECT id FROM stories WHERE title = :title ORDER BY id"), {'title': BENCH_STORY_TITLE}).scalars().all()
+  db.session.commit()
+  return user_ids[:user_count], story_ids[:story_count]
+
+def reset_toggles(user_ids):
+  for model in (Favorite, Bookmark):
+    db.session.execute(db.delete(model).where(model.user_id.in_(user_ids)))
+  db.session.commit()
+
+def toggle_worker(app, user_ids, story_id, events, seed, errors, latency):
+  """Sets random favorites of story_id by user_ids, committing after each one."""
+
+  rng = random.Random(seed)
+  with app.app_context():
+    for _ in range(events):
+      user_id = rng.choice(user_ids)
+      is_set = rng.random() < 0.5
+      start = time.perf_counter()
+      try:
+        Favorite.set_state(user_id, story_id, is_set)
+        db.session.commit()
+      except Exception as exc:
+        db.session.rollback()
+        errors.append(exc)
+        continue
+      latency.observe(time.perf_counter() - start)
+    db.session.remove()
+
+def run_concurrent_toggles(app, threads, events_per_thread, user_ids, story_id):
+  """Each thread gets its own users, except that every thread also toggles for user_ids[0], like one user double-clicking in several
+  tabs."""
+
+  shared_user_id = user_ids[0]
+  own_users = [user_ids[1:][index::threads] for index in range(threads)]
+  errors = []
+  latency = LatencyStats(recent_samples=threads * events_per_thread)
+  workers = [threading.Thread(target=toggle_worker, args=(app, own_users[index] + [shared_user_id], story_id, events_per_thread, index,
+                                                          errors, latency))
+             for index in range(threads)]
+  start = time.perf_counter()
+  for worker in workers:
+    worker.start()
+  for worker in workers:
+    worker.join()
+  return errors, latency, time.perf_counter() - start
+
+def toggle_with_orm(user_id, story_id):
+  """The obvious way: load the user and their favorites collection, then append or remove the story."""
+
+  user = db.session.get(User, user_id)
+  story = db.session.get(Story, story_id)
+  if story in user.favorite_stories:
+    user.favorite_stories.remove(story)
+  else:
+    user.favorite_stories.append(story)
+  db.session.commit()
+
+def toggle_with_api(user_id, story_id):
+  is_set = db.session.get(Favorite, (user_id, story_id)) is None
+  Favorite.set_state(user_id, story_id, is_set)
+  db.session.commit()
+
+def bookmark_with_orm(user_id, story_ids):
+  user = db.session.get(User, user_id)
+  for story_id in story_ids:
+    user.bookmarked_stories.append(db.session.get(Story, story_id))
+  db.session.commit()
+
+def clear_bookmarks_with_orm(user_id):
+  user = db.session.get(User, user_id)
+  user.bookmarked_stories.clear()
+  db.session.commit()
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--db', default=DEFAULT_BENCH_DB)
+  parser.add_argument('--threads', type=int, nargs='+', default=[1, 4, 16, 32])
+  parser.add_argument('--events', type=int, default=300, help="toggles per thread")
+  parser.add_argument('--users', type=int, default=2000)
+  parser.add_argument('--collection-size', type=int, default=1000, help="favorites of the user in the single toggle comparison")
+  parser.add_argument('--bulk', type=int, default=50, help="stories bookmarked at once")
+  args = parser.parse_args()
+
+  # One connection per thread.
+  app = make_bench_app(args.db, SQLALCHEMY_ENGINE_OPTIONS=database_engine_options({'DB_POOL_SIZE': max(args.threads) + 1}))
+  user_ids, story_ids = ensure_fixtures(args.users, args.collection_size + 1)
+  story_id = story_ids[0]
+
+  print(f"{'threads':>7} {'toggles/s':>10} {'p50 ms':>7} {'p99 ms':>7} {'errors':>7}")
+  for threads in args.threads:
+    reset_toggles(user_ids)
+    errors, latency, seconds = run_concurrent_toggles(app, threads, args.events, user_ids, story_id)
+    summary = latency.summary()
+    print(f"{threads:>7} {summary['count'] / seconds:>10.0f} {summary['p50'] * 1000:>7.2f} {summary['p99'] * 1000:>7.2f} {len(errors):>7}")
+
+  # A user with a large collection of favorites toggling one more story.
+  collector_id = user_ids[1]
+  reset_toggles(user_ids)
+  Favorite.set_many(collector_id, story_ids[1:], True)
+  db.session.commit()
+  orm_ms = time_call(lambda: (toggle_with_orm(collector_id, story_id), db.session.expunge_all()), repeat=10)
+  api_ms = time_call(lambda: (toggle_with_api(collector_id, story_id), db.session.expunge_all()), repeat=10)
+  print(f"\ntoggle by a user with {args.collection_size} favorites: ORM collection {orm_ms:.2f} ms, set_state {api_ms:.2f} ms")
+
+  bulk_ids = story_ids[1:args.bulk + 1]
+  def bulk_orm():
+    bookmark_with_orm(collector_id, bulk_ids)
+    clear_bookmarks_with_orm(collector_id)
+    db.session.expunge_all()
+  def bulk_api():
+    Bookmark.set_many(collector_id, bulk_ids, True)
+    db.session.commit()
+    Bookmark.clear_all(collector_id)
+    db.session.commit()
+  print(f"bookmark {args.bulk} stories then clear all: ORM collection {time_call(bulk_orm):.2f} ms, "
+        f"set_many + clear_all {time_call(bulk_api):.2f} ms")
+
+  reset_toggles(user_ids)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,30 @@
+"""Helpers shared by the benchmarks that need the app and a local Postgres database. Benchmarks use their own database (hackornews2_bench
+by default) created through create_app(db_name, testing=True), so they never touch the development or production data."""
+
+import statistics
+import time
+
+from app import create_app
+from models.connect import connect_db
+
+DEFAULT_BENCH_DB = 'hackornews2_bench'
+
+def make_bench_app(db_name=DEFAULT_BENCH_DB, **config):
+  """Returns a testing app connected to db_name with all tables created, and pushes an app context for it. Keyword arguments override
+  the app's config before it connects, e.g. SQLALCHEMY_ENGINE_OPTIONS."""
+
+  app = create_app(db_name, testing=True)
+  app.config.update(config)
+  connect_db(app)
+  app.app_context().push()
+  return app
+
+def time_call(function, repeat=5):
+  """Calls function repeat times and returns the median wall time in milliseconds."""
+
+  timings = []
+  for _ in range(repeat):
+    start = time.perf_counter()
+    function()
+    timings.append((time.perf_counter() - start) * 1000)
+  return statistics.median(timings)
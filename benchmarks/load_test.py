@@ -0,0 +1,437 @@
+"""Load tests the whole app: seeds a database at one of several scales, drives the real routes with a mix of simulated visitors, and reports
+latency percentiles, throughput and SQL queries per request for each kind of request, compared against a saved baseline.
+
+Simulated visitors (virtual users) mostly browse anonymously: the feed and its next pages, the hot feed, stories with their comments,
+comment threads, search and title autocomplete. Now and then one signs up, or logs in (as a seeded user) and then browses logged in,
+toggles favorites and eventually logs out. Each keeps its own cookies.
+
+Two modes:
+
+  client  every request goes through the Flask test client in this process, one at a time: the app's own cost per request, without
+          HTTP or concurrency.
+  http    the app runs under gunicorn (production settings, gunicorn.conf.py) and --processes load generator processes, each running
+          --vus virtual users on threads, send requests over HTTP as fast as they get answers, for --duration seconds after --warmup.
+
+Queries per request come from the Server-Timing header (SERVER_TIMING_HEADER, see services/instrumentation.py). Login rate limits are
+turned off, since every virtual user comes from the same address, and signups verify their email against a local stand-in SMTP server.
+Passwords are hashed with a realistic work factor (--hash-rounds), so logins and signups are dominated by bcrypt.
+
+Baselines: --save-baseline writes the results to benchmarks/baselines/<mode>-<scale>.json; later runs compare against it and exit with
+status 1 if any kind of request got more than --tolerance slower at the 95th percentile, runs more queries, fails more often, or if
+overall throughput dropped by more than --tolerance. A run with other settings (--requests, --duration...) than the baseline's isn't
+compared at all. Latency baselines only mean something on the machine that saved them; query counts hold everywhere.
+
+Each scale uses its own database, hackornews2_load_<scale>, which must exist (createdb hackornews2_load_small) and is seeded with seed.py
+the first time (or again with --reseed). Run from the repository root against a local Postgres:
+
+  python -m benchmarks.load_test --scale small --mode both"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import signal
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from argparse import Namespace
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+BASELINE_FOLDER = os.path.join(os.path.dirname(__file__), 'baselines')
+
+# seed.py arguments for each scale. large is about the size of the other benchmarks' database.
+SCALES = {
+  'small': dict(users=1000, stories=10000, favorites=20000, bookmarks=5000, comments=10000, replies=15000),
+  'medium': dict(users=10000, stories=100000, favorites=200000, bookmarks=50000, comments=100000, replies=150000),
+  'large': dict(users=100000, stories=1000000, favorites=2000000, bookmarks=500000, comments=1000000, replies=1500000),
+}
+SEEDED_PASSWORD = 'password'
+
+# What virtual users do, with relative weights, while logged out and while logged in.
+ANONYMOUS_ACTIONS = {'feed': 30, 'feed_next': 10, 'hot': 10, 'story': 25, 'comments': 5, 'search': 8, 'autocomplete': 8, 'login': 3,
+                     'signup': 1}
+LOGGED_IN_ACTIONS = {'feed': 25, 'feed_next': 10, 'hot': 10, 'story': 25, 'comments': 5, 'search': 8, 'autocomplete': 8, 'favorite': 6,
+                     'logout': 3}
+# Tells this run's signups apart from those of earlier runs against the same database.
+RUN_ID = f'{int(time.time()):x}'
+# Status codes that count as success for each action.
+EXPECTED_STATUSES = {'login': (302,), 'signup': (302,), 'logout': (302,)}
+
+NEXT_PAGE_REGEX = re.compile(r'[?&]after=([^"&]+)"')
+QUERY_COUNT_REGEX = re.compile(r'desc="(\d+) queries"')
+
+class TestClientTransport:
+  """Sends a virtual user's requests through the Flask test client, with the virtual user's own cookies."""
+
+  def __init__(self, app):
+    self.client = app.test_client()
+
+  def send(self, method, path, data=None, headers=None):
+    response = self.client.open(path, method=method, data=data, headers=headers)
+    return response.status_code, response.get_data(as_text=True), response.headers.get('Server-Timing', '')
+
+class HTTPTransport:
+  """Sends a virtual user's requests over HTTP, on a requests session that keeps its cookies and connection."""
+
+  def __init__(self, base_url):
+    import requests
+
+    self.base_url = base_url
+    self.session = requests.Session()
+
+  def send(self, method, path, data=None, headers=None):
+    response = self.session.request(method, self.base_url + path, data=data, headers=headers, allow_redirects=False, timeout=60)
+    return response.status_code, response.text, response.headers.get('Server-Timing', '')
+
+class VirtualUser:
+  """One simulated visitor. ids describes the seeded data: {'stories', 'comments', 'users'}, the highest id of each, and 'words', title
+  words most common first. Every step sends one request and returns a sample: (action, status, ok, seconds, queries or None)."""
+
+  def __init__(self, transport, rng, ids, name):
+    self.transport = transport
+    self.rng = rng
+    self.ids = ids
+    self.name = name
+    self.logged_in = False
+    self.next_page = None
+    self.signups = 0
+
+  def popular(self, count):
+    # Log-uniform ranks, like seed.py's popularity: a few ids get most of the traffic.
+    return min(count, int(count ** self.rng.random()))
+
+  def step(self):
+    actions = LOGGED_IN_ACTIONS if self.logged_in else ANONYMOUS_ACTIONS
+    action = self.rng.choices(list(actions), weights=list(actions.values()))[0]
+    if action == 'feed_next' and self.next_page is None:
+      action = 'feed'
+    method, path, data, headers = getattr(self, f'request_{action}')()
+
+    start = time.perf_counter()
+    status, body, server_timing = self.transport.send(method, path, data, headers)
+    seconds = time.perf_counter() - start
+
+    ok = status in EXPECTED_STATUSES.get(action, (200,))
+    if action in ('feed', 'feed_next'):
+      match = NEXT_PAGE_REGEX.search(body)
+      self.next_page = match.group(1) if match else None
+    elif ok and action in ('login', 'logout'):
+      self.logged_in = action == 'login'
+    query_count = QUERY_COUNT_REGEX.search(server_timing)
+    return action, status, ok, seconds, int(query_count.group(1)) if query_count else None
+
+  def request_feed(self):
+    return 'GET', '/', None, None
+
+  def request_feed_next(self):
+    return 'GET', f'/?after={self.next_page}', None, None
+
+  def request_hot(self):
+    return 'GET', '/hot', None, None
+
+  def request_story(self):
+    return 'GET', f"/stories/{self.popular(self.ids['stories'])}", None, None
+
+  def request_comments(self):
+    return 'GET', f"/comments/{self.rng.randint(1, self.ids['comments'])}", None, None
+
+  def request_search(self):
+    return 'GET', f"/search?q={self.ids['words'][self.popular(len(self.ids['words'])) - 1]}", None, None
+
+  def request_autocomplete(self):
+    word = self.ids['words'][self.popular(len(self.ids['words'])) - 1]
+    return 'GET', f"/search/autocomplete?q={word[:self.rng.randint(3, max(3, len(word)))]}", None, None
+
+  def request_login(self):
+    return 'POST', '/login', {'username': f"user{self.rng.randint(1, self.ids['users'])}", 'password': SEEDED_PASSWORD}, None
+
+  def request_signup(self):
+    self.signups += 1
+    # The run's start time keeps names unique across runs, which replay the same random choices.
+    username = f'load_{self.name}_{self.signups}_{RUN_ID}'
+    return 'POST', '/signup', {'username': username, 'email': f'{username}@example.com', 'password': SEEDED_PASSWORD}, None
+
+  def request_favorite(self):
+    data = {'is_set': self.rng.choice('01')}
+    return 'POST', f"/stories/{self.popular(self.ids['stories'])}/favorite", data, {'Accept': 'application/json'}
+
+  def request_logout(self):
+    return 'GET', '/logout', None, None
+
+def use_stand_in_email(smtp_port):
+  """Points signup email verification at a local stand-in SMTP server for every example.com address."""
+
+  from services.email_verification import email_verifier, SMTPBackend, StaticMXResolver
+
+  email_verifier.resolver = StaticMXResolver({'example.com': '127.0.0.1'})
+  email_verifier.smtp = SMTPBackend(port=smtp_port, timeout=2.0)
+
+def server_app():
+  """gunicorn app factory for http mode (benchmarks.load_test:server_app()): the production app from wsgi.py, with email verification
+  pointed at the stand-in SMTP server, CSRF checks and rate limits off, query counts in a Server-Timing header, and without the
+  background link metadata fetcher and profile picture processor, which would only add noise."""
+
+  import wsgi
+  from services.link_metadata import link_metadata_fetcher
+  from services.profile_pictures import profile_picture_processor
+  from services.rate_limiting import rate_limiter
+
+  wsgi.app.config.update(WTF_CSRF_ENABLED=False, SERVER_TIMING_HEADER=True)
+  rate_limiter.configure(backend=rate_limiter.backend, enabled=False)
+  # Each worker starts their threads from a before_request hook on its first request, so without the hook they never start.
+  for background in (link_metadata_fetcher, profile_picture_processor):
+    if background._start_in_this_process in wsgi.app.before_request_funcs.get(None, []):
+      wsgi.app.before_request_funcs[None].remove(background._start_in_this_process)
+  use_stand_in_email(int(os.environ['LOAD_TEST_SMTP_PORT']))
+  return wsgi.app
+
+def ensure_seeded(scale, hash_rounds, reseed):
+  """Seeds the current app's database with the scale's data unless it already has at least that much. Returns the ids for VirtualUser."""
+
+  import seed
+  from models.init_db import db
+  from models.user import User
+  from models.story import Story
+  from models.comment import Comment
+  from services.password_hashing import password_hasher
+
+  sizes = SCALES[scale]
+  counts = {model: db.session.query(db.func.max(model.id)).scalar() or 0 for model in (User, Story, Comment)}
+  if reseed or counts[User] < sizes['users'] or counts[Story] < sizes['stories']:
+    print(f"seeding the {scale} scale: {sizes}")
+    # drop_all waits for every open transaction on the tables, including this session's.
+    db.session.rollback()
+    password_hasher.configure(rounds=hash_rounds, workers=0)
+    seed.seed(Namespace(days=365, batch_size=50000, password=SEEDED_PASSWORD, hash_each_user=False, keep_existing=False, seed=0,
+                        **sizes))
+    counts = {model: db.session.query(db.func.max(model.id)).scalar() or 0 for model in (User, Story, Comment)}
+
+  # Signed up users are named differently, so the highest seeded user number is the scale's.
+  return {'users': sizes['users'], 'stories': counts[Story], 'comments': counts[Comment], 'words': seed.TITLE_VOCABULARY[:2000]}
+
+def run_client(app, ids, requests, vus, seed):
+  """Sends requests requests through the test client, taking turns between vus virtual users. Returns (samples, seconds)."""
+
+  rng = random.Random(seed)
+  users = [VirtualUser(TestClientTransport(app), random.Random(rng.random()), ids, f'c{number}') for number in range(vus)]
+  samples = []
+  start = time.perf_counter()
+  for number in range(requests):
+    samples.append(users[number % vus].step())
+  return samples, time.perf_counter() - start
+
+def run_load_process(base_url, ids, vus, warmup, duration, seed):
+  """One load generator process: vus virtual users on threads, each sending requests back to back until the deadline. Samples from the
+  warmup are dropped."""
+
+  samples = []
+  lock = threading.Lock()
+  measure_from = time.monotonic() + warmup
+  deadline = measure_from + duration
+
+  def run_user(number):
+    user = VirtualUser(HTTPTransport(base_url), random.Random(seed * 1000 + number), ids, f'p{seed}v{number}')
+    while time.monotonic() < deadline:
+      started = time.monotonic()
+      try:
+        sample = user.step()
+      except Exception as exc:
+        sample = ('error', None, False, time.monotonic() - started, None)
+        print(f"ERROR: load test request failed: {exc}", file=sys.stderr)
+      if started >= measure_from:
+        with lock:
+          samples.append(sample)
+
+  threads = [threading.Thread(target=run_user, args=(number,)) for number in range(vus)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return samples
+
+def run_http(db_name, ids, args):
+  """Starts gunicorn on the scale's database, runs the load generator processes against it and stops it. Returns (samples, seconds)."""
+
+  from benchmarks.standins import StandInSMTPServer
+
+  with StandInSMTPServer() as smtp_server:
+    environ = dict(os.environ, DATABASE_URL=f'postgresql:///{db_name}', APP_ENV='production', PYTHONPATH=os.getcwd(),
+                   PASSWORD_HASH_ROUNDS=str(args.hash_rounds), LOAD_TEST_SMTP_PORT=str(smtp_server.port))
+    command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--workers', str(args.workers),
+               '--bind', f'127.0.0.1:{args.port}', 'benchmarks.load_test:server_app()']
+    server = subprocess.Popen(command, env=environ, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{args.port}'
+    try:
+      wait_until_serving(server, base_url)
+      with ProcessPoolExecutor(max_workers=args.processes) as executor:
+        futures = [executor.submit(run_load_process, base_url, ids, args.vus, args.warmup, args.duration, number + 1)
+                   for number in range(args.processes)]
+        samples = [sample for future in futures for sample in future.result()]
+    finally:
+      server.send_signal(signal.SIGTERM)
+      server.wait()
+  return samples, args.duration
+
+def wait_until_serving(server, base_url, timeout=120):
+  deadline = time.monotonic() + timeout
+  while time.monotonic() < deadline:
+    if server.poll() is not None:
+      raise RuntimeError(f"gunicorn exited with code {server.returncode}")
+    try:
+      with urllib.request.urlopen(f'{base_url}/', timeout=5) as response:
+        response.read()
+      return
+    except OSError:
+      time.sleep(0.2)
+  raise RuntimeError(f"gunicorn didn't start serving within {timeout} seconds")
+
+def summarize(samples, seconds):
+  """Per action and in total: requests, errors, p50/p95/p99 latency in milliseconds, mean queries per request and requests per second."""
+
+  def stats(group):
+    latencies = sorted(sample[3] * 1000 for sample in group)
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    query_counts = [sample[4] for sample in group if sample[4] is not None]
+    return {
+      'requests': len(group),
+      'errors': sum(not sample[2] for sample in group),
+      'p50_ms': round(percentiles[49], 2),
+      'p95_ms': round(percentiles[94], 2),
+      'p99_ms': round(percentiles[98], 2),
+      'queries_per_request': round(statistics.mean(query_counts), 2) if query_counts else None,
+      'requests_per_second': round(len(group) / seconds, 2),
+    }
+
+  actions = {}
+  for sample in samples:
+    actions.setdefault(sample[0], []).append(sample)
+  return {'actions': {action: stats(group) for action, group in sorted(actions.items())}, 'total': stats(samples)}
+
+def print_summary(title, summary):
+  print(f"\n{title}")
+  print(f"{'':>14} {'requests':>9} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8} {'req/s':>8}")
+  for action, stats in list(summary['actions'].items()) + [('total', summary['total'])]:
+    queries = '' if stats['queries_per_request'] is None else f"{stats['queries_per_request']:.2f}"
+    print(f"{action:>14} {stats['requests']:>9} {stats['errors']:>7} {stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} "
+          f"{stats['p99_ms']:>8.1f} {queries:>8} {stats['requests_per_second']:>8.1f}")
+
+def compare(summary, baseline, tolerance, slack_ms=2.0):
+  """Returns the regressions of summary against a saved baseline summary, as readable strings. slack_ms keeps jitter in requests that
+  take a couple of milliseconds from counting as a regression."""
+
+  regressions = []
+  for action, stats in summary['actions'].items():
+    base = baseline['actions'].get(action)
+    if base is None:
+      continue
+    if stats['p95_ms'] > base['p95_ms'] * (1 + tolerance) + slack_ms:
+      regressions.append(f"{action}: p95 {stats['p95_ms']:.1f} ms, baseline {base['p95_ms']:.1f} ms")
+    if None not in (stats['queries_per_request'], base['queries_per_request']) and \
+       stats['queries_per_request'] > base['queries_per_request'] + 0.5:
+      regressions.append(f"{action}: {stats['queries_per_request']:.2f} queries per request, baseline {base['queries_per_request']:.2f}")
+    if stats['errors'] / stats['requests'] > base['errors'] / base['requests'] + 0.01:
+      regressions.append(f"{action}: {stats['errors']} errors in {stats['requests']} requests, baseline {base['errors']} in "
+                         f"{base['requests']}")
+  if summary['total']['requests_per_second'] < baseline['total']['requests_per_second'] * (1 - tolerance):
+    regressions.append(f"throughput {summary['total']['requests_per_second']:.1f} requests/s, baseline "
+                       f"{baseline['total']['requests_per_second']:.1f}")
+  return regressions
+
+def git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def baseline_path(mode, scale):
+  return os.path.join(BASELINE_FOLDER, f'{mode}-{scale}.json')
+
+def report(mode, scale, settings, summary, args):
+  """Prints a run's results, compares them with the saved baseline and saves them as the new one if asked. Returns the regressions."""
+
+  print_summary(f"{mode} mode, {scale} scale ({', '.join(f'{name}={value}' for name, value in settings.items())}):", summary)
+  path = baseline_path(mode, scale)
+  regressions = []
+  if os.path.exists(path) and not args.save_baseline:
+    with open(path) as baseline_file:
+      baseline = json.load(baseline_file)
+    if baseline['settings'] != settings:
+      # Different request counts, durations or work factors make latencies and throughput incomparable.
+      saved_with = ', '.join(f'{name}={value}' for name, value in baseline['settings'].items())
+      print(f"not compared: the baseline was saved with different settings ({saved_with}); run with those, or save a new baseline "
+            f"with --save-baseline")
+    else:
+      regressions = compare(summary, baseline['summary'], args.tolerance)
+      print(f"compared with the baseline from {baseline['created_at']} (commit {baseline['commit']}): "
+            f"{len(regressions)} regression{'s' if len(regressions) != 1 else ''}")
+      for regression in regressions:
+        print(f"  REGRESSION {regression}")
+
+  if args.save_baseline:
+    os.makedirs(BASELINE_FOLDER, exist_ok=True)
+    baseline = {
+      'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+      'commit': git_commit(),
+      'machine': {'cpus': os.cpu_count(), 'python': platform.python_version(), 'platform': platform.platform()},
+      'settings': settings,
+      'summary': summary,
+    }
+    with open(path, 'w') as baseline_file:
+      json.dump(baseline, baseline_file, indent=2)
+      baseline_file.write('\n')
+    print(f"saved as the baseline in {os.path.relpath(path)}")
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--scale', choices=SCALES, default='small')
+  parser.add_argument('--mode', choices=('client', 'http', 'both'), default='both')
+  parser.add_argument('--reseed', action='store_true', help="seed the scale's database again even if it already has the data")
+  parser.add_argument('--requests', type=int, default=2000, help="requests sent in client mode")
+  parser.add_argument('--vus', type=int, default=4, help="virtual users in client mode, and per load generator process in http mode")
+  parser.add_argument('--processes', type=int, default=2, help="load generator processes in http mode")
+  parser.add_argument('--workers', type=int, default=4, help="gunicorn workers in http mode")
+  parser.add_argument('--duration', type=float, default=30, help="seconds measured in http mode")
+  parser.add_argument('--warmup', type=float, default=5, help="seconds of load before measuring in http mode")
+  parser.add_argument('--port', type=int, default=8766)
+  parser.add_argument('--hash-rounds', type=int, default=12, help="bcrypt work factor of the seeded and signed up users")
+  parser.add_argument('--seed', type=int, default=0, help="random seed of the virtual users")
+  parser.add_argument('--tolerance', type=float, default=0.25, help="allowed slowdown before a change counts as a regression")
+  parser.add_argument('--save-baseline', action='store_true', help="save the results as the baseline instead of comparing with it")
+  args = parser.parse_args()
+
+  from benchmarks.common import make_bench_app
+  from benchmarks.standins import StandInSMTPServer
+  from services.password_hashing import password_hasher
+  from services.rate_limiting import rate_limiter
+
+  db_name = f'hackornews2_load_{args.scale}'
+  app = make_bench_app(db_name, SERVER_TIMING_HEADER=True)
+  ids = ensure_seeded(args.scale, args.hash_rounds, args.reseed)
+
+  regressions = []
+  if args.mode in ('client', 'both'):
+    password_hasher.configure(rounds=args.hash_rounds, workers=0)
+    rate_limiter.configure(backend=rate_limiter.backend, enabled=False)
+    with StandInSMTPServer() as smtp_server:
+      use_stand_in_email(smtp_server.port)
+      samples, seconds = run_client(app, ids, args.requests, args.vus, args.seed)
+    settings = {'requests': args.requests, 'vus': args.vus, 'hash_rounds': args.hash_rounds, 'seed': args.seed}
+    regressions += report('client', args.scale, settings, summarize(samples, seconds), args)
+
+  if args.mode in ('http', 'both'):
+    samples, seconds = run_http(db_name, ids, args)
+    settings = {'processes': args.processes, 'vus': args.vus, 'workers': args.workers, 'duration': args.duration,
+                'warmup': args.warmup, 'hash_rounds': args.hash_rounds}
+    regressions += report('http', args.scale, settings, summarize(samples, seconds), args)
+
+  sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+  main()
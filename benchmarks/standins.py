@@ -0,0 +1,148 @@
+"""Local stand-in servers that the benchmarks point the app's services at instead of real third-party servers. Each server runs on a
+daemon thread, binds to an ephemeral port on localhost, and can add an artificial delay to imitate network latency."""
+
+import http.server
+import socketserver
+import sys
+import threading
+import time
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def handle_error(self, request, client_address):
+    # Clients dropping idle keep-alive connections are expected, not worth a traceback.
+    if not isinstance(sys.exc_info()[1], ConnectionError):
+      super().handle_error(request, client_address)
+
+class StandInSMTPServer:
+  """Speaks just enough SMTP for an RCPT TO check. Mail for local parts that start with 'missing' is rejected with 550, everything else
+  is accepted with 250. delay seconds are slept before the greeting, like a slow remote mail server."""
+
+  def __init__(self, delay=0.0):
+    self.delay = delay
+    self.connections = 0
+    stand_in = self
+
+    class Handler(socketserver.StreamRequestHandler):
+      def handle(self):
+        stand_in.connections += 1
+        time.sleep(stand_in.delay)
+        self.wfile.write(b"220 stand-in ESMTP\r\n")
+        for raw_line in self.rfile:
+          command = raw_line.decode('ascii', 'replace').strip()
+          verb = command.split(' ', 1)[0].upper()
+          if verb == 'QUIT':
+            self.wfile.write(b"221 bye\r\n")
+            return
+          if verb == 'RCPT' and '<missing' in command.lower():
+            self.wfile.write(b"550 no such user\r\n")
+          else:
+            self.wfile.write(b"250 ok\r\n")
+
+    self._server = _ThreadingTCPServer(('127.0.0.1', 0), Handler)
+    self.host, self.port = self._server.server_address
+
+  def __enter__(self):
+    threading.Thread(target=self._server.serve_forever, daemon=True).start()
+    return self
+
+  def __exit__(self, *exc_info):
+    self._server.shutdown()
+    self._server.server_close()
+
+class StandInHTTPServer:
+  """Serves a small HTML page with a title, description and favicon link at every path, with an ETag so that a conditional request
+  gets a 304. Paths that start with /missing are 404s, and the paths in files ({path: (content type, body)}) serve those bodies instead.
+  delay seconds are slept before each response, like a slow site. host is the loopback address to listen on: every 127.x.x.x address
+  is the local machine, so servers on different ones look like different sites.
+
+  requests and not_modified count the requests served; max_concurrent is the most requests it was ever serving at once, and
+  min_gap the shortest time between the end of one response and the start of the next request (None until there are two)."""
+
+  ETAG = '"stand-in-v1"'
+
+  def __init__(self, delay=0.0, name='Stand-in', files=None, host='127.0.0.1'):
+    self.delay = delay
+    self.name = name
+    self.files = dict(files or {})
+    self.requests = 0
+    self.not_modified = 0
+    self.max_concurrent = 0
+    self.min_gap = None
+    self._concurrent = 0
+    self._last_finished = None
+    self._lock = threading.Lock()
+    stand_in = self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+
+      def do_GET(self):
+        stand_in._started()
+        try:
+          time.sleep(stand_in.delay)
+          if self.path.startswith('/missing'):
+            self._respond(404, b'not found')
+          elif self.path in stand_in.files:
+            content_type, body = stand_in.files[self.path]
+            self._respond(200, body, {'Content-Type': content_type})
+          elif self.headers.get('If-None-Match') == stand_in.ETAG:
+            stand_in.not_modified += 1
+            self._respond(304, b'')
+          else:
+            body = (f'<!doctype html><html><head><title>{stand_in.name} {self.path}</title>'
+                    f'<meta name="description" content="A page served by the stand-in at {self.path}.">'
+                    f'<link rel="icon" href="/static/icon.png"></head><body>Hello</body></html>').encode()
+            self._respond(200, body, {'Content-Type': 'text/html; charset=utf-8', 'ETag': stand_in.ETAG})
+        finally:
+          stand_in._finished()
+
+      def _respond(self, status, body, headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+          self.send_header(name, value)
+        if status != 304:
+          self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    self._server = _ThreadingHTTPServer((host, 0), Handler)
+    self.host, self.port = self._server.server_address
+    self.url = f'http://{self.host}:{self.port}'
+
+  def reset_counts(self):
+    with self._lock:
+      self.requests = self.not_modified = self.max_concurrent = 0
+      self.min_gap = self._last_finished = None
+
+  def _started(self):
+    with self._lock:
+      now = time.monotonic()
+      self.requests += 1
+      self._concurrent += 1
+      self.max_concurrent = max(self.max_concurrent, self._concurrent)
+      if self._last_finished is not None and self._concurrent == 1:
+        gap = now - self._last_finished
+        self.min_gap = gap if self.min_gap is None else min(self.min_gap, gap)
+
+  def _finished(self):
+    with self._lock:
+      self._concurrent -= 1
+      self._last_finished = time.monotonic()
+
+  def __enter__(self):
+    threading.Thread(target=self._server.serve_forever, daemon=True).start()
+    return self
+
+  def __exit__(self, *exc_info):
+    self._server.shutdown()
+    self._server.server_close()
@@ -0,0 +1,11 @@
+"""This is the file where the forms dealing with stories are defined."""
+
+from flask_wtf import FlaskForm
+from wtforms import HiddenField
+from wtforms.validators import AnyOf
+
+class StoryToggleForm(FlaskForm):
+  """The favorite and bookmark buttons. is_set is the state the user wants ('1' to favorite/bookmark the story, '0' to undo it) rather
+  than a flip of the current state, so submitting the same button twice does the same thing twice."""
+
+  is_set = HiddenField(validators=[AnyOf(['1', '0'])])
@@ -0,0 +1,21 @@
+"""gunicorn settings. The app is built once in the master process (preload_app) and the workers are forked from it, so they start in
+milliseconds and share the memory of the imported code with the master until they write to it. Nothing in the app opens database
+connections or starts threads while it's being built in production, but any connection pools are reset in each worker anyway, since
+a connection inherited across a fork can't be shared."""
+
+import os
+
+wsgi_app = 'wsgi:app'
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2 * (os.cpu_count() or 1) + 1))
+preload_app = True
+
+def post_fork(server, worker):
+  from models.init_db import db
+  from services.password_hashing import password_hasher
+
+  with server.app.wsgi().app_context():
+    for engine in db.engines.values():
+      engine.dispose(close=False)
+    # Every worker starts its own bcrypt pool, so they split the CPUs between them.
+    password_hasher.current().app_processes = server.cfg.workers
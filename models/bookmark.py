@@ -1,13 +1,20 @@
 """This file contains the Bookmarks model."""
 
 from models.init_db import db
+from models.counter_cache import add_story_counter_triggers
+from models.story_toggle import StoryToggleMixin
+from models.hot_ranking import BOOKMARK_WEIGHT
 from datetime import datetime, timezone
 
-class Bookmark(db.Model):
+class Bookmark(StoryToggleMixin, db.Model):
   """A User can bookmark any Story in the app. Each bookmark has an associated user id and story id."""
 
   __tablename__ = "bookmarks"
+  story_counter_column = 'bookmark_count'
 
   user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), primary_key=True)
   story_id = db.Column(db.Integer, db.ForeignKey('stories.id', ondelete='cascade'), primary_key=True)
-  created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
\ No newline at end of file
+  created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+# Keep the stories' bookmark_count and hot scores (in story_engagement) in sync with this table.
+add_story_counter_triggers(Bookmark.__table__, Bookmark.story_counter_column, BOOKMARK_WEIGHT)
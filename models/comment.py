@@ -1,16 +1,153 @@
 """This file contains the Comments model."""
 
+from collections import namedtuple
+
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import ARRAY, array
+from sqlalchemy.orm import configure_mappers, joinedload
+
 from models.init_db import db
+from models.counter_cache import add_story_counter_triggers
+from models.hot_ranking import COMMENT_WEIGHT
 from datetime import datetime, timezone
 
+# A page of a story's discussion: a slice of its top-level comments with their replies, in the order they're displayed.
+# next_cursor is None on the last page, otherwise pass it back to get_thread_page to get the next page.
+CommentPage = namedtuple('CommentPage', ['comments', 'next_cursor'])
+
+# Largest value of a PostgreSQL integer. path || MAX_COMMENT_ID sorts after the paths of all of a comment's descendants, and
+# ARRAY[MAX_COMMENT_ID] after every path.
+MAX_COMMENT_ID = 2 ** 31 - 1
+
 class Comment(db.Model):
-  """Any user can leave a comment on any story. Each comment has a required content field. Users can create, edit, and delete their own comments."""
+  """Any user can leave a comment on any story. Each comment has a required content field. Users can create, edit, and delete their own comments.
+
+  Comments are threaded: a comment can reply to another comment (parent_id) on the same story. Each comment stores its materialized
+  path, the ids of its top-level ancestor down to itself, e.g. [12, 40, 57] for a reply (57) to a reply (40) to comment 12. Sorting a
+  story's comments by path lists them in display order (every comment followed by its replies, oldest first), and a comment's
+  descendants are exactly the comments whose path falls between its own path and path || MAX_COMMENT_ID, so whole threads and slices of
+  a discussion are a single range scan of the (story_id, path) index. path and depth are filled in by the database when a comment is
+  inserted, as is descendant_count on all of its ancestors."""
 
   __tablename__ = "comments"
+  __table_args__ = (
+    # A story's discussion in display order, and the range scans for threads and pages of it.
+    db.Index('ix_comments_story_id_path', 'story_id', 'path'),
+    # A story's top-level comments in order, to find where each page starts and ends.
+    db.Index('ix_comments_story_id_top_level', 'story_id', 'id', postgresql_where=db.text('parent_id IS NULL')),
+    # A user's comments, oldest first, for exports.
+    db.Index('ix_comments_user_id_id', 'user_id', 'id'),
+  )
 
   id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-  user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), primary_key=True)
-  story_id = db.Column(db.Integer, db.ForeignKey('stories.id', ondelete='cascade'), primary_key=True)
+  user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), nullable=False)
+  story_id = db.Column(db.Integer, db.ForeignKey('stories.id', ondelete='cascade'), nullable=False)
+  parent_id = db.Column(db.Integer, db.ForeignKey('comments.id', ondelete='cascade'))
   content = db.Column(db.Text, nullable=False)
-  created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
-  updated_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
\ No newline at end of file
+  created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+  updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+  path = db.Column(ARRAY(db.Integer), nullable=False, server_default='{}')
+  # 0 for top-level comments, 1 for their replies, and so on.
+  depth = db.Column(db.SmallInteger, nullable=False, server_default='0')
+  # Number of replies, replies to replies, etc. below this comment, kept up to date by the database.
+  descendant_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+  @classmethod
+  def _thread_query(cls):
+    # Comment.user is a backref, which only exists once all the mappers have been configured.
+    configure_mappers()
+    return cls.query.options(joinedload(cls.user))
+
+  @classmethod
+  def get_thread_page(cls, story_id, cursor=None, per_page=20, max_depth=3):
+    """Returns a CommentPage of per_page top-level comments of story_id, oldest first, each followed by its replies down to max_depth
+    levels below it, in display order. cursor is the id of the first top-level comment of the page (the next_cursor of the previous
+    page). Replies deeper than max_depth aren't loaded; the descendant_count of the comments at max_depth tells how many there are, and
+    get_thread loads them.
+
+    The whole page, including each commenter (comment.user), is loaded in one query: subqueries find the page's first top-level comment
+    and the next page's, and since every comment on the page sorts between those two in path order, the page is one range of the
+    (story_id, path) index."""
+
+    top_level = db.session.query(cls.id).filter(cls.story_id == story_id, cls.parent_id.is_(None))
+    if cursor is not None:
+      top_level = top_level.filter(cls.id >= cursor)
+    top_level = top_level.order_by(cls.id)
+    first_id = top_level.limit(1).scalar_subquery()
+    next_page_id = top_level.offset(per_page).limit(1).scalar_subquery()
+
+    rows = (cls._thread_query()
+            .add_columns(next_page_id)
+            .filter(cls.story_id == story_id,
+                    cls.path >= array([first_id]),
+                    cls.path < array([db.func.coalesce(next_page_id, MAX_COMMENT_ID)]),
+                    cls.depth <= max_depth)
+            .order_by(cls.path).all())
+
+    if not rows:
+      return CommentPage([], None)
+    return CommentPage([comment for comment, _ in rows], rows[0][1])
+
+  @classmethod
+  def get_thread(cls, comment_id, max_depth=None):
+    """Returns the comment with id comment_id followed by all its replies (only max_depth levels deep if given) in display order, or an
+    empty list if there's no such comment. One query, a range scan of the (story_id, path) index."""
+
+    root = db.aliased(cls)
+    query = (cls._thread_query()
+             .join(root, root.id == comment_id)
+             .filter(cls.story_id == root.story_id,
+                     cls.path >= root.path,
+                     cls.path <= db.func.array_append(root.path, MAX_COMMENT_ID)))
+    if max_depth is not None:
+      query = query.filter(cls.depth <= root.depth + max_depth)
+    return query.order_by(cls.path).all()
+
+# Keep the stories' comment_count and hot scores (in story_engagement) in sync with this table.
+add_story_counter_triggers(Comment.__table__, 'comment_count', COMMENT_WEIGHT)
+
+# Fills in each new comment's path and depth from its parent's, and counts it in the descendant_count of all its ancestors. Works for
+# every way of inserting comments (ORM, COPY, INSERT ... SELECT), and replies inserted by the same statement as their parent.
+event.listen(Comment.__table__, 'after_create', DDL("""
+  CREATE OR REPLACE FUNCTION comments_set_path() RETURNS trigger AS $$
+  DECLARE
+    parent comments%%ROWTYPE;
+  BEGIN
+    IF NEW.parent_id IS NULL THEN
+      NEW.path := ARRAY[NEW.id];
+    ELSE
+      SELECT * INTO parent FROM comments WHERE id = NEW.parent_id;
+      IF NOT FOUND OR parent.story_id <> NEW.story_id THEN
+        RAISE foreign_key_violation USING MESSAGE = format('comment %%s is not a comment on story %%s', NEW.parent_id, NEW.story_id);
+      END IF;
+      NEW.path := parent.path || NEW.id;
+    END IF;
+    NEW.depth := cardinality(NEW.path) - 1;
+    NEW.descendant_count := 0;
+    RETURN NEW;
+  END
+  $$ LANGUAGE plpgsql;
+
+  CREATE OR REPLACE FUNCTION comments_update_descendant_counts() RETURNS trigger AS $$
+  DECLARE
+    direction integer := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+  BEGIN
+    UPDATE comments SET descendant_count = descendant_count + direction * changed.descendants
+    FROM (
+      SELECT ancestor_id, count(*) AS descendants
+      FROM changed_rows, unnest(changed_rows.path[1:cardinality(changed_rows.path) - 1]) AS ancestor_id
+      GROUP BY ancestor_id
+    ) AS changed
+    WHERE comments.id = changed.ancestor_id;
+    RETURN NULL;
+  END
+  $$ LANGUAGE plpgsql;
+
+  CREATE TRIGGER comments_set_path BEFORE INSERT ON comments
+    FOR EACH ROW EXECUTE FUNCTION comments_set_path();
+  CREATE TRIGGER comments_count_descendant_inserts AFTER INSERT ON comments
+    REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION comments_update_descendant_counts();
+  CREATE TRIGGER comments_count_descendant_deletes AFTER DELETE ON comments
+    REFERENCING OLD TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION comments_update_descendant_counts();
+""").execute_if(dialect='postgresql'))
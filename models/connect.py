@@ -1,12 +1,85 @@
 """Initializes the SQLAlchemy database and connects it to the application context. All the models in this folder will be in this database."""
 
+from contextlib import contextmanager
+
+from sqlalchemy.pool import NullPool
+
 from models.init_db import db
+from models.routing import REPLICA_BIND_PREFIX
+
+def database_engine_options(environ):
+  """Builds SQLALCHEMY_ENGINE_OPTIONS (connection pool settings) from environment variables, so they can be tuned per deployment:
+
+  DB_POOL_SIZE / DB_MAX_OVERFLOW: connections kept open per worker process, and extra ones allowed during bursts.
+  DB_POOL_TIMEOUT: seconds to wait for a free connection before giving up.
+  DB_POOL_RECYCLE: seconds after which a connection is replaced, before the server or a proxy drops it for being idle.
+  DB_POOL_PRE_PING: '1' (default) checks that a connection is still alive before handing it out.
+  DB_EXTERNAL_POOLER: '1' when connecting through an external pooler such as PgBouncer, which already pools connections, so every
+  checkout gets a fresh connection to the pooler instead.
+  DB_STATEMENT_TIMEOUT_MS: cancels any statement running longer than this. Many poolers reject this startup option, so behind one set
+  statement_timeout on the database role instead."""
+
+  options = {'pool_pre_ping': environ.get('DB_POOL_PRE_PING', '1') == '1'}
+  if environ.get('DB_EXTERNAL_POOLER') == '1':
+    options['poolclass'] = NullPool
+  else:
+    options.update(
+      pool_size = int(environ.get('DB_POOL_SIZE', 5)),
+      max_overflow = int(environ.get('DB_MAX_OVERFLOW', 10)),
+      pool_timeout = float(environ.get('DB_POOL_TIMEOUT', 30)),
+      pool_recycle = int(environ.get('DB_POOL_RECYCLE', 1800))
+    )
+
+  if environ.get('DB_STATEMENT_TIMEOUT_MS'):
+    options['connect_args'] = {'options': f"-c statement_timeout={int(environ['DB_STATEMENT_TIMEOUT_MS'])}"}
+  return options
+
+def replica_binds(replica_urls, engine_options):
+  """SQLALCHEMY_BINDS entries for the read replicas. Replica engines use the same pool settings as the primary, and their connections
+  are read only so a query wrongly routed to a replica fails instead of writing to it."""
+
+  binds = {}
+  for number, url in enumerate(replica_urls):
+    options = dict(engine_options, url=url)
+    connect_args = dict(options.get('connect_args', {}))
+    connect_args['options'] = (connect_args.get('options', '') + ' -c default_transaction_read_only=on').strip()
+    options['connect_args'] = connect_args
+    binds[f"{REPLICA_BIND_PREFIX}{number}"] = options
+  return binds
 
 def connect_db(app):
   """Connect the SQLAlchemy instance/database, db, to Flask application instance provided in app.py.
-  That is, links the database with the models in this app as the database for the Hack-or-News 2 application initialized in app.py"""
+  That is, links the database with the models in this app as the database for the Hack-or-News 2 application initialized in app.py.
+  Read replicas listed in the app's DATABASE_REPLICA_URLS config are added as extra binds, see models/routing.py. Unless the
+  DATABASE_MIGRATE config is False, the primary database's schema is brought up to date too (see models/migrations.py)."""
+
+  # Imported here since the migrations import every model, and some models import this file.
+  from models.migrations import migrate
+
+  replica_urls = app.config.setdefault('DATABASE_REPLICA_URLS', [])
+  if replica_urls:
+    app.config.setdefault('SQLALCHEMY_BINDS', {}).update(replica_binds(replica_urls, app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})))
+
+  @app.cli.command('migrate')
+  def migrate_command():
+    """Applies the schema migrations the primary database doesn't have yet (see models/migrations.py)."""
+    for migration in migrate():
+      print(f"Applied migration {migration.version}: {migration.name}")
 
   with app.app_context():
     db.app = app
     db.init_app(app)
-    db.create_all() # Create all tables specified by the models above in the database.
\ No newline at end of file
+    # Bring the primary database's schema up to date, unless that's left to `flask migrate` when deploying (production).
+    if app.config.setdefault('DATABASE_MIGRATE', True):
+      migrate()
+
+@contextmanager
+def read_from_replica():
+  """Within this block, read-only queries made through db.session may be answered by a read replica (if any are configured)."""
+
+  routing_session = db.session()
+  routing_session.replica_depth += 1
+  try:
+    yield routing_session
+  finally:
+    routing_session.replica_depth -= 1
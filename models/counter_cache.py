@@ -0,0 +1,43 @@
+"""Keeps the favorite_count, bookmark_count and comment_count of each story's story_engagement row consistent with the favorites,
+bookmarks and comments tables. The counters are maintained by PostgreSQL triggers rather than in Python so that every way of adding or
+removing rows is covered: the ORM, bulk INSERT ... ON CONFLICT / DELETE statements, COPY, and rows removed by ON DELETE CASCADE.
+
+The same triggers keep the stories' hot scores (see models/hot_ranking.py) up to date, adding or subtracting each row's weight. Both
+live in the narrow story_engagement row, so each change is a single UPDATE of it, and the wide stories row is never rewritten.
+
+The triggers are statement-level and use transition tables, so inserting or deleting many rows at once costs one UPDATE per affected
+story instead of one per row."""
+
+from sqlalchemy import DDL, event
+
+def add_story_counter_triggers(table, counter_column, hot_score_weight):
+  """Creates the triggers that keep story_engagement.<counter_column> equal to the number of rows in table referencing each story, and
+  add (or subtract) hot_score_weight to the story's hot score for every row inserted (or deleted). Called by the favorites, bookmarks
+  and comments models, and run automatically right after their table is created."""
+
+  function_name = f"{table.name}_update_story_engagement"
+  counter_ddl = DDL(f"""
+    CREATE OR REPLACE FUNCTION {function_name}() RETURNS trigger AS $$
+    DECLARE
+      direction integer := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+      score_epoch timestamp := lock_hot_score_epoch();
+    BEGIN
+      UPDATE story_engagement
+      SET {counter_column} = {counter_column} + direction * changed.row_count,
+          hot_score = greatest(hot_score + direction * changed.score_change, 0)
+      FROM (
+        SELECT story_id, count(*) AS row_count, sum(hot_score_change(created_at, {hot_score_weight}, score_epoch)) AS score_change
+        FROM changed_rows GROUP BY story_id
+      ) AS changed
+      WHERE story_engagement.story_id = changed.story_id;
+      RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER {table.name}_count_inserts AFTER INSERT ON {table.name}
+      REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION {function_name}();
+    CREATE TRIGGER {table.name}_count_deletes AFTER DELETE ON {table.name}
+      REFERENCING OLD TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION {function_name}();
+  """)
+
+  event.listen(table, 'after_create', counter_ddl.execute_if(dialect='postgresql'))
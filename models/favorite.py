@@ -1,13 +1,20 @@
 """This file contains the Favorites model."""
 
 from models.init_db import db
+from models.counter_cache import add_story_counter_triggers
+from models.story_toggle import StoryToggleMixin
+from models.hot_ranking import FAVORITE_WEIGHT
 from datetime import datetime, timezone
 
-class Favorite(db.Model):
+class Favorite(StoryToggleMixin, db.Model):
   """A User can favorite any Story currently registered in the app, and each Favorite will be associated with a user id and story id."""
 
   __tablename__ = "favorites"
+  story_counter_column = 'favorite_count'
 
   user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), primary_key=True)
   story_id = db.Column(db.Integer, db.ForeignKey('stories.id', ondelete='cascade'), primary_key=True)
-  created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
\ No newline at end of file
+  created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+# Keep the stories' favorite_count and hot scores (in story_engagement) in sync with this table.
+add_story_counter_triggers(Favorite.__table__, Favorite.story_counter_column, FAVORITE_WEIGHT)
@@ -0,0 +1,123 @@
+"""The "hot" ranking of stories. A story's hot score is the sum of the weights of the story itself and of every favorite, bookmark and
+comment it received, each decayed exponentially by its age (halving every HOT_SCORE_HALF_LIFE_HOURS), so stories with a lot of recent
+engagement rank highest.
+
+Decaying every score as time passes would mean rewriting every story's score all the time. Instead, each event's weight is stored
+pre-multiplied by exp(DECAY_RATE * seconds between the epoch and the event). At any moment every story's real score is its stored score
+times the same factor exp(-DECAY_RATE * seconds since the epoch), so ordering by the stored score gives the same order as ordering by the
+real score, and the stored scores never need to change as time passes. The hot feed is then a single scan of the score index.
+
+The stored scores live in story_engagement along with the engagement counters (see models/story_engagement.py), and are kept up to
+date incrementally by PostgreSQL triggers (see models/counter_cache.py): adding or removing a favorite, bookmark or comment adds or
+subtracts that one event's weight, and posting a story creates its row. Because the stored scores grow exponentially with the time
+since the epoch, rebase_hot_scores occasionally moves the epoch to the present and scales every score down to match (see
+services/hot_ranking.py for the background job that does this), long before they could overflow."""
+
+import math
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import DDL, event, text
+
+from models.init_db import db
+from models.story_engagement import StoryEngagement
+
+HOT_SCORE_HALF_LIFE_HOURS = 12
+# Per second.
+DECAY_RATE = math.log(2) / (HOT_SCORE_HALF_LIFE_HOURS * 3600)
+
+# What each kind of engagement adds to a story's score at the moment it happens. Posting the story counts too, so that new stories
+# without any engagement yet are ranked by how recent they are.
+POST_WEIGHT = 1.0
+FAVORITE_WEIGHT = 1.0
+BOOKMARK_WEIGHT = 2.0
+COMMENT_WEIGHT = 2.0
+
+# Rebasing sets scores that have decayed below this to 0, so stories nobody has engaged with for months stop being rewritten.
+MIN_HOT_SCORE = 1e-9
+
+# Advisory lock taken in shared mode by every score update and in exclusive mode by rebases, so no update can use the old epoch while a
+# rebase is rescaling the scores.
+HOT_SCORE_LOCK_KEY = 0x486f7453636f7265
+
+class HotRankingEpoch(db.Model):
+  """The single row holding the time that stored hot scores are relative to."""
+
+  __tablename__ = "hot_ranking_epoch"
+
+  id = db.Column(db.Integer, primary_key=True)
+  epoch = db.Column(db.DateTime, nullable=False)
+
+def utc_now():
+  return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def rebase_hot_scores(min_age=timedelta(0)):
+  """Moves the epoch to now and scales every stored score down by the decay since the old epoch, unless the epoch is less than min_age
+  old. Returns whether the scores were rebased. Score updates wait while this runs. The caller must commit."""
+
+  db.session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': HOT_SCORE_LOCK_KEY})
+  old_epoch = db.session.execute(db.select(HotRankingEpoch.epoch)).scalar_one()
+  new_epoch = utc_now()
+  if new_epoch - old_epoch < min_age:
+    return False
+
+  decay = math.exp(-DECAY_RATE * (new_epoch - old_epoch).total_seconds())
+  decayed_score = StoryEngagement.hot_score * decay
+  db.session.execute(db.update(StoryEngagement)
+                     .where(StoryEngagement.hot_score != 0)
+                     .values(hot_score=db.case((decayed_score < MIN_HOT_SCORE, 0.0), else_=decayed_score)))
+  db.session.execute(db.update(HotRankingEpoch).values(epoch=new_epoch))
+  return True
+
+def recompute_hot_scores():
+  """Recomputes every story's stored score from scratch relative to a new epoch. The triggers keep the scores correct as rows change,
+  so this is only needed to repair them or after changing the weights or the half-life. The caller must commit."""
+
+  db.session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': HOT_SCORE_LOCK_KEY})
+  epoch = utc_now()
+  db.session.execute(db.update(HotRankingEpoch).values(epoch=epoch))
+  db.session.execute(text(f"""
+    INSERT INTO story_engagement (story_id, hot_score)
+    SELECT stories.id, hot_score_change(stories.created_at, {POST_WEIGHT}, :epoch) + coalesce(engagement.score, 0)
+    FROM stories LEFT JOIN (
+      SELECT story_id, sum(score) AS score FROM (
+        SELECT story_id, hot_score_change(created_at, {FAVORITE_WEIGHT}, :epoch) AS score FROM favorites
+        UNION ALL SELECT story_id, hot_score_change(created_at, {BOOKMARK_WEIGHT}, :epoch) FROM bookmarks
+        UNION ALL SELECT story_id, hot_score_change(created_at, {COMMENT_WEIGHT}, :epoch) FROM comments
+      ) AS events GROUP BY story_id
+    ) AS engagement ON engagement.story_id = stories.id
+    ON CONFLICT (story_id) DO UPDATE SET hot_score = excluded.hot_score
+  """), {'epoch': epoch})
+
+# hot_score_change(event_time, weight, epoch) is the stored score an event adds. lock_hot_score_epoch() takes the shared lock and returns
+# the current epoch; it has to be called before reading the epoch so that a rebase committed in the meantime is seen.
+event.listen(HotRankingEpoch.__table__, 'after_create', DDL(f"""
+  INSERT INTO hot_ranking_epoch (id, epoch) VALUES (1, now() AT TIME ZONE 'utc');
+
+  CREATE OR REPLACE FUNCTION hot_score_change(event_time timestamp, weight double precision, score_epoch timestamp)
+  RETURNS double precision AS $$
+    SELECT weight * exp({DECAY_RATE!r} * extract(epoch FROM coalesce(event_time, now() AT TIME ZONE 'utc') - score_epoch)::double precision)
+  $$ LANGUAGE sql STABLE;
+
+  CREATE OR REPLACE FUNCTION lock_hot_score_epoch() RETURNS timestamp AS $$
+  BEGIN
+    PERFORM pg_advisory_xact_lock_shared({HOT_SCORE_LOCK_KEY});
+    RETURN (SELECT epoch FROM hot_ranking_epoch);
+  END
+  $$ LANGUAGE plpgsql;
+""").execute_if(dialect='postgresql'))
+
+# Every new story gets its engagement row, with no engagement yet and a score worth POST_WEIGHT at the time it was posted.
+event.listen(StoryEngagement.__table__, 'after_create', DDL(f"""
+  CREATE OR REPLACE FUNCTION stories_insert_engagement() RETURNS trigger AS $$
+  DECLARE
+    score_epoch timestamp := lock_hot_score_epoch();
+  BEGIN
+    INSERT INTO story_engagement (story_id, hot_score)
+    SELECT id, hot_score_change(created_at, {POST_WEIGHT}, score_epoch) FROM new_stories;
+    RETURN NULL;
+  END
+  $$ LANGUAGE plpgsql;
+
+  CREATE TRIGGER stories_insert_engagement AFTER INSERT ON stories
+    REFERENCING NEW TABLE AS new_stories FOR EACH STATEMENT EXECUTE FUNCTION stories_insert_engagement();
+""").execute_if(dialect='postgresql'))
@@ -2,4 +2,7 @@
 
 from flask_sqlalchemy import SQLAlchemy
 
-db = SQLAlchemy()
\ No newline at end of file
+from models.routing import RoutingSession
+
+# RoutingSession can send read-only queries to read replicas, see models/routing.py.
+db = SQLAlchemy(session_options={'class_': RoutingSession})
\ No newline at end of file
@@ -0,0 +1,147 @@
+"""This file contains the LinkMetadata model, what the background fetcher (services/link_metadata.py) found at each story URL."""
+
+from collections import namedtuple
+
+from sqlalchemy import DDL, event
+
+from models.init_db import db
+from models.hot_ranking import utc_now
+
+# SQL expression for the host name of a URL without "www.", e.g. "nytimes.com" for https://www.nytimes.com/..., '' if it has none.
+URL_DOMAIN = r"coalesce(regexp_replace(substring(url from '^[a-zA-Z][a-zA-Z0-9+.-]*://([^/:?#]+)'), '^www[.]', ''), '')"
+
+# A URL claimed for fetching, with its domain and the validators from its last fetch for a conditional request.
+ClaimedLink = namedtuple('ClaimedLink', ['url', 'domain', 'etag', 'last_modified', 'failures'])
+
+class LinkMetadata(db.Model):
+  """One row per distinct story URL, shared by every story linking to it. The database adds a row for each new URL when a story is
+  posted (see the trigger below), due to be fetched right away; the fetcher fills in the rest and sets when it's due again (expires_at).
+  Until then only domain is known. status_code is the last HTTP status, or None if the URL couldn't be fetched at all."""
+
+  __tablename__ = "link_metadata"
+  __table_args__ = (
+    # The fetcher's queue: each domain's URLs that are due, oldest first.
+    db.Index('ix_link_metadata_domain_expires_at', 'domain', 'expires_at'),
+  )
+
+  url = db.Column(db.Text, primary_key=True)
+  domain = db.Column(db.Text, nullable=False, server_default='')
+  status_code = db.Column(db.SmallInteger)
+  is_dead = db.Column(db.Boolean, nullable=False, default=False, server_default='false')
+  title = db.Column(db.Text)
+  description = db.Column(db.Text)
+  favicon_url = db.Column(db.Text)
+  # Validators from the last successful response, sent back with the next fetch so an unchanged page costs a 304 and no body.
+  etag = db.Column(db.Text)
+  last_modified = db.Column(db.Text)
+  fetched_at = db.Column(db.DateTime)
+  expires_at = db.Column(db.DateTime, nullable=False, default=utc_now)
+  # Fetches that failed in a row, and why the last one did.
+  failures = db.Column(db.SmallInteger, nullable=False, default=0, server_default='0')
+  error = db.Column(db.Text)
+
+  @classmethod
+  def claim_due(cls, limit, lease):
+    """Returns up to limit ClaimedLinks whose metadata is due: the oldest due URL of each domain that may be asked again (see
+    LinkDomain), domains asked least recently first. Pushes both the URLs' expires_at and their domains' next_request_at lease (a
+    timedelta) into the future, so that fetchers in other processes skip them meanwhile. Domains another transaction has locked are
+    skipped rather than waited for. The caller must commit, and release the domains once the URLs are fetched."""
+
+    now = utc_now()
+    due_url = (db.select(cls.url).where(cls.domain == LinkDomain.domain, cls.expires_at <= now).order_by(cls.expires_at).limit(1)
+               .lateral('due_url'))
+    due = db.session.execute(
+      db.select(LinkDomain.domain, due_url.c.url).join(due_url, db.true()).where(LinkDomain.next_request_at <= now)
+      .order_by(LinkDomain.next_request_at).limit(limit).with_for_update(of=LinkDomain, skip_locked=True)
+    ).all()
+    if not due:
+      return []
+
+    db.session.execute(db.update(LinkDomain).where(LinkDomain.domain.in_([domain for domain, url in due]))
+                       .values(next_request_at=now + lease))
+    claimed = db.session.execute(
+      db.update(cls).where(cls.url.in_([url for domain, url in due])).values(expires_at=now + lease)
+      .returning(cls.url, cls.domain, cls.etag, cls.last_modified, cls.failures)
+    )
+    return [ClaimedLink(*row) for row in claimed]
+
+  @classmethod
+  def store(cls, results):
+    """Saves fetch results, dictionaries of column values including url, with one bulk UPDATE by primary key. The caller must commit."""
+
+    if results:
+      db.session.execute(db.update(cls), results)
+
+# New story URLs (posted or edited) get a row, due immediately. When the table is created in an existing database, every story URL
+# already there gets one too.
+event.listen(LinkMetadata.__table__, 'after_create', DDL(f"""
+  CREATE OR REPLACE FUNCTION stories_insert_link_metadata() RETURNS trigger AS $$
+  BEGIN
+    INSERT INTO link_metadata (url, domain, expires_at)
+    SELECT DISTINCT url, {URL_DOMAIN}, now() AT TIME ZONE 'utc' FROM new_stories
+    ON CONFLICT (url) DO NOTHING;
+    RETURN NULL;
+  END
+  $$ LANGUAGE plpgsql;
+
+  CREATE OR REPLACE FUNCTION stories_update_link_metadata() RETURNS trigger AS $$
+  BEGIN
+    INSERT INTO link_metadata (url, domain, expires_at)
+    SELECT url, {URL_DOMAIN}, now() AT TIME ZONE 'utc' FROM (SELECT NEW.url AS url) AS new_story
+    ON CONFLICT (url) DO NOTHING;
+    RETURN NULL;
+  END
+  $$ LANGUAGE plpgsql;
+
+  CREATE TRIGGER stories_insert_link_metadata AFTER INSERT ON stories
+    REFERENCING NEW TABLE AS new_stories FOR EACH STATEMENT EXECUTE FUNCTION stories_insert_link_metadata();
+  -- Row level, so that the counter updates running on every favorite, bookmark and comment don't fire it.
+  CREATE TRIGGER stories_update_link_metadata AFTER UPDATE OF url ON stories
+    FOR EACH ROW WHEN (OLD.url IS DISTINCT FROM NEW.url) EXECUTE FUNCTION stories_update_link_metadata();
+
+  INSERT INTO link_metadata (url, domain, expires_at)
+  SELECT DISTINCT url, {URL_DOMAIN}, now() AT TIME ZONE 'utc' FROM stories
+  ON CONFLICT (url) DO NOTHING;
+""").execute_if(dialect='postgresql'))
+
+class LinkDomain(db.Model):
+  """One row per domain in link_metadata, which makes fetching polite across every process: a domain's URLs are only claimed one at a
+  time, and not again until next_request_at, which stays in the future while one of them is being fetched and is then set to the delay
+  between requests to a site (see LinkMetadata.claim_due and the fetcher)."""
+
+  __tablename__ = "link_domains"
+  __table_args__ = (
+    db.Index('ix_link_domains_next_request_at', 'next_request_at'),
+  )
+
+  domain = db.Column(db.Text, primary_key=True)
+  next_request_at = db.Column(db.DateTime, nullable=False, default=utc_now)
+
+  @classmethod
+  def release(cls, domains, delay):
+    """Lets the fetchers claim URLs from domains again once delay (a timedelta) has passed. The caller must commit."""
+
+    if domains:
+      db.session.execute(db.update(cls).where(cls.domain.in_(domains)).values(next_request_at=utc_now() + delay))
+
+# Every domain with a URL in link_metadata gets a row, including those of URLs already there when the table is created.
+event.listen(LinkDomain.__table__, 'after_create', DDL("""
+  CREATE OR REPLACE FUNCTION link_metadata_insert_link_domain() RETURNS trigger AS $$
+  BEGIN
+    INSERT INTO link_domains (domain, next_request_at)
+    SELECT DISTINCT domain, now() AT TIME ZONE 'utc' FROM new_links
+    ON CONFLICT (domain) DO NOTHING;
+    RETURN NULL;
+  END
+  $$ LANGUAGE plpgsql;
+
+  CREATE TRIGGER link_metadata_insert_link_domain AFTER INSERT ON link_metadata
+    REFERENCING NEW TABLE AS new_links FOR EACH STATEMENT EXECUTE FUNCTION link_metadata_insert_link_domain();
+
+  INSERT INTO link_domains (domain, next_request_at)
+  SELECT DISTINCT domain, now() AT TIME ZONE 'utc' FROM link_metadata
+  ON CONFLICT (domain) DO NOTHING;
+""").execute_if(dialect='postgresql'))
+
+# link_domains' trigger is on link_metadata, so create_all has to create link_metadata first.
+LinkDomain.__table__.add_is_dependent_on(LinkMetadata.__table__)
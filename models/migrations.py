@@ -0,0 +1,478 @@
+"""Versioned migrations of the primary database's schema. `flask --app wsgi migrate` (and, outside production, connect_db) brings a
+database up to date:
+
+- An empty database gets the models' current schema straight from create_all, with the functions and triggers the models attach to
+  their tables, and is recorded as having every migration applied.
+- Any other database gets each migration in MIGRATIONS that isn't in its schema_migrations table yet, in order, and records it there.
+  A database from before there were migrations (no schema_migrations table) starts at the first one.
+
+Migrations are written out in SQL rather than generated from the models, so each keeps doing what it did when it was written however
+the models change later; only tuning constants, like the hot ranking weights, are shared with the models. Adding a column, index,
+table or trigger to a model therefore needs a new migration at the end of MIGRATIONS that does the same to existing databases
+(tests/test_migrations.py checks that a migrated database ends up with the same schema as a new one).
+
+All pending migrations run in one transaction, so a failed upgrade leaves the database as it was. Adding columns and indexes locks
+their table meanwhile, which on a big table means running the migration when the site is quiet."""
+
+from collections import namedtuple
+
+from sqlalchemy import DDL, text
+
+from models.init_db import db
+from models.hot_ranking import BOOKMARK_WEIGHT, COMMENT_WEIGHT, DECAY_RATE, FAVORITE_WEIGHT, HOT_SCORE_LOCK_KEY, POST_WEIGHT
+from models.link_metadata import URL_DOMAIN
+from models.profile_picture import PICTURE_PENDING
+from models.story import SEARCH_VECTOR
+# create_all only creates the tables of the models that have been imported.
+from models import bookmark, comment, favorite, rate_limit, user
+
+# One schema change. upgrade(connection) applies it, within the migration's transaction.
+Migration = namedtuple('Migration', ['version', 'name', 'upgrade'])
+
+# Advisory lock held while migrating, so that app servers booting at the same time migrate one after the other.
+MIGRATION_LOCK_KEY = 0x536368656d61
+
+def migrate():
+  """Applies the migrations the primary database doesn't have yet, and returns them."""
+
+  with db.engines[None].begin() as connection:
+    return apply_migrations(connection)
+
+def apply_migrations(connection):
+  """Brings the database connection is connected to up to date (see the top of this file), within connection's transaction. Tables are
+  looked up on connection's search_path. Returns the migrations that were applied."""
+
+  connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': MIGRATION_LOCK_KEY})
+  is_empty = not table_exists(connection, 'schema_migrations') and not table_exists(connection, 'users')
+  connection.execute(DDL("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+      version integer PRIMARY KEY,
+      name text NOT NULL,
+      applied_at timestamp NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
+    )
+  """))
+
+  if is_empty:
+    db.metadatas[None].create_all(connection)
+    pending = MIGRATIONS
+  else:
+    applied = set(connection.execute(text("SELECT version FROM schema_migrations")).scalars())
+    pending = [migration for migration in MIGRATIONS if migration.version not in applied]
+    for migration in pending:
+      migration.upgrade(connection)
+
+  for migration in pending:
+    connection.execute(text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                       {'version': migration.version, 'name': migration.name})
+  return pending
+
+def table_exists(connection, table_name):
+  return connection.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {'name': table_name}).scalar()
+
+def upgrade_original_schema(connection):
+  """From the original schema (users, stories, comments, favorites and bookmarks only) to the one of the first release with migrations:
+  stories get engagement counters and a search vector, comments are threaded, and the hot ranking, link metadata, profile picture and
+  rate limiting tables are added, with the functions and triggers that maintain them and everything they derive from existing rows.
+
+  Databases set up by that release's create-tables have some or all of this already, so every step is written to be skipped or
+  repeated harmlessly."""
+
+  connection.execute(DDL(f"""
+    CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+    ALTER TABLE stories
+      ADD COLUMN IF NOT EXISTS favorite_count integer NOT NULL DEFAULT 0,
+      ADD COLUMN IF NOT EXISTS bookmark_count integer NOT NULL DEFAULT 0,
+      ADD COLUMN IF NOT EXISTS comment_count integer NOT NULL DEFAULT 0,
+      ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ({SEARCH_VECTOR}) STORED;
+    -- The feed's keyset pagination needs every story to have a creation time.
+    UPDATE stories SET created_at = coalesce(updated_at, now() AT TIME ZONE 'utc') WHERE created_at IS NULL;
+    ALTER TABLE stories ALTER COLUMN created_at SET NOT NULL;
+  """))
+
+  # Comments were keyed by (id, user_id, story_id); replies need a foreign key to id alone.
+  primary_key = connection.execute(text("""
+    SELECT array_agg(attname::text ORDER BY attname) FROM pg_index JOIN pg_attribute ON attrelid = indrelid AND attnum = ANY(indkey)
+    WHERE indrelid = 'comments'::regclass AND indisprimary
+  """)).scalar()
+  if primary_key != ['id']:
+    connection.execute(DDL("""
+      ALTER TABLE comments ALTER COLUMN user_id SET NOT NULL, ALTER COLUMN story_id SET NOT NULL,
+        DROP CONSTRAINT comments_pkey, ADD CONSTRAINT comments_pkey PRIMARY KEY (id)
+    """))
+
+  connection.execute(DDL("""
+    ALTER TABLE comments
+      ADD COLUMN IF NOT EXISTS parent_id integer REFERENCES comments (id) ON DELETE CASCADE,
+      ADD COLUMN IF NOT EXISTS path integer[] NOT NULL DEFAULT '{}',
+      ADD COLUMN IF NOT EXISTS depth smallint NOT NULL DEFAULT 0,
+      ADD COLUMN IF NOT EXISTS descendant_count integer NOT NULL DEFAULT 0;
+    -- Comments from before threading are all top-level, so each one's path is just its id.
+    UPDATE comments SET path = ARRAY[id], depth = 0 WHERE path = '{}';
+
+    CREATE TABLE IF NOT EXISTS hot_ranking_epoch (
+      id serial PRIMARY KEY,
+      epoch timestamp NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS story_hot_scores (
+      story_id integer PRIMARY KEY REFERENCES stories (id) ON DELETE CASCADE,
+      score double precision NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS link_metadata (
+      url text PRIMARY KEY,
+      domain text NOT NULL DEFAULT '',
+      status_code smallint,
+      is_dead boolean NOT NULL DEFAULT false,
+      title text,
+      description text,
+      favicon_url text,
+      etag text,
+      last_modified text,
+      fetched_at timestamp,
+      expires_at timestamp NOT NULL,
+      failures smallint NOT NULL DEFAULT 0,
+      error text
+    );
+    CREATE TABLE IF NOT EXISTS link_domains (
+      domain text PRIMARY KEY,
+      next_request_at timestamp NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS profile_pictures (
+      source_url text PRIMARY KEY,
+      status text NOT NULL DEFAULT 'pending',
+      thumbnail_hash text,
+      width smallint,
+      height smallint,
+      source_content_type text,
+      source_bytes integer,
+      attempts smallint NOT NULL DEFAULT 0,
+      error text,
+      next_attempt_at timestamp NOT NULL,
+      processed_at timestamp
+    );
+    CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+      key text PRIMARY KEY,
+      tokens double precision NOT NULL,
+      updated_at double precision NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS ix_stories_created_at_id ON stories (created_at, id);
+    CREATE INDEX IF NOT EXISTS ix_stories_user_id_created_at_id ON stories (user_id, created_at, id);
+    CREATE INDEX IF NOT EXISTS ix_stories_search_vector ON stories USING gin (search_vector);
+    CREATE INDEX IF NOT EXISTS ix_stories_title_trgm ON stories USING gist (title gist_trgm_ops);
+    CREATE INDEX IF NOT EXISTS ix_comments_story_id_path ON comments (story_id, path);
+    CREATE INDEX IF NOT EXISTS ix_comments_story_id_top_level ON comments (story_id, id) WHERE parent_id IS NULL;
+    CREATE INDEX IF NOT EXISTS ix_comments_user_id_id ON comments (user_id, id);
+    CREATE INDEX IF NOT EXISTS ix_story_hot_scores_score_story_id ON story_hot_scores (score, story_id);
+    CREATE INDEX IF NOT EXISTS ix_link_metadata_domain_expires_at ON link_metadata (domain, expires_at);
+    CREATE INDEX IF NOT EXISTS ix_link_domains_next_request_at ON link_domains (next_request_at);
+  """))
+  connection.execute(DDL(f"""
+    CREATE INDEX IF NOT EXISTS ix_profile_pictures_pending ON profile_pictures (next_attempt_at) WHERE status = '{PICTURE_PENDING}';
+  """))
+
+  # Hot ranking (models/hot_ranking.py).
+  connection.execute(DDL(f"""
+    INSERT INTO hot_ranking_epoch (id, epoch) VALUES (1, now() AT TIME ZONE 'utc') ON CONFLICT (id) DO NOTHING;
+
+    CREATE OR REPLACE FUNCTION hot_score_change(event_time timestamp, weight double precision, score_epoch timestamp)
+    RETURNS double precision AS $$
+      SELECT weight * exp({DECAY_RATE!r} * extract(epoch FROM coalesce(event_time, now() AT TIME ZONE 'utc') - score_epoch)::double precision)
+    $$ LANGUAGE sql STABLE;
+
+    CREATE OR REPLACE FUNCTION lock_hot_score_epoch() RETURNS timestamp AS $$
+    BEGIN
+      PERFORM pg_advisory_xact_lock_shared({HOT_SCORE_LOCK_KEY});
+      RETURN (SELECT epoch FROM hot_ranking_epoch);
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION stories_insert_hot_scores() RETURNS trigger AS $$
+    DECLARE
+      score_epoch timestamp := lock_hot_score_epoch();
+    BEGIN
+      INSERT INTO story_hot_scores (story_id, score)
+      SELECT id, hot_score_change(created_at, {POST_WEIGHT}, score_epoch) FROM new_stories;
+      RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE TRIGGER stories_insert_hot_scores AFTER INSERT ON stories
+      REFERENCING NEW TABLE AS new_stories FOR EACH STATEMENT EXECUTE FUNCTION stories_insert_hot_scores();
+  """))
+
+  # Engagement counters and hot scores (models/counter_cache.py).
+  for table_name, counter_column, weight in [('favorites', 'favorite_count', FAVORITE_WEIGHT),
+                                             ('bookmarks', 'bookmark_count', BOOKMARK_WEIGHT),
+                                             ('comments', 'comment_count', COMMENT_WEIGHT)]:
+    function_name = f"{table_name}_update_stories_{counter_column}"
+    connection.execute(DDL(f"""
+      CREATE OR REPLACE FUNCTION {function_name}() RETURNS trigger AS $$
+      DECLARE
+        direction integer := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+        score_epoch timestamp := lock_hot_score_epoch();
+      BEGIN
+        UPDATE stories SET {counter_column} = {counter_column} + direction * changed.row_count
+        FROM (SELECT story_id, count(*) AS row_count FROM changed_rows GROUP BY story_id) AS changed
+        WHERE stories.id = changed.story_id;
+
+        UPDATE story_hot_scores SET score = greatest(score + direction * changed.score_change, 0)
+        FROM (
+          SELECT story_id, sum(hot_score_change(created_at, {weight}, score_epoch)) AS score_change
+          FROM changed_rows GROUP BY story_id
+        ) AS changed
+        WHERE story_hot_scores.story_id = changed.story_id;
+        RETURN NULL;
+      END
+      $$ LANGUAGE plpgsql;
+
+      CREATE OR REPLACE TRIGGER {table_name}_count_inserts AFTER INSERT ON {table_name}
+        REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION {function_name}();
+      CREATE OR REPLACE TRIGGER {table_name}_count_deletes AFTER DELETE ON {table_name}
+        REFERENCING OLD TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION {function_name}();
+
+      -- One grouped count of the whole table, rather than a count per story (story_id alone isn't indexed), and only the stories whose
+      -- count is wrong are rewritten.
+      UPDATE stories SET {counter_column} = counted.row_count
+      FROM (
+        SELECT stories.id, count({table_name}.story_id) AS row_count
+        FROM stories LEFT JOIN {table_name} ON {table_name}.story_id = stories.id GROUP BY stories.id
+      ) AS counted
+      WHERE stories.id = counted.id AND stories.{counter_column} <> counted.row_count;
+    """))
+
+  # Threaded comments (models/comment.py).
+  connection.execute(DDL("""
+    CREATE OR REPLACE FUNCTION comments_set_path() RETURNS trigger AS $$
+    DECLARE
+      parent comments%%ROWTYPE;
+    BEGIN
+      IF NEW.parent_id IS NULL THEN
+        NEW.path := ARRAY[NEW.id];
+      ELSE
+        SELECT * INTO parent FROM comments WHERE id = NEW.parent_id;
+        IF NOT FOUND OR parent.story_id <> NEW.story_id THEN
+          RAISE foreign_key_violation USING MESSAGE = format('comment %%s is not a comment on story %%s', NEW.parent_id, NEW.story_id);
+        END IF;
+        NEW.path := parent.path || NEW.id;
+      END IF;
+      NEW.depth := cardinality(NEW.path) - 1;
+      NEW.descendant_count := 0;
+      RETURN NEW;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION comments_update_descendant_counts() RETURNS trigger AS $$
+    DECLARE
+      direction integer := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+    BEGIN
+      UPDATE comments SET descendant_count = descendant_count + direction * changed.descendants
+      FROM (
+        SELECT ancestor_id, count(*) AS descendants
+        FROM changed_rows, unnest(changed_rows.path[1:cardinality(changed_rows.path) - 1]) AS ancestor_id
+        GROUP BY ancestor_id
+      ) AS changed
+      WHERE comments.id = changed.ancestor_id;
+      RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE TRIGGER comments_set_path BEFORE INSERT ON comments
+      FOR EACH ROW EXECUTE FUNCTION comments_set_path();
+    CREATE OR REPLACE TRIGGER comments_count_descendant_inserts AFTER INSERT ON comments
+      REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION comments_update_descendant_counts();
+    CREATE OR REPLACE TRIGGER comments_count_descendant_deletes AFTER DELETE ON comments
+      REFERENCING OLD TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION comments_update_descendant_counts();
+  """))
+
+  # Every story's hot score from scratch, relative to a new epoch (as models.hot_ranking.recompute_hot_scores does).
+  connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': HOT_SCORE_LOCK_KEY})
+  connection.execute(text(f"""
+    UPDATE hot_ranking_epoch SET epoch = now() AT TIME ZONE 'utc';
+    INSERT INTO story_hot_scores (story_id, score)
+    SELECT stories.id, hot_score_change(stories.created_at, {POST_WEIGHT}, epoch) + coalesce(engagement.score, 0)
+    FROM hot_ranking_epoch, stories LEFT JOIN (
+      SELECT story_id, sum(score) AS score FROM (
+        SELECT story_id, hot_score_change(favorites.created_at, {FAVORITE_WEIGHT}, epoch) AS score FROM favorites, hot_ranking_epoch
+        UNION ALL SELECT story_id, hot_score_change(bookmarks.created_at, {BOOKMARK_WEIGHT}, epoch) FROM bookmarks, hot_ranking_epoch
+        UNION ALL SELECT story_id, hot_score_change(comments.created_at, {COMMENT_WEIGHT}, epoch) FROM comments, hot_ranking_epoch
+      ) AS events GROUP BY story_id
+    ) AS engagement ON engagement.story_id = stories.id
+    ON CONFLICT (story_id) DO UPDATE SET score = excluded.score
+  """))
+
+  # Link metadata (models/link_metadata.py), queued for every story URL and domain already there.
+  connection.execute(DDL(f"""
+    CREATE OR REPLACE FUNCTION stories_insert_link_metadata() RETURNS trigger AS $$
+    BEGIN
+      INSERT INTO link_metadata (url, domain, expires_at)
+      SELECT DISTINCT url, {URL_DOMAIN}, now() AT TIME ZONE 'utc' FROM new_stories
+      ON CONFLICT (url) DO NOTHING;
+      RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION stories_update_link_metadata() RETURNS trigger AS $$
+    BEGIN
+      INSERT INTO link_metadata (url, domain, expires_at)
+      SELECT url, {URL_DOMAIN}, now() AT TIME ZONE 'utc' FROM (SELECT NEW.url AS url) AS new_story
+      ON CONFLICT (url) DO NOTHING;
+      RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION link_metadata_insert_link_domain() RETURNS trigger AS $$
+    BEGIN
+      INSERT INTO link_domains (domain, next_request_at)
+      SELECT DISTINCT domain, now() AT TIME ZONE 'utc' FROM new_links
+      ON CONFLICT (domain) DO NOTHING;
+      RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE TRIGGER stories_insert_link_metadata AFTER INSERT ON stories
+      REFERENCING NEW TABLE AS new_stories FOR EACH STATEMENT EXECUTE FUNCTION stories_insert_link_metadata();
+    CREATE OR REPLACE TRIGGER stories_update_link_metadata AFTER UPDATE OF url ON stories
+      FOR EACH ROW WHEN (OLD.url IS DISTINCT FROM NEW.url) EXECUTE FUNCTION stories_update_link_metadata();
+    CREATE OR REPLACE TRIGGER link_metadata_insert_link_domain AFTER INSERT ON link_metadata
+      REFERENCING NEW TABLE AS new_links FOR EACH STATEMENT EXECUTE FUNCTION link_metadata_insert_link_domain();
+
+    INSERT INTO link_metadata (url, domain, expires_at)
+    SELECT DISTINCT url, {URL_DOMAIN}, now() AT TIME ZONE 'utc' FROM stories
+    ON CONFLICT (url) DO NOTHING;
+    INSERT INTO link_domains (domain, next_request_at)
+    SELECT DISTINCT domain, now() AT TIME ZONE 'utc' FROM link_metadata
+    ON CONFLICT (domain) DO NOTHING;
+  """))
+
+  # Profile picture thumbnails (models/profile_picture.py), queued for every user's remote picture already there.
+  connection.execute(DDL("""
+    CREATE OR REPLACE FUNCTION users_insert_profile_picture() RETURNS trigger AS $$
+    BEGIN
+      INSERT INTO profile_pictures (source_url, next_attempt_at)
+      SELECT DISTINCT profile_picture_url, now() AT TIME ZONE 'utc' FROM new_users WHERE profile_picture_url ~* '^https?://'
+      ON CONFLICT (source_url) DO NOTHING;
+      RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION users_update_profile_picture() RETURNS trigger AS $$
+    BEGIN
+      INSERT INTO profile_pictures (source_url, next_attempt_at)
+      SELECT NEW.profile_picture_url, now() AT TIME ZONE 'utc' WHERE NEW.profile_picture_url ~* '^https?://'
+      ON CONFLICT (source_url) DO NOTHING;
+      RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE TRIGGER users_insert_profile_picture AFTER INSERT ON users
+      REFERENCING NEW TABLE AS new_users FOR EACH STATEMENT EXECUTE FUNCTION users_insert_profile_picture();
+    CREATE OR REPLACE TRIGGER users_update_profile_picture AFTER UPDATE OF profile_picture_url ON users
+      FOR EACH ROW WHEN (OLD.profile_picture_url IS DISTINCT FROM NEW.profile_picture_url) EXECUTE FUNCTION users_update_profile_picture();
+
+    INSERT INTO profile_pictures (source_url, next_attempt_at)
+    SELECT DISTINCT profile_picture_url, now() AT TIME ZONE 'utc' FROM users WHERE profile_picture_url ~* '^https?://'
+    ON CONFLICT (source_url) DO NOTHING;
+  """))
+
+  # Rate limiting (models/rate_limit.py).
+  connection.execute(DDL("""
+    CREATE OR REPLACE FUNCTION rate_limit_consume(bucket_key text, refill_rate double precision, capacity double precision,
+                                                  cost double precision, OUT allowed boolean, OUT retry_after double precision) AS $$
+    DECLARE
+      now_seconds double precision := extract(epoch FROM clock_timestamp());
+      available double precision;
+    BEGIN
+      INSERT INTO rate_limit_buckets AS bucket (key, tokens, updated_at) VALUES (bucket_key, capacity, now_seconds)
+      ON CONFLICT (key) DO UPDATE
+        SET tokens = least(capacity, bucket.tokens + greatest(0, now_seconds - bucket.updated_at) * refill_rate),
+            updated_at = greatest(bucket.updated_at, now_seconds)
+      RETURNING tokens INTO available;
+
+      allowed := available >= cost;
+      IF allowed THEN
+        UPDATE rate_limit_buckets SET tokens = available - cost WHERE key = bucket_key;
+        retry_after := 0;
+      ELSE
+        retry_after := (cost - available) / refill_rate;
+      END IF;
+    END
+    $$ LANGUAGE plpgsql;
+  """))
+
+def move_engagement_to_story_engagement(connection):
+  """Moves the stories' engagement counters and the story_hot_scores table into one narrow story_engagement table, so a favorite,
+  bookmark or comment updates one small row instead of both the wide story row and its hot score row. The favorites, bookmarks and
+  comments are locked against writes meanwhile so no change is counted in the old place after it was copied."""
+
+  connection.execute(DDL(f"""
+    LOCK TABLE favorites, bookmarks, comments IN SHARE MODE;
+    SELECT pg_advisory_xact_lock({HOT_SCORE_LOCK_KEY});
+
+    CREATE TABLE story_engagement (
+      story_id integer PRIMARY KEY REFERENCES stories (id) ON DELETE CASCADE,
+      favorite_count integer NOT NULL DEFAULT 0,
+      bookmark_count integer NOT NULL DEFAULT 0,
+      comment_count integer NOT NULL DEFAULT 0,
+      hot_score double precision NOT NULL
+    );
+    INSERT INTO story_engagement (story_id, favorite_count, bookmark_count, comment_count, hot_score)
+    SELECT stories.id, favorite_count, bookmark_count, comment_count, coalesce(story_hot_scores.score, 0)
+    FROM stories LEFT JOIN story_hot_scores ON story_hot_scores.story_id = stories.id;
+    CREATE INDEX ix_story_engagement_hot_score_story_id ON story_engagement (hot_score, story_id);
+
+    CREATE FUNCTION stories_insert_engagement() RETURNS trigger AS $$
+    DECLARE
+      score_epoch timestamp := lock_hot_score_epoch();
+    BEGIN
+      INSERT INTO story_engagement (story_id, hot_score)
+      SELECT id, hot_score_change(created_at, {POST_WEIGHT}, score_epoch) FROM new_stories;
+      RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+
+    CREATE TRIGGER stories_insert_engagement AFTER INSERT ON stories
+      REFERENCING NEW TABLE AS new_stories FOR EACH STATEMENT EXECUTE FUNCTION stories_insert_engagement();
+    DROP TRIGGER stories_insert_hot_scores ON stories;
+    DROP FUNCTION stories_insert_hot_scores();
+  """))
+
+  for table_name, counter_column, weight in [('favorites', 'favorite_count', FAVORITE_WEIGHT),
+                                             ('bookmarks', 'bookmark_count', BOOKMARK_WEIGHT),
+                                             ('comments', 'comment_count', COMMENT_WEIGHT)]:
+    function_name = f"{table_name}_update_story_engagement"
+    connection.execute(DDL(f"""
+      CREATE FUNCTION {function_name}() RETURNS trigger AS $$
+      DECLARE
+        direction integer := CASE WHEN TG_OP = 'INSERT' THEN 1 ELSE -1 END;
+        score_epoch timestamp := lock_hot_score_epoch();
+      BEGIN
+        UPDATE story_engagement
+        SET {counter_column} = {counter_column} + direction * changed.row_count,
+            hot_score = greatest(hot_score + direction * changed.score_change, 0)
+        FROM (
+          SELECT story_id, count(*) AS row_count, sum(hot_score_change(created_at, {weight}, score_epoch)) AS score_change
+          FROM changed_rows GROUP BY story_id
+        ) AS changed
+        WHERE story_engagement.story_id = changed.story_id;
+        RETURN NULL;
+      END
+      $$ LANGUAGE plpgsql;
+
+      CREATE OR REPLACE TRIGGER {table_name}_count_inserts AFTER INSERT ON {table_name}
+        REFERENCING NEW TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION {function_name}();
+      CREATE OR REPLACE TRIGGER {table_name}_count_deletes AFTER DELETE ON {table_name}
+        REFERENCING OLD TABLE AS changed_rows FOR EACH STATEMENT EXECUTE FUNCTION {function_name}();
+      DROP FUNCTION {table_name}_update_stories_{counter_column}();
+    """))
+
+  connection.execute(DDL("""
+    DROP TABLE story_hot_scores;
+    ALTER TABLE stories DROP COLUMN favorite_count, DROP COLUMN bookmark_count, DROP COLUMN comment_count;
+  """))
+
+# In the order they're applied. Never edit or remove one that has been released; add a new one instead.
+MIGRATIONS = [
+  Migration(1, 'upgrade the original schema', upgrade_original_schema),
+  Migration(2, 'move engagement counters and hot scores to story_engagement', move_engagement_to_story_engagement),
+]
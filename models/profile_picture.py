@@ -0,0 +1,93 @@
+"""This file contains the ProfilePicture model, the local thumbnail made from each remote profile picture URL
+(see services/profile_pictures.py)."""
+
+from collections import namedtuple
+
+from sqlalchemy import DDL, event
+
+from models.init_db import db
+from models.hot_ranking import utc_now
+
+PICTURE_PENDING = 'pending'
+PICTURE_READY = 'ready'
+PICTURE_INVALID = 'invalid'
+
+# A source URL claimed for processing, with the number of attempts made so far.
+ClaimedPicture = namedtuple('ClaimedPicture', ['source_url', 'attempts'])
+
+class ProfilePicture(db.Model):
+  """One row per distinct remote profile picture URL, shared by every user who gave it. The database adds a pending row for each new
+  http(s) URL when a user signs up or changes their picture (see the trigger below). The processor then fetches it once and sets status
+  to ready, with the content hash of the thumbnail it stored, or to invalid (not an image, too large, unreachable...), with why in error.
+  Pages show the thumbnail once it's ready and the default picture otherwise; they never load the source URL."""
+
+  __tablename__ = "profile_pictures"
+  __table_args__ = (
+    # The processor's queue: pending pictures that are due, oldest first.
+    db.Index('ix_profile_pictures_pending', 'next_attempt_at', postgresql_where=db.text(f"status = '{PICTURE_PENDING}'")),
+  )
+
+  source_url = db.Column(db.Text, primary_key=True)
+  status = db.Column(db.Text, nullable=False, default=PICTURE_PENDING, server_default=PICTURE_PENDING)
+  # SHA-256 of the thumbnail file, which is also its name, so identical images fetched from different URLs share one file.
+  thumbnail_hash = db.Column(db.Text)
+  width = db.Column(db.SmallInteger)
+  height = db.Column(db.SmallInteger)
+  source_content_type = db.Column(db.Text)
+  source_bytes = db.Column(db.Integer)
+  attempts = db.Column(db.SmallInteger, nullable=False, default=0, server_default='0')
+  error = db.Column(db.Text)
+  next_attempt_at = db.Column(db.DateTime, nullable=False, default=utc_now)
+  processed_at = db.Column(db.DateTime)
+
+  @classmethod
+  def claim_due(cls, limit, lease):
+    """Returns up to limit ClaimedPictures that are pending and due, and pushes their next_attempt_at lease (a timedelta) into the future
+    so that processors in other processes skip them meanwhile. The caller must commit."""
+
+    due = (db.select(cls.source_url).where(cls.status == PICTURE_PENDING, cls.next_attempt_at <= utc_now())
+           .order_by(cls.next_attempt_at).limit(limit).with_for_update(skip_locked=True).cte('due'))
+    claimed = db.session.execute(
+      db.update(cls).where(cls.source_url == due.c.source_url).values(next_attempt_at=utc_now() + lease)
+      .returning(cls.source_url, cls.attempts)
+    )
+    return [ClaimedPicture(*row) for row in claimed]
+
+  @classmethod
+  def store(cls, results):
+    """Saves processing results, dictionaries of column values including source_url, with one bulk UPDATE by primary key. The caller
+    must commit."""
+
+    if results:
+      db.session.execute(db.update(cls), results)
+
+# New remote profile picture URLs (at signup or changed later) get a pending row. Local ones, like the default picture, don't. When the
+# table is created in an existing database, the remote pictures of existing users are queued too.
+event.listen(ProfilePicture.__table__, 'after_create', DDL("""
+  CREATE OR REPLACE FUNCTION users_insert_profile_picture() RETURNS trigger AS $$
+  BEGIN
+    INSERT INTO profile_pictures (source_url, next_attempt_at)
+    SELECT DISTINCT profile_picture_url, now() AT TIME ZONE 'utc' FROM new_users WHERE profile_picture_url ~* '^https?://'
+    ON CONFLICT (source_url) DO NOTHING;
+    RETURN NULL;
+  END
+  $$ LANGUAGE plpgsql;
+
+  CREATE OR REPLACE FUNCTION users_update_profile_picture() RETURNS trigger AS $$
+  BEGIN
+    INSERT INTO profile_pictures (source_url, next_attempt_at)
+    SELECT NEW.profile_picture_url, now() AT TIME ZONE 'utc' WHERE NEW.profile_picture_url ~* '^https?://'
+    ON CONFLICT (source_url) DO NOTHING;
+    RETURN NULL;
+  END
+  $$ LANGUAGE plpgsql;
+
+  CREATE TRIGGER users_insert_profile_picture AFTER INSERT ON users
+    REFERENCING NEW TABLE AS new_users FOR EACH STATEMENT EXECUTE FUNCTION users_insert_profile_picture();
+  CREATE TRIGGER users_update_profile_picture AFTER UPDATE OF profile_picture_url ON users
+    FOR EACH ROW WHEN (OLD.profile_picture_url IS DISTINCT FROM NEW.profile_picture_url) EXECUTE FUNCTION users_update_profile_picture();
+
+  INSERT INTO profile_pictures (source_url, next_attempt_at)
+  SELECT DISTINCT profile_picture_url, now() AT TIME ZONE 'utc' FROM users WHERE profile_picture_url ~* '^https?://'
+  ON CONFLICT (source_url) DO NOTHING;
+""").execute_if(dialect='postgresql'))
@@ -0,0 +1,43 @@
+"""This file contains the table behind the shared rate limiting backend (services/rate_limiting.py)."""
+
+from sqlalchemy import DDL, event
+
+from models.init_db import db
+
+class RateLimitBucket(db.Model):
+  """One token bucket, e.g. the login attempts of one IP address. tokens is how many were left at updated_at (seconds since the epoch,
+  by the database's clock so every app server agrees); the bucket has refilled since then. The table is UNLOGGED: it's written on every
+  rate limited request, and losing it in a database crash only forgives everyone's recent attempts."""
+
+  __tablename__ = "rate_limit_buckets"
+  __table_args__ = {'prefixes': ['UNLOGGED']}
+
+  key = db.Column(db.Text, primary_key=True)
+  tokens = db.Column(db.Float, nullable=False)
+  updated_at = db.Column(db.Float, nullable=False)
+
+# Refills and takes cost tokens from a bucket in one round trip. The upsert locks the bucket's row, so concurrent requests for the same
+# key queue up instead of both spending the last token. Returns whether the tokens were taken, and if not, the seconds until they would be.
+event.listen(RateLimitBucket.__table__, 'after_create', DDL("""
+  CREATE OR REPLACE FUNCTION rate_limit_consume(bucket_key text, refill_rate double precision, capacity double precision,
+                                                cost double precision, OUT allowed boolean, OUT retry_after double precision) AS $$
+  DECLARE
+    now_seconds double precision := extract(epoch FROM clock_timestamp());
+    available double precision;
+  BEGIN
+    INSERT INTO rate_limit_buckets AS bucket (key, tokens, updated_at) VALUES (bucket_key, capacity, now_seconds)
+    ON CONFLICT (key) DO UPDATE
+      SET tokens = least(capacity, bucket.tokens + greatest(0, now_seconds - bucket.updated_at) * refill_rate),
+          updated_at = greatest(bucket.updated_at, now_seconds)
+    RETURNING tokens INTO available;
+
+    allowed := available >= cost;
+    IF allowed THEN
+      UPDATE rate_limit_buckets SET tokens = available - cost WHERE key = bucket_key;
+      retry_after := 0;
+    ELSE
+      retry_after := (cost - available) / refill_rate;
+    END IF;
+  END
+  $$ LANGUAGE plpgsql;
+""").execute_if(dialect='postgresql'))
@@ -0,0 +1,75 @@
+"""Routes read-only queries to read replicas of the database. Replicas are configured with the DATABASE_REPLICA_URLS config (see
+connect_db in models/connect.py) and only used inside a read_from_replica() block (also in models/connect.py), which views and models wrap around queries that are
+safe to run on a slightly out of date copy of the data, such as the story feed or looking up a user logging in. Everything else,
+including every write, goes to the primary database.
+
+To make sure users always see their own writes, a session stops using replicas as soon as it writes anything, and the user's Flask
+session remembers to read from the primary for DATABASE_REPLICA_STICKY_SECONDS after a commit, so the page they are redirected to after
+e.g. signing up doesn't come from a replica that hasn't caught up yet."""
+
+import random
+import time
+
+from flask import current_app, has_request_context, session as flask_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import Select, event
+
+# Key in the Flask session holding the time until which this user's reads must go to the primary.
+READ_PRIMARY_UNTIL = "db_read_primary_until"
+
+# Bind keys of replicas in SQLALCHEMY_BINDS start with this prefix.
+REPLICA_BIND_PREFIX = "replica_"
+
+class RoutingSession(Session):
+  """db.session's class. Sends SELECTs made inside read_from_replica() to one of the replicas, chosen once per session so that all of a
+  request's replica reads see the same snapshot of the data."""
+
+  def __init__(self, db, **kwargs):
+    super().__init__(db, **kwargs)
+    self.replica_depth = 0
+    self.has_written = False
+    self.replica_key = None
+
+  def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+    if bind is None and self.should_read_from_replica(clause):
+      return self._db.engines[self.replica_key]
+    return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+  def should_read_from_replica(self, clause):
+    if not self.replica_depth or self.has_written or self._flushing:
+      return False
+    # Only plain SELECTs; SELECT ... FOR UPDATE and raw SQL text might write or lock rows.
+    if not isinstance(clause, Select) or clause._for_update_arg is not None:
+      return False
+    if has_request_context() and flask_session.get(READ_PRIMARY_UNTIL, 0) > time.time():
+      return False
+
+    if self.replica_key is None:
+      replica_keys = self.replica_keys()
+      if not replica_keys:
+        return False
+      self.replica_key = random.choice(replica_keys)
+    return True
+
+  def replica_keys(self):
+    return [key for key in self._db.engines if key and key.startswith(REPLICA_BIND_PREFIX)]
+
+@event.listens_for(RoutingSession, 'after_flush')
+def stop_reading_from_replicas(session, flush_context):
+  """Once a session has written something, all its reads go to the primary, which is the only database guaranteed to have the write."""
+  session.has_written = True
+
+@event.listens_for(RoutingSession, 'do_orm_execute')
+def stop_reading_from_replicas_on_write(orm_execute_state):
+  """Statements executed directly rather than through a flush (bulk INSERT/UPDATE/DELETE, raw SQL, and SELECTs whose CTEs write, which
+  must be run with execution_options={'writes': True}) write to the primary too, so they have the same effect as a flush."""
+
+  if not orm_execute_state.is_select or orm_execute_state.execution_options.get('writes'):
+    orm_execute_state.session.has_written = True
+
+@event.listens_for(RoutingSession, 'after_commit')
+def stick_to_primary_after_commit(session):
+  """Keeps sending this user's reads to the primary for a while after they committed a write, until the replicas have caught up."""
+
+  if session.has_written and session.replica_keys() and has_request_context():
+    flask_session[READ_PRIMARY_UNTIL] = time.time() + current_app.config.get('DATABASE_REPLICA_STICKY_SECONDS', 10)
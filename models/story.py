@@ -1,23 +1,238 @@
 """This file contains the Story model."""
 
+import base64
+from collections import namedtuple
+
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import configure_mappers, contains_eager, deferred, foreign, joinedload
+
 from models.init_db import db
+from models.favorite import Favorite
+from models.bookmark import Bookmark
+from models.comment import Comment
+from models.story_engagement import StoryEngagement
+from models.link_metadata import LinkMetadata, URL_DOMAIN
 from datetime import datetime, timezone
 
+# A page of the story feed. next_cursor is None on the last page, otherwise pass it back to get_feed to get the next page.
+FeedPage = namedtuple('FeedPage', ['stories', 'next_cursor'])
+
+# A page of search results. has_next_page tells whether there is a page after this one.
+SearchPage = namedtuple('SearchPage', ['stories', 'page', 'has_next_page'])
+
+# Search results are only paginated this deep; nobody reads page 51 of search results, and deep OFFSETs get slow.
+MAX_SEARCH_PAGES = 50
+
+# The story's searchable text: the title weighted highest, then the author, then the words of the URL's domain (e.g. "nytimes com" for
+# https://www.nytimes.com/...). Computed by PostgreSQL whenever a story is inserted or updated.
+SEARCH_VECTOR = (
+  "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+  "setweight(to_tsvector('english', coalesce(author, '')), 'B') || "
+  f"setweight(to_tsvector('english', replace({URL_DOMAIN}, '.', ' ')), 'C')"
+)
+
+class InvalidCursor(ValueError):
+  """Raised when a feed cursor token can't be decoded, e.g. because it was edited by hand."""
+
+def encode_cursor(sort_value, id):
+  """Turns the sort key of the last story on a page, e.g. its (created_at, id) or (hot score, id), into an opaque URL-safe token."""
+  if isinstance(sort_value, datetime):
+    sort_value = sort_value.isoformat()
+  return base64.urlsafe_b64encode(f"{sort_value}|{id}".encode('UTF-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, parse_sort_value=datetime.fromisoformat):
+  """Inverse of encode_cursor; parse_sort_value turns the sort value back from a string. Raises InvalidCursor if cursor wasn't made by
+  encode_cursor."""
+  try:
+    padded_cursor = cursor + '=' * (-len(cursor) % 4)
+    sort_value, id = base64.urlsafe_b64decode(padded_cursor).decode('UTF-8').split('|')
+    return parse_sort_value(sort_value), int(id)
+  except ValueError as exc:
+    raise InvalidCursor(f"Invalid feed cursor {cursor!r}") from exc
+
 class Story(db.Model):
   """Each Story in the app is usually a news article or website that is shared by a user. 
   Each story has a title, optional author (sometimes the author of a story is not quite clear), and a url to the website where 
   users can read the story."""
 
   __tablename__ = "stories"
+  __table_args__ = (
+    # The feed is ordered newest first by (created_at, id), and a user's stories by the same key within user_id.
+    db.Index('ix_stories_created_at_id', 'created_at', 'id'),
+    db.Index('ix_stories_user_id_created_at_id', 'user_id', 'created_at', 'id'),
+    # Full-text search, and trigram matching of titles for typo tolerant autocomplete. The trigram index is GiST rather than GIN because
+    # GiST can return the closest titles first, so autocomplete stops after `limit` titles instead of sorting every match.
+    db.Index('ix_stories_search_vector', 'search_vector', postgresql_using='gin'),
+    db.Index('ix_stories_title_trgm', 'title', postgresql_using='gist', postgresql_ops={'title': 'gist_trgm_ops'}),
+  )
 
   id = db.Column(db.Integer, primary_key=True, autoincrement=True)
   user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='cascade'), nullable=False)
   title = db.Column(db.Text, nullable=False)
   author = db.Column(db.Text)
   url = db.Column(db.Text, nullable=False)
-  created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
-  updated_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
+  # Defaults are functions so each story gets the time it was created at, not the time the app started.
+  created_at = db.Column(db.DateTime, nullable=False, default=lambda: datetime.now(timezone.utc))
+  updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+
+  # Deferred since listings never show it; it's only used in WHERE and ORDER BY clauses of searches.
+  search_vector = deferred(db.Column(TSVECTOR, db.Computed(SEARCH_VECTOR, persisted=True)))
+
+  # Whether the user viewing a listing has favorited/bookmarked the story. Not stored in the database; set by get_feed.
+  is_favorited = False
+  is_bookmarked = False
+
+  @classmethod
+  def get_feed(cls, cursor=None, per_page=20, user_id=None, viewer_id=None):
+    """Returns a FeedPage of stories, newest first, optionally only the ones posted by user_id. Uses keyset pagination: instead of an
+    OFFSET, which has to skip over every story on earlier pages, cursor holds the (created_at, id) of the last story on the previous page
+    and the query seeks straight to the stories after it using the (created_at, id) indexes, so page 10,000 is as fast as page 1.
+
+    Everything a listing shows is loaded in a single query no matter how many stories are on the page: each story's poster (story.user),
+    its favorite/bookmark/comment counts (story.engagement), and, if viewer_id is given, whether that user has favorited/bookmarked it
+    (story.is_favorited, story.is_bookmarked)."""
+
+    query = cls._listing_query(viewer_id)
+    if user_id is not None:
+      query = query.filter(cls.user_id == user_id)
+    if cursor is not None:
+      created_at, id = decode_cursor(cursor)
+      query = query.filter(db.tuple_(cls.created_at, cls.id) < db.tuple_(created_at, id))
+
+    # Fetch one extra story to find out whether there is a next page without a separate COUNT query.
+    rows = query.order_by(cls.created_at.desc(), cls.id.desc()).limit(per_page + 1).all()
+    stories = cls._stories_from_listing_rows(rows, viewer_id)
+
+    if len(stories) <= per_page:
+      return FeedPage(stories, None)
+
+    stories = stories[:per_page]
+    return FeedPage(stories, encode_cursor(stories[-1].created_at, stories[-1].id))
+
+  @classmethod
+  def get_hot_feed(cls, cursor=None, per_page=20, viewer_id=None):
+    """Returns a FeedPage of the hottest stories (see models/hot_ranking.py), loaded like get_feed. The stories come straight off the
+    (hot_score, story_id) index of story_engagement, so each page is a single index scan however many stories there are. Scores keep
+    changing, so a story can move between pages while someone is paging through them."""
+
+    query = cls._listing_query(viewer_id)
+    if cursor is not None:
+      score, id = decode_cursor(cursor, parse_sort_value=float)
+      query = query.filter(db.tuple_(StoryEngagement.hot_score, StoryEngagement.story_id) < db.tuple_(score, id))
+
+    rows = query.order_by(StoryEngagement.hot_score.desc(), StoryEngagement.story_id.desc()).limit(per_page + 1).all()
+    stories = cls._stories_from_listing_rows(rows, viewer_id)
+
+    if len(stories) <= per_page:
+      return FeedPage(stories, None)
+
+    stories = stories[:per_page]
+    return FeedPage(stories, encode_cursor(stories[-1].engagement.hot_score, stories[-1].id))
+
+  @classmethod
+  def get_story(cls, story_id, viewer_id=None):
+    """Returns the story with id story_id, or None, loaded like the stories of a listing in a single query."""
+
+    rows = cls._listing_query(viewer_id).filter(cls.id == story_id).all()
+    stories = cls._stories_from_listing_rows(rows, viewer_id)
+    return stories[0] if stories else None
+
+  @classmethod
+  def _listing_query(cls, viewer_id):
+    """Query for stories along with everything a listing shows, so rendering it takes no further queries: each story's poster
+    (story.user), its counts and hot score (story.engagement, joined so the query can also filter and sort by them), what's known about
+    its link (story.link_metadata), and, if viewer_id is given, whether that user has favorited/bookmarked it."""
+
+    # Story.user is a backref, which only exists once all the mappers have been configured.
+    configure_mappers()
+    query = (db.session.query(cls).join(cls.engagement)
+             .options(joinedload(cls.user), joinedload(cls.link_metadata), contains_eager(cls.engagement)))
+    if viewer_id is not None:
+      # The viewer's favorite/bookmark flags come back as two extra columns of the same query.
+      is_favorited = db.exists().where(Favorite.story_id == cls.id, Favorite.user_id == viewer_id)
+      is_bookmarked = db.exists().where(Bookmark.story_id == cls.id, Bookmark.user_id == viewer_id)
+      query = query.add_columns(is_favorited.label('is_favorited'), is_bookmarked.label('is_bookmarked'))
+    return query
+
+  @staticmethod
+  def _stories_from_listing_rows(rows, viewer_id):
+    """Turns the rows returned by a _listing_query into a list of stories with is_favorited/is_bookmarked set."""
+
+    if viewer_id is None:
+      return rows
+
+    stories = []
+    for story, is_favorited, is_bookmarked in rows:
+      story.is_favorited = is_favorited
+      story.is_bookmarked = is_bookmarked
+      stories.append(story)
+    return stories
+
+  @classmethod
+  def search(cls, terms, page=1, per_page=20, viewer_id=None):
+    """Returns a SearchPage of the stories matching terms, best matches first. terms uses web search syntax: words are ANDed, "quoted
+    phrases" must appear together, 'or' separates alternatives and -word excludes a word. Title matches rank above author matches, which
+    rank above URL domain matches. Matching stories are found with the GIN index on search_vector rather than by scanning every title."""
+
+    page = max(1, min(page, MAX_SEARCH_PAGES))
+    search_query = db.func.websearch_to_tsquery('english', terms)
+    rank = db.func.ts_rank_cd(cls.search_vector, search_query)
+
+    rows = (cls._listing_query(viewer_id)
+            .filter(cls.search_vector.op('@@')(search_query))
+            .order_by(rank.desc(), cls.created_at.desc(), cls.id.desc())
+            .offset((page - 1) * per_page).limit(per_page + 1).all())
+    stories = cls._stories_from_listing_rows(rows, viewer_id)
+
+    has_next_page = len(stories) > per_page and page < MAX_SEARCH_PAGES
+    return SearchPage(stories[:per_page], page, has_next_page)
+
+  @classmethod
+  def autocomplete_titles(cls, prefix, limit=10):
+    """Returns up to limit (id, title) pairs of stories whose title contains a word similar to prefix, most similar first. Uses
+    pg_trgm word similarity, which tolerates typos and matches partially typed words, through the trigram index on title."""
+
+    # <<-> is 1 - word_similarity, which the trigram index can order by. Adding a tie breaker would make PostgreSQL sort every match.
+    distance = db.literal(prefix).op('<<->')(cls.title)
+    return (db.session.query(cls.id, cls.title)
+            .filter(db.literal(prefix).op('<%')(cls.title))
+            .order_by(distance)
+            .limit(limit).all())
+
+  @classmethod
+  def get_user_stories(cls, user_id, cursor=None, per_page=20, viewer_id=None):
+    """Returns a FeedPage of the stories posted by user_id, newest first."""
+    return cls.get_feed(cursor=cursor, per_page=per_page, user_id=user_id, viewer_id=viewer_id)
+
+  @classmethod
+  def recount_engagement(cls):
+    """Recomputes every story's favorite/bookmark/comment counts from scratch. The triggers keep the counts correct as rows change, so
+    this is only needed to repair them. Each count is one grouped scan of its table, and only the wrong ones are rewritten. The caller
+    must commit."""
+
+    for model, counter_column in [(Favorite, StoryEngagement.favorite_count), (Bookmark, StoryEngagement.bookmark_count),
+                                  (Comment, StoryEngagement.comment_count)]:
+      counted = (db.select(cls.id, db.func.count(model.story_id).label('row_count'))
+                 .outerjoin(model, model.story_id == cls.id).group_by(cls.id).subquery())
+      db.session.execute(db.update(StoryEngagement)
+                         .where(StoryEngagement.story_id == counted.c.id, counter_column != counted.c.row_count)
+                         .values({counter_column: counted.c.row_count}))
+
+  # Relationship between a story and its comments, in display order (see Comment.get_thread_page to load them a page at a time). The
+  # database deletes a story's comments along with it, which also takes care of replies.
+
+  comments = db.relationship('Comment', cascade='all, delete', passive_deletes=True, order_by='Comment.path', backref='story')
+
+  # The story's counters and hot score, in story_engagement, which the database creates and deletes along with the story.
+  engagement = db.relationship(StoryEngagement, uselist=False, viewonly=True)
+
+  # What the background fetcher found at the story's URL (see services/link_metadata.py). Not a foreign key, since the row is shared by
+  # every story with the same URL and is created by the database after the story.
+  link_metadata = db.relationship(LinkMetadata, primaryjoin=lambda: foreign(Story.url) == LinkMetadata.url, uselist=False, viewonly=True)
 
-  # Relationship between a story and its comments
+# link_metadata's triggers are on stories, so create_all has to create stories first.
+LinkMetadata.__table__.add_is_dependent_on(Story.__table__)
 
-  comments = db.relationship('Comment', cascade='all, delete', backref='story')
+# The trigram index on titles needs the pg_trgm extension, which has to exist before the stories table is created.
+event.listen(Story.__table__, 'before_create', DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect='postgresql'))
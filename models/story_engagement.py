@@ -0,0 +1,21 @@
+"""This file contains the StoryEngagement model, each story's engagement counters and stored hot score."""
+
+from models.init_db import db
+
+class StoryEngagement(db.Model):
+  """One row per story with its favorite, bookmark and comment counts, so listings don't have to count rows per story, and its stored
+  hot score (see models/hot_ranking.py). Kept in this narrow table rather than on stories because every favorite, bookmark and comment
+  changes them: updating a few numbers here is one small row version, where updating the story would rewrite its title, URL and search
+  vector. The database creates the row along with the story and keeps it up to date (see models/counter_cache.py)."""
+
+  __tablename__ = "story_engagement"
+  __table_args__ = (
+    # The hot feed is ordered by (hot_score, story_id) descending.
+    db.Index('ix_story_engagement_hot_score_story_id', 'hot_score', 'story_id'),
+  )
+
+  story_id = db.Column(db.Integer, db.ForeignKey('stories.id', ondelete='cascade'), primary_key=True)
+  favorite_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+  bookmark_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+  comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+  hot_score = db.Column(db.Float, nullable=False, default=0)
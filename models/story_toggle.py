@@ -0,0 +1,76 @@
+"""Favoriting and bookmarking without loading the user's collections through the ORM. Each change is one INSERT ... ON CONFLICT DO
+NOTHING or DELETE statement, so doing the same thing twice (a double click, a retried request) is harmless instead of raising
+IntegrityError, and it works the same for one story or for many at once.
+
+The API takes the state the user wants (favorited or not) rather than flipping the current state, so two requests racing each other
+can't cancel out. The stories' counters (in story_engagement) are kept up to date by the triggers in models/counter_cache.py. These are
+plain SQL statements, not ORM changes; the fragment cache still notices them, since they run through db.session."""
+
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from sqlalchemy.dialects.postgresql import insert
+
+from models.init_db import db
+
+# The result of changing one story: whether it's now set (favorited/bookmarked), the story's new count, and whether anything changed.
+ToggleResult = namedtuple('ToggleResult', ['is_set', 'count', 'changed'])
+
+class StoryToggleMixin:
+  """Mixed into the models recording a user marking a story (Favorite and Bookmark), which have a (user_id, story_id) primary key and
+  set story_counter_column to the name of the story_engagement column that counts their rows."""
+
+  story_counter_column = None
+
+  @classmethod
+  def set_state(cls, user_id, story_id, is_set):
+    """Makes story_id favorited/bookmarked by user_id (is_set=True) or not (is_set=False), whatever its current state. Returns a
+    ToggleResult, found in the same round trip as the change, or None if the story doesn't exist. The caller must commit."""
+
+    change = cls._insert_statement(user_id, [story_id]) if is_set else cls._delete_statement(user_id, [story_id])
+    changed = change.cte('changed')
+    engagement = db.metadata.tables['story_engagement']
+    # The counter triggers only run at the end of the statement, so this sees the count from before the change.
+    row_change = db.select(db.func.count()).select_from(changed).scalar_subquery()
+    new_count = engagement.c[cls.story_counter_column] + (row_change if is_set else -row_change)
+
+    # The statement is a SELECT, so tell the session it writes (see models/routing.py). Every story has an engagement row, so there's
+    # none if the story doesn't exist.
+    row = db.session.execute(
+      db.select(new_count, row_change).where(engagement.c.story_id == story_id),
+      execution_options={'writes': True}
+    ).first()
+    if row is None:
+      return None
+    count, row_change = row
+    return ToggleResult(is_set, count, row_change > 0)
+
+  @classmethod
+  def set_many(cls, user_id, story_ids, is_set):
+    """Makes all of story_ids favorited/bookmarked by user_id (is_set=True) or not (is_set=False) in one statement, skipping stories
+    that don't exist. Returns the ids of the stories that changed. The caller must commit."""
+
+    if not story_ids:
+      return []
+    change = cls._insert_statement(user_id, story_ids) if is_set else cls._delete_statement(user_id, story_ids)
+    return db.session.execute(change).scalars().all()
+
+  @classmethod
+  def clear_all(cls, user_id):
+    """Removes every favorite/bookmark of user_id. Returns the ids of the stories that changed. The caller must commit."""
+
+    change = db.delete(cls).where(cls.user_id == user_id).returning(cls.story_id)
+    return db.session.execute(change).scalars().all()
+
+  @classmethod
+  def _insert_statement(cls, user_id, story_ids):
+    # Selecting the rows from stories skips ids of stories that don't exist instead of failing on the foreign key.
+    stories = db.metadata.tables['stories']
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    existing_stories = db.select(db.literal(user_id), stories.c.id, db.literal(now)).where(stories.c.id.in_(story_ids))
+    return (insert(cls).from_select(['user_id', 'story_id', 'created_at'], existing_stories)
+            .on_conflict_do_nothing().returning(cls.story_id))
+
+  @classmethod
+  def _delete_statement(cls, user_id, story_ids):
+    return db.delete(cls).where(cls.user_id == user_id, cls.story_id.in_(story_ids)).returning(cls.story_id)
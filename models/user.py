@@ -1,11 +1,14 @@
 """This file contains the User model."""
 
-from flask_bcrypt import Bcrypt # For user signup/login password hashing
+from sqlalchemy.orm import foreign
 
 from models.init_db import db
+from models.connect import read_from_replica
+from models.profile_picture import ProfilePicture
 from datetime import datetime, timezone
 
-bcrypt = Bcrypt()
+# For user signup/login password hashing, done on a pool of worker processes.
+from services.password_hashing import password_hasher
 
 class User(db.Model):
   """User in the app. A user can create an account by putting down a username (50 characters max), unique email, optional profile picture
@@ -28,7 +31,7 @@ class User(db.Model):
   def create_user(cls, username, email, profile_picture_url, password):
     """Creates a new user, hashes the password, stores the new user information in the database, and returns the user."""
 
-    hashed_password = bcrypt.generate_password_hash(password).decode('UTF-8')
+    hashed_password = password_hasher.hash(password)
     new_user = User(
       username = username,
       email = email,
@@ -41,13 +44,18 @@ class User(db.Model):
   
   @classmethod
   def authenticate_user(cls, username, password):
-    """Attempts to log in the user. Returns user if successful, returns 0 if user not found in database, returns 1 if password doesn't match."""
+    """Attempts to log in the user. Returns user if successful, returns 0 if user not found in database, returns 1 if password doesn't match.
+    If the user's password was hashed with an outdated work factor, it's rehashed with the current one; the caller must commit."""
 
-    user_logging_in = cls.query.filter_by(username=username).first()
+    # Looking up the user is read-only, so it can be answered by a read replica.
+    with read_from_replica():
+      user_logging_in = cls.query.filter_by(username=username).first()
 
     if user_logging_in:
-      do_passwords_match = bcrypt.check_password_hash(user_logging_in.password, password)
+      do_passwords_match = password_hasher.verify(user_logging_in.password, password)
       if do_passwords_match:
+        if password_hasher.needs_rehash(user_logging_in.password):
+          user_logging_in.password = password_hasher.rehash(password)
         return user_logging_in
       return 1
     
@@ -61,7 +69,7 @@ class User(db.Model):
     logged_in_user = cls.query.get(id)
 
     if logged_in_user:
-      return bcrypt.check_password_hash(logged_in_user.password, password)
+      return password_hasher.verify(logged_in_user.password, password)
     return False
   
   @classmethod 
@@ -69,7 +77,7 @@ class User(db.Model):
     """Updates the current logged in user's password and saves it in the database."""
 
     logged_in_user = cls.query.get(id)
-    new_hashed_password = bcrypt.generate_password_hash(new_password).decode('UTF-8')
+    new_hashed_password = password_hasher.hash(new_password)
     logged_in_user.password = new_hashed_password
 
   # Relationships to link a user with the stories they've uploaded, their favorites, their bookmarks, and their comments.
@@ -77,9 +85,18 @@ class User(db.Model):
   stories = db.relationship('Story', cascade='all, delete', backref='user')
   favorites = db.relationship('Favorite', cascade='all, delete', backref='user')
   bookmarks = db.relationship('Bookmark', cascade='all, delete', backref='user')
-  comments = db.relationship('Comment', cascade='all, delete', backref='user')
+  # The database deletes a user's comments along with the replies to them.
+  comments = db.relationship('Comment', cascade='all, delete', passive_deletes=True, backref='user')
 
   # Relationships to link a user directly with their favorite stories and bookmarked stories.
 
   favorite_stories = db.relationship('Story', secondary='favorites', backref='favorite_users')
-  bookmarked_stories = db.relationship('Story', secondary='bookmarks', backref='bookmark_users')
\ No newline at end of file
+  bookmarked_stories = db.relationship('Story', secondary='bookmarks', backref='bookmark_users')
+
+  # The thumbnail of a remote profile picture (see services/profile_pictures.py), None for local pictures. Not a foreign key, since the
+  # row is shared by every user with the same picture URL and is created by the database after the user.
+  profile_picture = db.relationship(ProfilePicture, primaryjoin=lambda: foreign(User.profile_picture_url) == ProfilePicture.source_url,
+                                    uselist=False, viewonly=True)
+
+# profile_pictures' triggers are on users, so create_all has to create users first.
+ProfilePicture.__table__.add_is_dependent_on(User.__table__)
\ No newline at end of file
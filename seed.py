@@ -1,6 +1,25 @@
-"""Seed file that will be used throughout development to either insert sample data into the databae or connect to the online Supabase database."""
+"""Seed file that will be used throughout development to either insert sample data into the databae or connect to the online Supabase database.
+
+Run without arguments, it drops and recreates all the tables. It can also fill them with synthetic data at production scale to test
+performance locally, e.g.
+
+  python seed.py --users 100000 --stories 1000000 --favorites 5000000 --bookmarks 1000000 --comments 2000000 --replies 3000000
+
+Popularity is skewed like real traffic: a few users do most of the posting/favoriting/commenting and a few stories get most of the
+favorites, bookmarks and comments (ranks are drawn from a power law). Rows are generated lazily and streamed to the database in batches
+with PostgreSQL's COPY (or multi-row INSERTs on other databases) instead of one ORM add() per row, and every user gets the same
+precomputed password hash instead of paying for bcrypt once per user. The number of rows per second loaded into each table is reported."""
+
+import argparse
+import csv
+import io
+import itertools
+import random
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
 
-import os
 from app import create_app
 
 from models.init_db import db
@@ -10,26 +29,243 @@ from models.favorite import Favorite
 from models.bookmark import Bookmark
 from models.comment import Comment
 from models.connect import connect_db
+from services.password_hashing import password_hasher
 
 from dotenv import load_dotenv
 load_dotenv()
 
-app = create_app('hackornews2')
-# print("The database is: ", os.environ.get('DATABASE_URL'))
-connect_db(app)
-app.app_context().push()
+SAMPLE_WORDS = ("python flask postgres startup security open source release browser privacy climate space science economy "
+                "design database cloud hardware history research language compiler network").split()
+
+def title_vocabulary(size=20000):
+  """Words that story titles are made of, most common first. Like real text, word frequencies follow a power law over a large
+  vocabulary (see power_law_index), so searches for most words match a small fraction of the stories. The vocabulary is made-up words
+  with the real SAMPLE_WORDS spread from the most common ranks ("python") to rare ones ("network"), so benchmarks can search for real
+  words of known frequency."""
+
+  syllables = [consonant + vowel for consonant in 'bdfgklmnprstvz' for vowel in 'aeiou']
+  words = [''.join(parts) for parts in itertools.product(syllables, repeat=3)]
+  random.Random(0).shuffle(words)
+  words = words[:size]
+  for position, word in enumerate(SAMPLE_WORDS):
+    words.insert(int(1.5 ** position), word)
+  return words
+
+TITLE_VOCABULARY = title_vocabulary()
+
+# Replies are added in this many rounds, each of which can reply to the replies of the rounds before.
+REPLY_ROUNDS = 3
+
+# COPY bypasses the model's Python-side defaults, so they have to be filled in explicitly.
+DEFAULT_PROFILE_PICTURE_URL = User.profile_picture_url.default.arg
+
+def reset_database():
+  """Drops and recreates all tables, emptying them."""
+
+  db.drop_all()
+  db.create_all()
+
+  # If tables aren't empty, empty them
+  User.query.delete()
+  Story.query.delete()
+  Favorite.query.delete()
+  Bookmark.query.delete()
+  Comment.query.delete()
+
+  db.session.commit()
+
+def power_law_index(rng, count):
+  """Returns an index in [0, count) where small indexes are much more likely than large ones: the rank is log-uniform, so its
+  probability is roughly proportional to 1 / rank, like the popularity of stories."""
+  return min(count - 1, int(count ** rng.random()) - 1)
+
+def random_time(rng, start, span_seconds):
+  return start + timedelta(seconds=rng.random() * span_seconds)
+
+def bulk_load(table, columns, rows, batch_size):
+  """Streams rows (an iterable of tuples in the order of columns) into table in batches and returns the number of rows sent. Uses
+  COPY on PostgreSQL and executemany INSERTs on other databases."""
+
+  connection = db.session.connection()
+  use_copy = connection.dialect.name == 'postgresql'
+  raw_cursor = connection.connection.cursor() if use_copy else None
+  copy_statement = f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+  insert_statement = text(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join(':' + column for column in columns)})")
+
+  total_rows = 0
+  rows = iter(rows)
+  while True:
+    batch = list(itertools.islice(rows, batch_size))
+    if not batch:
+      break
+
+    if use_copy:
+      buffer = io.StringIO()
+      csv.writer(buffer).writerows(batch)
+      buffer.seek(0)
+      raw_cursor.copy_expert(copy_statement, buffer)
+    else:
+      connection.execute(insert_statement, [dict(zip(columns, row)) for row in batch])
+    total_rows += len(batch)
+
+  return total_rows
+
+def load_unique_pairs(table, rows, batch_size):
+  """Favorites and bookmarks can't contain the same (user_id, story_id) twice, and randomly drawn pairs sometimes collide. Rather than
+  remembering every pair in memory, rows are streamed into an unlogged staging table and copied over in one INSERT that skips
+  duplicates. Returns the number of rows actually added."""
+
+  db.session.execute(text(f"CREATE UNLOGGED TABLE IF NOT EXISTS {table}_staging (user_id integer, story_id integer, created_at timestamp)"))
+  db.session.execute(text(f"TRUNCATE {table}_staging"))
+  bulk_load(f"{table}_staging", ('user_id', 'story_id', 'created_at'), rows, batch_size)
+  result = db.session.execute(text(
+    f"INSERT INTO {table} (user_id, story_id, created_at) SELECT user_id, story_id, min(created_at) FROM {table}_staging "
+    f"GROUP BY user_id, story_id ON CONFLICT DO NOTHING"
+  ))
+  db.session.execute(text(f"DROP TABLE {table}_staging"))
+  return result.rowcount
+
+def timed(label, load):
+  """Runs load(), which returns a row count, commits, and prints how fast the rows were loaded."""
+
+  start = time.perf_counter()
+  row_count = load()
+  db.session.commit()
+  seconds = time.perf_counter() - start
+  print(f"{label:>10}: {row_count:>10} rows in {seconds:8.1f}s ({row_count / seconds if seconds else 0:,.0f} rows/sec)")
+  return row_count
+
+def generate_users(rng, count, password, password_hash, hash_each_user, first_number, start, span_seconds):
+  for number in range(first_number, first_number + count):
+    user_password_hash = password_hasher.hash(password) if hash_each_user else password_hash
+    yield (f"user{number}", f"user{number}@example.com", DEFAULT_PROFILE_PICTURE_URL, user_password_hash,
+           random_time(rng, start, span_seconds))
+
+def generate_stories(rng, count, user_ids, start, span_seconds):
+  for number in range(count):
+    created_at = random_time(rng, start, span_seconds)
+    title = ' '.join(TITLE_VOCABULARY[power_law_index(rng, len(TITLE_VOCABULARY))] for _ in range(rng.randint(3, 10))).capitalize()
+    author = f"Author {rng.randint(1, 50000)}" if rng.random() < 0.8 else None
+    url = f"https://news{rng.randint(1, 2000)}.example.com/articles/{number}"
+    yield (user_ids[power_law_index(rng, len(user_ids))], title, author, url, created_at, created_at)
+
+def generate_pairs(rng, count, user_ids, story_ids, start, span_seconds):
+  for _ in range(count):
+    yield (user_ids[power_law_index(rng, len(user_ids))], story_ids[power_law_index(rng, len(story_ids))],
+           random_time(rng, start, span_seconds))
+
+def generate_comments(rng, count, user_ids, story_ids, start, span_seconds):
+  for _ in range(count):
+    created_at = random_time(rng, start, span_seconds)
+    content = ' '.join(rng.choices(SAMPLE_WORDS, k=rng.randint(5, 40)))
+    yield (user_ids[power_law_index(rng, len(user_ids))], story_ids[power_law_index(rng, len(story_ids))], content, created_at,
+           created_at)
+
+def generate_replies(rng, count, user_ids, comment_ids):
+  for _ in range(count):
+    content = ' '.join(rng.choices(SAMPLE_WORDS, k=rng.randint(5, 40)))
+    # Most replies come within a few hours of the comment they reply to.
+    yield (user_ids[power_law_index(rng, len(user_ids))], comment_ids[power_law_index(rng, len(comment_ids))], content,
+           rng.expovariate(1 / 7200))
+
+def load_replies(rng, count, user_ids, batch_size, rounds=REPLY_ROUNDS):
+  """Adds count replies to existing comments, in rounds that can reply to the replies of earlier rounds, so threads get up to rounds
+  levels deep. Replies are streamed into an unlogged staging table and inserted in one statement per round, which looks up the story
+  and time of the comment each one replies to. Returns the number of replies added."""
+
+  db.session.execute(text(
+    "CREATE UNLOGGED TABLE IF NOT EXISTS replies_staging (user_id integer, parent_id integer, content text, delay_seconds float)"
+  ))
+  total_rows = 0
+  for round_number in range(rounds):
+    comment_ids = shuffled_ids(rng, Comment)
+    round_count = count // rounds + (1 if round_number < count % rounds else 0)
+    db.session.execute(text("TRUNCATE replies_staging"))
+    bulk_load('replies_staging', ('user_id', 'parent_id', 'content', 'delay_seconds'),
+              generate_replies(rng, round_count, user_ids, comment_ids), batch_size)
+    total_rows += db.session.execute(text(
+      "INSERT INTO comments (user_id, story_id, parent_id, content, created_at, updated_at) "
+      "SELECT replies.user_id, parents.story_id, replies.parent_id, replies.content, "
+      "       parents.created_at + replies.delay_seconds * interval '1 second', parents.created_at + replies.delay_seconds * interval '1 second' "
+      "FROM replies_staging AS replies JOIN comments AS parents ON parents.id = replies.parent_id"
+    )).rowcount
+  db.session.execute(text("DROP TABLE replies_staging"))
+  return total_rows
+
+def shuffled_ids(rng, model):
+  """All ids of model in random order, so that the most popular ranks are spread over random rows rather than the oldest ones."""
+
+  ids = [id for (id,) in db.session.query(model.id)]
+  rng.shuffle(ids)
+  return ids
+
+def seed(args):
+  rng = random.Random(args.seed)
+  now = datetime.now(timezone.utc).replace(tzinfo=None)
+  span_seconds = args.days * 24 * 3600
+  start = now - timedelta(seconds=span_seconds)
+
+  if not args.keep_existing:
+    reset_database()
+
+  if args.users:
+    # One bcrypt hash for everyone, unless each user really needs their own.
+    password_hash = password_hasher.hash(args.password)
+    first_number = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    users = generate_users(rng, args.users, args.password, password_hash, args.hash_each_user, first_number, start, span_seconds)
+    columns = ('username', 'email', 'profile_picture_url', 'password', 'created_at')
+    timed('users', lambda: bulk_load('users', columns, users, args.batch_size))
+
+  user_ids = shuffled_ids(rng, User)
+  if args.stories and user_ids:
+    stories = generate_stories(rng, args.stories, user_ids, start, span_seconds)
+    columns = ('user_id', 'title', 'author', 'url', 'created_at', 'updated_at')
+    timed('stories', lambda: bulk_load('stories', columns, stories, args.batch_size))
+
+  story_ids = shuffled_ids(rng, Story) if user_ids else []
+  if story_ids:
+    if args.favorites:
+      favorites = generate_pairs(rng, args.favorites, user_ids, story_ids, start, span_seconds)
+      timed('favorites', lambda: load_unique_pairs('favorites', favorites, args.batch_size))
+    if args.bookmarks:
+      bookmarks = generate_pairs(rng, args.bookmarks, user_ids, story_ids, start, span_seconds)
+      timed('bookmarks', lambda: load_unique_pairs('bookmarks', bookmarks, args.batch_size))
+    if args.comments:
+      comments = generate_comments(rng, args.comments, user_ids, story_ids, start, span_seconds)
+      columns = ('user_id', 'story_id', 'content', 'created_at', 'updated_at')
+      timed('comments', lambda: bulk_load('comments', columns, comments, args.batch_size))
+    if args.replies:
+      timed('replies', lambda: load_replies(rng, args.replies, user_ids, args.batch_size))
 
-# db.session.rollback()
+  if db.session.connection().dialect.name == 'postgresql':
+    # Fresh statistics so the query planner knows how big the tables now are.
+    db.session.execute(text("ANALYZE"))
+    db.session.commit()
 
-# Create all tables
-db.drop_all()
-db.create_all()
+def main():
+  parser = argparse.ArgumentParser(description="Reset the database and optionally fill it with synthetic data.")
+  parser.add_argument('--db', default='hackornews2', help="local database name, used if DATABASE_URL isn't set")
+  parser.add_argument('--users', type=int, default=0)
+  parser.add_argument('--stories', type=int, default=0)
+  parser.add_argument('--favorites', type=int, default=0)
+  parser.add_argument('--bookmarks', type=int, default=0)
+  parser.add_argument('--comments', type=int, default=0, help="top-level comments")
+  parser.add_argument('--replies', type=int, default=0, help=f"replies to comments, up to {REPLY_ROUNDS} levels deep")
+  parser.add_argument('--days', type=int, default=365, help="spread created_at times over this many days before now")
+  parser.add_argument('--batch-size', type=int, default=50000)
+  parser.add_argument('--password', default='password', help="password of every generated user")
+  parser.add_argument('--hash-each-user', action='store_true', help="bcrypt each user's password separately (slow)")
+  parser.add_argument('--keep-existing', action='store_true', help="add to the existing data instead of dropping all tables first")
+  parser.add_argument('--seed', type=int, default=0, help="random seed, so the same arguments generate the same data")
+  args = parser.parse_args()
 
-# If tables aren't empty, empty them
-User.query.delete()
-Story.query.delete()
-Favorite.query.delete()
-Bookmark.query.delete()
-Comment.query.delete()
+  app = create_app(args.db)
+  # print("The database is: ", os.environ.get('DATABASE_URL'))
+  # Echoing every statement of a bulk load would slow it down considerably.
+  app.config['SQLALCHEMY_ECHO'] = False
+  connect_db(app)
+  with app.app_context():
+    seed(args)
 
-db.session.commit()
\ No newline at end of file
+if __name__ == '__main__':
+  main()
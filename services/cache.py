@@ -0,0 +1,64 @@
+"""Small in-process caches shared by the services in this folder. Each gunicorn worker gets its own copy, so these are only ever used
+for data that is cheap to recompute or safe to be briefly stale."""
+
+import threading
+import time
+from collections import OrderedDict
+
+class TTLCache:
+  """Thread-safe least-recently-used cache whose entries also expire a number of seconds (ttl) after being stored. Once maxsize entries
+  are stored, storing a new entry evicts the least recently used one. Individual entries can be stored with their own ttl, which is
+  useful for caching negative results for a shorter amount of time than positive ones."""
+
+  def __init__(self, maxsize=1024, ttl=300, timer=time.monotonic):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.timer = timer
+    self.hits = 0
+    self.misses = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    """Returns the value stored under key, or default if the key was never stored, has expired, or has been evicted."""
+
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None:
+        expires_at, value = entry
+        if expires_at > self.timer():
+          self._entries.move_to_end(key)
+          self.hits += 1
+          return value
+        del self._entries[key]
+      self.misses += 1
+      return default
+
+  def set(self, key, value, ttl=None):
+    """Stores value under key for ttl seconds (the cache's default ttl if not given)."""
+
+    expires_at = self.timer() + (self.ttl if ttl is None else ttl)
+    with self._lock:
+      self._entries[key] = (expires_at, value)
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.maxsize:
+        self._entries.popitem(last=False)
+
+  def pop(self, key, default=None):
+    """Removes key from the cache and returns its value (even if expired), or default if it isn't stored."""
+
+    with self._lock:
+      entry = self._entries.pop(key, None)
+    return default if entry is None else entry[1]
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def hit_rate(self):
+    """Fraction of get calls that found a live entry, 0.0 if the cache hasn't been read yet."""
+    lookups = self.hits + self.misses
+    return self.hits / lookups if lookups else 0.0
+
+  def __len__(self):
+    return len(self._entries)
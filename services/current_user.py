@@ -0,0 +1,163 @@
+"""Loads the logged in user for each request without a database round trip on every request. Most pages only need the user's id,
+username, email, sign up date and profile picture, so those are kept as a small immutable snapshot in a per-process LRU/TTL cache keyed
+by user id. The full User row is only loaded from the database if a view or template actually reads one of its other attributes.
+
+Snapshots are invalidated whenever a User row is updated or deleted through SQLAlchemy in this process (e.g. User.update_password or
+editing a profile). Other gunicorn workers keep their copy until it expires, so CURRENT_USER_CACHE_TTL bounds how stale a username or
+profile picture can be in other workers. A user whose remote profile picture is still being processed isn't cached at all, since the
+picture pages show changes from the default one to the thumbnail as soon as any worker's processor is done with it.
+
+If an account is deleted while a snapshot of it is cached, reading one of the other attributes raises UserDeleted, which the app handles
+by logging the user out."""
+
+import threading
+from collections import namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
+
+from models.init_db import db
+from models.user import User
+from services.cache import TTLCache
+from services.profile_pictures import profile_picture_src, profile_picture_pending
+
+# profile_picture_src is the URL pages show for the user's picture (see services/profile_pictures.py).
+UserSnapshot = namedtuple('UserSnapshot', ['id', 'username', 'email', 'created_at', 'profile_picture_url', 'profile_picture_src'])
+
+class UserDeleted(Exception):
+  """Raised when the full User of a logged in user is needed but their account no longer exists."""
+
+class CurrentUser:
+  """Stored in g.user for a logged in user. Reading id, username, email, created_at, profile_picture_url or profile_picture_src, or
+  calling format_created_at, uses the cached snapshot; reading anything else (password, relationships, ...) loads the full User from the
+  database once and delegates to it."""
+
+  __slots__ = ('snapshot', '_user', '_cache')
+
+  def __init__(self, snapshot, cache, user=None):
+    self.snapshot = snapshot
+    self._user = user
+    self._cache = cache
+
+  @property
+  def id(self):
+    return self.snapshot.id
+
+  @property
+  def username(self):
+    return self.snapshot.username
+
+  @property
+  def email(self):
+    return self.snapshot.email
+
+  @property
+  def created_at(self):
+    return self.snapshot.created_at
+
+  def format_created_at(self):
+    return User.format_created_at(self)
+
+  @property
+  def profile_picture_url(self):
+    return self.snapshot.profile_picture_url
+
+  @property
+  def profile_picture_src(self):
+    return self.snapshot.profile_picture_src
+
+  def load(self):
+    """Returns the full User instance for the logged in user, querying the database the first time it's needed in a request."""
+
+    if self._user is None:
+      self._user = db.session.get(User, self.snapshot.id)
+      self._cache.count('full_loads')
+      if self._user is None:
+        self._cache.invalidate(self.snapshot.id)
+        raise UserDeleted(self.snapshot.id)
+    return self._user
+
+  def __getattr__(self, name):
+    return getattr(self.load(), name)
+
+  def __repr__(self):
+    return f"<CurrentUser id={self.snapshot.id} username={self.snapshot.username!r}>"
+
+class CurrentUserCache:
+  """Per-process cache of UserSnapshots. Used like a Flask extension: create it once, then call init_app(app) to configure it from the
+  app's CURRENT_USER_CACHE_SIZE and CURRENT_USER_CACHE_TTL settings."""
+
+  def __init__(self, app=None):
+    self._counter_lock = threading.Lock()
+    self.configure()
+
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.config.setdefault('CURRENT_USER_CACHE_SIZE', 10000)
+    app.config.setdefault('CURRENT_USER_CACHE_TTL', 60)
+
+    self.configure(app.config['CURRENT_USER_CACHE_SIZE'], app.config['CURRENT_USER_CACHE_TTL'])
+    app.extensions['current_user_cache'] = self
+
+  def configure(self, maxsize=10000, ttl=60):
+    self.snapshots = TTLCache(maxsize=maxsize, ttl=ttl)
+    self.counters = {'requests': 0, 'skipped': 0, 'hits': 0, 'misses': 0, 'full_loads': 0}
+
+  def count(self, counter):
+    with self._counter_lock:
+      self.counters[counter] += 1
+
+  def load(self, user_id):
+    """Returns a CurrentUser for user_id, or None if no such user exists (e.g. the account was deleted while logged in)."""
+
+    self.count('requests')
+    snapshot = self.snapshots.get(user_id)
+    if snapshot is not None:
+      self.count('hits')
+      return CurrentUser(snapshot, self)
+
+    # On a miss, load the full User in the same single query, since it's likely to be needed again soon.
+    self.count('misses')
+    user = db.session.get(User, user_id, options=[joinedload(User.profile_picture)])
+    if user is None:
+      return None
+
+    return CurrentUser(self.store(user), self, user=user)
+
+  def skip(self):
+    """Records a request that didn't need the logged in user at all (e.g. static files)."""
+    self.count('requests')
+    self.count('skipped')
+
+  def store(self, user):
+    """Caches a snapshot of a User instance that was just loaded anyway, e.g. after logging in, and returns it. Snapshots of users whose
+    profile picture is still pending are returned without being cached."""
+
+    snapshot = UserSnapshot(user.id, user.username, user.email, user.created_at, user.profile_picture_url, profile_picture_src(user))
+    if not profile_picture_pending(user):
+      self.snapshots.set(user.id, snapshot)
+    return snapshot
+
+  def invalidate(self, user_id):
+    self.snapshots.pop(user_id)
+
+  def stats(self):
+    """Hit rate of the snapshot cache, and how many SELECTs on users were avoided per request compared to loading the full User on
+    every request (each cache hit or skipped request saves one)."""
+
+    counters = dict(self.counters)
+    lookups = counters['hits'] + counters['misses']
+    saved_queries = counters['hits'] + counters['skipped'] - counters['full_loads']
+    counters['hit_rate'] = counters['hits'] / lookups if lookups else 0.0
+    counters['saved_queries_per_request'] = saved_queries / counters['requests'] if counters['requests'] else 0.0
+    return counters
+
+current_user_cache = CurrentUserCache()
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def invalidate_changed_user(mapper, connection, target):
+  """Drops the cached snapshot of any user whose row changes, so a new password, username, email or profile picture is seen right away."""
+  current_user_cache.invalidate(target.id)
@@ -0,0 +1,239 @@
+"""Email existence verification used by the signup form. Checking that an email address actually exists takes an MX record lookup
+followed by an SMTP conversation with the domain's mail server, both of which can take seconds. To keep a burst of signups from tying up
+every worker, lookups run on a small bounded thread pool with hard timeouts, MX records are cached per domain and verification results
+are cached per address. The DNS and SMTP backends are pluggable so the verifier can run against local stand-in servers.
+
+dnspython and smtplib are only imported by the backends once the first address is verified, which keeps them (and dnspython's import
+time) out of the startup of every worker process."""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from services.cache import TTLCache
+
+# Possible results of verifying an email address.
+EMAIL_EXISTS = "exists"
+EMAIL_DOES_NOT_EXIST = "does_not_exist"
+EMAIL_DOMAIN_HAS_NO_MAIL_SERVER = "no_mail_server"
+# Verification timed out, a backend failed, or the mail server gave a temporary (4xx) answer.
+EMAIL_UNVERIFIED = "unverified"
+
+class VerificationBackendError(Exception):
+  """Raised by the DNS and SMTP backends when a lookup fails (times out, the server misbehaves...) instead of giving an answer."""
+
+# Stored in the MX cache for domains that have no mail server, since None means "not cached".
+_NO_MX_RECORD = object()
+
+class DNSResolverBackend:
+  """Looks up MX records with dnspython. lifetime bounds the total time spent on a single lookup, including retries."""
+
+  def __init__(self, lifetime=3.0):
+    self.lifetime = lifetime
+
+  def lookup_mx(self, domain):
+    """Returns the hostname of the highest priority mail server for domain, or None if the domain doesn't exist or has no MX records.
+    Raises VerificationBackendError if the lookup itself fails (for example it times out)."""
+
+    import dns.exception
+    import dns.resolver
+
+    try:
+      records = dns.resolver.resolve(domain, 'MX', lifetime=self.lifetime)
+    except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer):
+      return None
+    except dns.exception.DNSException as exc:
+      raise VerificationBackendError(f"MX lookup for {domain} failed: {exc}") from exc
+
+    best_record = min(records, key=lambda record: record.preference)
+    return str(best_record.exchange).rstrip('.')
+
+class StaticMXResolver:
+  """Resolver backend that answers from a dictionary of domain -> mail server hostname instead of DNS. Used to point the verifier at a
+  local stand-in SMTP server during development and benchmarking."""
+
+  def __init__(self, records):
+    self.records = records
+
+  def lookup_mx(self, domain):
+    return self.records.get(domain)
+
+class SMTPBackend:
+  """Asks a mail server whether it accepts mail for an address, without actually sending an email. timeout applies to connecting and
+  to every individual SMTP command."""
+
+  def __init__(self, from_address='test@example.com', port=25, timeout=5.0):
+    self.from_address = from_address
+    self.port = port
+    self.timeout = timeout
+
+  def check_recipient(self, mx_host, address):
+    """Returns the SMTP reply code to RCPT TO for address, 250 meaning the mail server accepts mail for it. Raises
+    VerificationBackendError if the conversation fails, and OSError if the server can't be reached."""
+
+    import smtplib
+
+    server = smtplib.SMTP(timeout=self.timeout)
+    try:
+      server.connect(mx_host, self.port)
+      server.helo(server.local_hostname)
+      server.mail(self.from_address)
+      code, message = server.rcpt(address)
+    except smtplib.SMTPException as exc:
+      raise VerificationBackendError(f"SMTP conversation with {mx_host} failed: {exc}") from exc
+    finally:
+      try:
+        server.quit()
+      except (smtplib.SMTPException, OSError):
+        server.close()
+
+    return code
+
+class EmailVerifier:
+  """Verifies email addresses on a bounded thread pool, caching MX records per domain and results per address. Used like a Flask
+  extension: create it once, then call init_app(app) to configure it from the app's EMAIL_VERIFICATION_* settings.
+
+  A request never waits on a verification for more than EMAIL_VERIFICATION_TIMEOUT seconds. Verifications that time out keep running in
+  the background and their result is still cached, so retrying the signup form shortly after is instant. Concurrent requests verifying
+  the same address share a single lookup, and once EMAIL_VERIFICATION_MAX_PENDING lookups are in flight new ones are not started at all."""
+
+  def __init__(self, app=None, resolver=None, smtp=None):
+    self.resolver = resolver or DNSResolverBackend()
+    self.smtp = smtp or SMTPBackend()
+    self._executor = None
+    self._in_flight = {}
+    self._lock = threading.Lock()
+    self.configure()
+
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.config.setdefault('EMAIL_VERIFICATION_MAX_WORKERS', 8)
+    app.config.setdefault('EMAIL_VERIFICATION_MAX_PENDING', 64)
+    app.config.setdefault('EMAIL_VERIFICATION_TIMEOUT', 5.0)
+    app.config.setdefault('EMAIL_VERIFICATION_MX_TTL', 3600)
+    app.config.setdefault('EMAIL_VERIFICATION_POSITIVE_TTL', 24 * 3600)
+    app.config.setdefault('EMAIL_VERIFICATION_NEGATIVE_TTL', 3600)
+    app.config.setdefault('EMAIL_VERIFICATION_FAIL_OPEN', True)
+
+    self.configure(
+      max_workers = app.config['EMAIL_VERIFICATION_MAX_WORKERS'],
+      max_pending = app.config['EMAIL_VERIFICATION_MAX_PENDING'],
+      timeout = app.config['EMAIL_VERIFICATION_TIMEOUT'],
+      mx_ttl = app.config['EMAIL_VERIFICATION_MX_TTL'],
+      positive_ttl = app.config['EMAIL_VERIFICATION_POSITIVE_TTL'],
+      negative_ttl = app.config['EMAIL_VERIFICATION_NEGATIVE_TTL'],
+      fail_open = app.config['EMAIL_VERIFICATION_FAIL_OPEN']
+    )
+    app.extensions['email_verifier'] = self
+
+  def configure(self, max_workers=8, max_pending=64, timeout=5.0, mx_ttl=3600, positive_ttl=24 * 3600, negative_ttl=3600,
+                fail_open=True, cache_size=10000):
+    """(Re)configures the verifier, dropping any cached results. fail_open decides whether the signup form accepts an address that
+    couldn't be verified in time."""
+
+    self.shutdown()
+    self.max_workers = max_workers
+    self.max_pending = max_pending
+    self.timeout = timeout
+    self.mx_ttl = mx_ttl
+    self.positive_ttl = positive_ttl
+    self.negative_ttl = negative_ttl
+    self.fail_open = fail_open
+    self.mx_cache = TTLCache(maxsize=cache_size, ttl=mx_ttl)
+    self.address_cache = TTLCache(maxsize=cache_size, ttl=positive_ttl)
+    self.timeouts = 0
+    self.rejected = 0
+
+  def shutdown(self):
+    """Stops the thread pool without waiting for running lookups. A new pool is created the next time an address is verified."""
+
+    with self._lock:
+      if self._executor is not None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+      self._executor = None
+      self._in_flight = {}
+
+  def verify(self, address):
+    """Returns one of EMAIL_EXISTS, EMAIL_DOES_NOT_EXIST, EMAIL_DOMAIN_HAS_NO_MAIL_SERVER or EMAIL_UNVERIFIED for address."""
+
+    key = address.lower()
+    cached_result = self.address_cache.get(key)
+    if cached_result is not None:
+      return cached_result
+
+    started_lookup = False
+    with self._lock:
+      future = self._in_flight.get(key)
+      if future is None:
+        if len(self._in_flight) >= self.max_pending:
+          self.rejected += 1
+          return EMAIL_UNVERIFIED
+        if self._executor is None:
+          # Created lazily so that a pool is never inherited across a fork (e.g. gunicorn --preload).
+          self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='email-verifier')
+        future = self._executor.submit(self._verify_uncached, address)
+        self._in_flight[key] = future
+        started_lookup = True
+
+    # Registered outside the lock because the callback runs immediately (and takes the lock) if the lookup already finished.
+    if started_lookup:
+      future.add_done_callback(lambda finished_future: self._finish(key, finished_future))
+
+    try:
+      return future.result(timeout=self.timeout)
+    except FutureTimeoutError:
+      self.timeouts += 1
+      return EMAIL_UNVERIFIED
+
+  def _finish(self, key, future):
+    """Called once a lookup finishes, even if the request that started it has stopped waiting. Caches definite answers."""
+
+    with self._lock:
+      if self._in_flight.get(key) is future:
+        del self._in_flight[key]
+
+    if future.cancelled() or future.exception() is not None:
+      return
+
+    result = future.result()
+    if result == EMAIL_EXISTS:
+      self.address_cache.set(key, result, ttl=self.positive_ttl)
+    elif result != EMAIL_UNVERIFIED:
+      self.address_cache.set(key, result, ttl=self.negative_ttl)
+
+  def _verify_uncached(self, address):
+    domain = address.rsplit('@', 1)[1].lower()
+
+    try:
+      mx_host = self.mx_cache.get(domain)
+      if mx_host is None:
+        mx_host = self.resolver.lookup_mx(domain) or _NO_MX_RECORD
+        self.mx_cache.set(domain, mx_host, ttl=self.mx_ttl if mx_host is not _NO_MX_RECORD else self.negative_ttl)
+      if mx_host is _NO_MX_RECORD:
+        return EMAIL_DOMAIN_HAS_NO_MAIL_SERVER
+
+      code = self.smtp.check_recipient(mx_host, address)
+    except (VerificationBackendError, OSError) as exc:
+      print(f"ERROR: could not verify email {address}: {exc}")
+      return EMAIL_UNVERIFIED
+
+    if code == 250:
+      return EMAIL_EXISTS
+    if 500 <= code < 600:
+      return EMAIL_DOES_NOT_EXIST
+    # 4xx replies (e.g. greylisting) are temporary, so don't treat them as a definite answer.
+    return EMAIL_UNVERIFIED
+
+  def stats(self):
+    """Counters describing how the verifier has been doing since it was last configured."""
+
+    return {
+      'address_cache_hit_rate': self.address_cache.hit_rate(),
+      'mx_cache_hit_rate': self.mx_cache.hit_rate(),
+      'in_flight': len(self._in_flight),
+      'timeouts': self.timeouts,
+      'rejected': self.rejected
+    }
+
+email_verifier = EmailVerifier()
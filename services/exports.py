@@ -0,0 +1,148 @@
+"""Machine-readable exports of stories and of a user's favorites, bookmarks and comments, as NDJSON (one JSON object per line) or CSV.
+
+Exports can be millions of rows, so they're never loaded into memory: the query runs on a server-side cursor (yield_per) that fetches
+EXPORT_BATCH_SIZE rows at a time, each batch is formatted and handed to the client, and only then is the next one fetched. The queries
+select plain columns rather than ORM objects, so nothing is added to the session's identity map either. Memory use is the same whether an
+export has a hundred rows or ten million; the price is that a database connection is held until the client has downloaded everything.
+So each worker process streams at most EXPORT_MAX_CONCURRENT exports at once (see ExportSlots), and the public story export is also rate
+limited per IP address (see services/rate_limiting.py)."""
+
+import csv
+import io
+import json
+import threading
+from datetime import datetime
+
+from models.init_db import db
+from models.user import User
+from models.story import Story
+from models.story_engagement import StoryEngagement
+from models.favorite import Favorite
+from models.bookmark import Bookmark
+from models.comment import Comment
+
+# Content type of each export format.
+EXPORT_FORMATS = {
+  'ndjson': 'application/x-ndjson',
+  'csv': 'text/csv',
+}
+
+# Rows fetched from the server-side cursor, and formatted and sent to the client, at a time.
+EXPORT_BATCH_SIZE = 1000
+
+def story_export_query(user_id=None, since=None, until=None):
+  """Every story, oldest first, optionally only the ones posted by user_id and/or created in [since, until). Ordered by (created_at, id)
+  so the (created_at, id) indexes return the rows in order without sorting."""
+
+  query = (db.select(Story.id, Story.title, Story.author, Story.url, User.username, Story.created_at,
+                     StoryEngagement.favorite_count, StoryEngagement.bookmark_count, StoryEngagement.comment_count)
+           .join(User, User.id == Story.user_id)
+           .join(StoryEngagement, StoryEngagement.story_id == Story.id))
+  if user_id is not None:
+    query = query.where(Story.user_id == user_id)
+  if since is not None:
+    query = query.where(Story.created_at >= since)
+  if until is not None:
+    query = query.where(Story.created_at < until)
+  return query.order_by(Story.created_at, Story.id)
+
+def marked_stories_export_query(model, user_id):
+  """The stories user_id has favorited or bookmarked (model is Favorite or Bookmark), in story id order, which is the order of the
+  (user_id, story_id) primary key."""
+
+  return (db.select(Story.id.label('story_id'), Story.title, Story.url, model.created_at.label('marked_at'))
+          .join(Story, Story.id == model.story_id)
+          .where(model.user_id == user_id)
+          .order_by(model.story_id))
+
+def comment_export_query(user_id):
+  """The comments written by user_id, oldest first."""
+
+  return (db.select(Comment.id, Comment.story_id, Comment.parent_id, Comment.content, Comment.created_at)
+          .where(Comment.user_id == user_id)
+          .order_by(Comment.id))
+
+USER_ACTIVITY_QUERIES = {
+  'favorites': lambda user_id: marked_stories_export_query(Favorite, user_id),
+  'bookmarks': lambda user_id: marked_stories_export_query(Bookmark, user_id),
+  'comments': comment_export_query,
+}
+
+def _json_default(value):
+  if isinstance(value, datetime):
+    return value.isoformat()
+  raise TypeError(f"{type(value).__name__} can't be exported")
+
+def export_rows(query, export_format, batch_size=EXPORT_BATCH_SIZE):
+  """Generator running query on a server-side cursor and yielding its rows formatted as export_format ('ndjson' or 'csv'), one string per
+  batch of batch_size rows. CSV starts with a header row of the column names. Meant to be the body of a streamed Flask response
+  (wrapped in stream_with_context so the database session outlives the view)."""
+
+  result = db.session.execute(query, execution_options={'yield_per': batch_size})
+  try:
+    columns = list(result.keys())
+    if export_format == 'csv':
+      buffer = io.StringIO()
+      writer = csv.writer(buffer)
+      writer.writerow(columns)
+      for rows in result.partitions():
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+      # The header of an export without rows.
+      if buffer.tell():
+        yield buffer.getvalue()
+    else:
+      for rows in result.partitions():
+        yield ''.join(json.dumps(dict(zip(columns, row)), default=_json_default) + '\n' for row in rows)
+  finally:
+    # Also runs if the client disconnects part way, which releases the cursor.
+    result.close()
+
+class ExportSlots:
+  """Used like a Flask extension: create it once, then call init_app(app) to configure it from the app's EXPORT_* settings:
+
+  EXPORT_MAX_CONCURRENT: exports each worker process streams at once. Every export holds a database connection and a server thread until
+  the client has downloaded it, so without a cap a few slow downloads could take the whole connection pool.
+  EXPORT_RETRY_AFTER: seconds an export turned away because every slot is taken is told to wait before retrying.
+
+  rejected counts the exports turned away since the slots were last configured."""
+
+  def __init__(self, app=None):
+    self.configure()
+
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.config.setdefault('EXPORT_MAX_CONCURRENT', 2)
+    app.config.setdefault('EXPORT_RETRY_AFTER', 30)
+
+    self.configure(
+      max_concurrent = app.config['EXPORT_MAX_CONCURRENT'],
+      retry_after = app.config['EXPORT_RETRY_AFTER']
+    )
+    app.extensions['export_slots'] = self
+
+  def configure(self, max_concurrent=2, retry_after=30):
+    self.max_concurrent = max_concurrent
+    self.retry_after = retry_after
+    self._slots = threading.BoundedSemaphore(max_concurrent)
+    self.rejected = 0
+
+  def acquire(self):
+    """Takes a slot for an export without waiting. Returns whether one was free; if so, release must be called once the export is done."""
+
+    if self._slots.acquire(blocking=False):
+      return True
+    self.rejected += 1
+    return False
+
+  def release(self):
+    self._slots.release()
+
+  def stats(self):
+    return {'max_concurrent': self.max_concurrent, 'rejected': self.rejected}
+
+export_slots = ExportSlots()
@@ -0,0 +1,111 @@
+"""Server-side cache of rendered HTML fragments that are the same for every anonymous visitor, such as the story feed on the logged out
+homepage, so those views don't query the database and re-render the feed on every request.
+
+Every cached fragment is dropped whenever a transaction that added, changed or deleted a story, favorite, bookmark, comment or user
+through db.session commits in this process: ORM changes, bulk statements on those tables, and raw SQL or SELECTs marked as writing
+(execution_options={'writes': True}, see models/routing.py), which count as changes to anything. Dropping them at commit rather than when
+the change is flushed means a request rendering meanwhile can't store a fragment of the old data as current, and a rollback drops
+nothing. Other gunicorn workers keep their fragments until they expire, so FRAGMENT_CACHE_TTL bounds how stale an anonymous page can be."""
+
+import itertools
+import threading
+from datetime import datetime, timezone
+
+from flask import g
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models.user import User
+from models.story import Story
+from models.favorite import Favorite
+from models.bookmark import Bookmark
+from models.comment import Comment
+from services.cache import TTLCache
+
+# Models whose changes can show up in a cached fragment.
+FRAGMENT_MODELS = (User, Story, Favorite, Bookmark, Comment)
+FRAGMENT_TABLES = {model.__table__ for model in FRAGMENT_MODELS}
+
+class FragmentCache:
+  """Used like a Flask extension: create it once, then call init_app(app) to configure it from the app's FRAGMENT_CACHE_SIZE and
+  FRAGMENT_CACHE_TTL settings."""
+
+  def __init__(self, app=None):
+    self._generation = 0
+    self._lock = threading.Lock()
+    self.configure()
+
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.config.setdefault('FRAGMENT_CACHE_SIZE', 256)
+    app.config.setdefault('FRAGMENT_CACHE_TTL', 30)
+
+    self.configure(app.config['FRAGMENT_CACHE_SIZE'], app.config['FRAGMENT_CACHE_TTL'])
+    app.extensions['fragment_cache'] = self
+
+  def configure(self, maxsize=256, ttl=30):
+    self.fragments = TTLCache(maxsize=maxsize, ttl=ttl)
+
+  def get_or_render(self, key, render):
+    """Returns the cached fragment for key, calling render() to produce (and cache) it if there isn't one. Also records in
+    g.last_modified when the newest fragment used by this request was rendered, which becomes the page's Last-Modified header."""
+
+    # Fragments are stored per generation, so invalidate() only has to bump the generation number.
+    generation_key = (self._generation, key)
+    cached = self.fragments.get(generation_key)
+    if cached is None:
+      rendered_at = datetime.now(timezone.utc).replace(microsecond=0)
+      cached = (rendered_at, Markup(render()))
+      self.fragments.set(generation_key, cached)
+
+    rendered_at, fragment = cached
+    if g.get('last_modified') is None or rendered_at > g.last_modified:
+      g.last_modified = rendered_at
+    return fragment
+
+  def invalidate(self):
+    """Drops every cached fragment."""
+
+    with self._lock:
+      self._generation += 1
+    self.fragments.clear()
+
+  def stats(self):
+    return {'fragments': len(self.fragments), 'hit_rate': self.fragments.hit_rate()}
+
+fragment_cache = FragmentCache()
+
+# Key in session.info set once the session's current transaction has changed something fragments are rendered from.
+FRAGMENTS_CHANGED = 'fragments_changed'
+
+@event.listens_for(Session, 'after_flush')
+def note_flushed_changes(session, flush_context):
+  changed_objects = itertools.chain(session.new, session.dirty, session.deleted)
+  if any(isinstance(changed_object, FRAGMENT_MODELS) for changed_object in changed_objects):
+    session.info[FRAGMENTS_CHANGED] = True
+
+@event.listens_for(Session, 'do_orm_execute')
+def note_executed_changes(orm_execute_state):
+  """Statements executed directly rather than through a flush: bulk INSERT/UPDATE/DELETE on one of the models' tables, and raw SQL or
+  writing SELECTs, whose tables aren't known."""
+
+  if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+    if orm_execute_state.statement.table not in FRAGMENT_TABLES:
+      return
+  elif orm_execute_state.is_select and not orm_execute_state.execution_options.get('writes'):
+    return
+  orm_execute_state.session.info[FRAGMENTS_CHANGED] = True
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_fragments_after_commit(session):
+  """Drops cached fragments once changes to any model that fragments are rendered from are committed."""
+
+  if session.info.pop(FRAGMENTS_CHANGED, False):
+    fragment_cache.invalidate()
+
+@event.listens_for(Session, 'after_rollback')
+def forget_rolled_back_changes(session):
+  session.info.pop(FRAGMENTS_CHANGED, None)
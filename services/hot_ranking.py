@@ -0,0 +1,87 @@
+"""Background job that periodically rebases the stored hot scores (see models/hot_ranking.py) so they never grow large enough to lose
+precision or overflow. Every HOT_RANKING_REBASE_INTERVAL seconds each worker process checks whether the epoch is older than
+HOT_RANKING_REBASE_AFTER seconds and, if so, rebases. Rebases take an exclusive database lock, so with several gunicorn workers only the
+first one to get there rebases and the others find a fresh epoch.
+
+Rebasing rewrites every non-zero score and makes favoriting, bookmarking and commenting wait until it's done, which is why it only
+happens every few days: a week's worth of growth is a factor of 2^14 with the default 12 hour half-life, nowhere near a problem."""
+
+import os
+import threading
+import time
+from datetime import timedelta
+
+from models.init_db import db
+from models.hot_ranking import rebase_hot_scores
+
+class HotRankingRebaser:
+  """Used like a Flask extension: create it once, then call init_app(app) to configure it from the app's HOT_RANKING_* settings. The
+  background thread is started by the first request each process serves, not by init_app: threads don't survive a fork, so one started
+  while gunicorn --preload builds the app in the master process would run in the master rather than the workers. Setting
+  HOT_RANKING_REBASE_INTERVAL to 0 disables the thread (testing always does), in which case run_once can be called from a cron job
+  instead."""
+
+  def __init__(self, app=None):
+    self.app = None
+    self._thread = None
+    self._thread_pid = None
+    self._start_lock = threading.Lock()
+    self._stopping = threading.Event()
+    self.rebases = 0
+    self.last_rebase_seconds = 0.0
+
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.config.setdefault('HOT_RANKING_REBASE_INTERVAL', 3600)
+    app.config.setdefault('HOT_RANKING_REBASE_AFTER', 7 * 24 * 3600)
+
+    self.app = app
+    app.extensions['hot_ranking_rebaser'] = self
+    if app.config['HOT_RANKING_REBASE_INTERVAL'] and not app.testing:
+      app.before_request(self._start_in_this_process)
+
+  def _start_in_this_process(self):
+    # One comparison per request once the thread is running.
+    if self._thread_pid != os.getpid():
+      self.start()
+
+  def start(self):
+    with self._start_lock:
+      if self._thread_pid == os.getpid() and self._thread.is_alive():
+        return
+      self._stopping.clear()
+      self._thread = threading.Thread(target=self._run, name='hot-ranking-rebaser', daemon=True)
+      self._thread_pid = os.getpid()
+      self._thread.start()
+
+  def stop(self):
+    self._stopping.set()
+
+  def _run(self):
+    # Waits first, so short-lived processes like seed.py never touch the scores.
+    while not self._stopping.wait(self.app.config['HOT_RANKING_REBASE_INTERVAL']):
+      self.run_once()
+
+  def run_once(self):
+    """Rebases the scores if the epoch is old enough. Returns whether it did."""
+
+    with self.app.app_context():
+      start = time.perf_counter()
+      try:
+        rebased = rebase_hot_scores(min_age=timedelta(seconds=self.app.config['HOT_RANKING_REBASE_AFTER']))
+        db.session.commit()
+      except Exception as exc:
+        db.session.rollback()
+        print(f"ERROR: rebasing hot scores failed: {exc}")
+        return False
+      finally:
+        db.session.remove()
+
+    if rebased:
+      self.rebases += 1
+      self.last_rebase_seconds = time.perf_counter() - start
+    return rebased
+
+hot_ranking_rebaser = HotRankingRebaser()
@@ -0,0 +1,124 @@
+"""HTTP caching for the app's responses, replacing the old blanket no-cache headers.
+
+Static files are served from content-hashed URLs (url_for('static', ...) adds ?v=<hash of the file>), so they can be cached by browsers
+and the CDN for a year and marked immutable; a changed file gets a new URL. Only a version matching the file's current contents gets that:
+static URLs without one (e.g. hard-coded ones) or with a stale or made up one are cached for STATIC_UNVERSIONED_MAX_AGE seconds and
+revalidated with the ETag/Last-Modified that Flask already sends for files, so an old URL never pins new contents for a year.
+
+HTML pages get an ETag so that browsers revalidating a page they already have receive an empty 304 response. Pages for logged in users,
+and any page whose session holds something (flash messages, a CSRF token), are marked private so shared caches never store them. Forms
+embed a CSRF token signed with the time it was made, which would make every rendering of a page with forms different, so the ETag is
+computed without it (see page_etag).
+Redirects and responses to anything other than GET/HEAD are never cached."""
+
+import hashlib
+import os
+import time
+
+from flask import current_app, request, session, g
+from werkzeug.http import generate_etag
+
+# One year, the longest max-age browsers honor.
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+class HTTPCaching:
+  """Used like a Flask extension: create it once, then call init_app(app) to register its hooks on the app."""
+
+  def __init__(self, app=None):
+    self._file_versions = {}
+
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.config.setdefault('STATIC_UNVERSIONED_MAX_AGE', 3600)
+    self._file_versions = {}
+
+    app.url_defaults(self.add_static_file_version)
+    app.after_request(self.add_cache_headers)
+    app.extensions['http_caching'] = self
+
+  def static_file_version(self, static_folder, filename):
+    """Returns a short hash of the contents of a static file, or None if it doesn't exist. Hashes are remembered per file modification
+    time, so a file is only read again after it changes. It's the start of the file's SHA-256, like the names of profile picture
+    thumbnails (see services/profile_pictures.py), so a thumbnail's version is its name."""
+
+    path = os.path.join(static_folder, filename)
+    try:
+      modified_at = os.stat(path).st_mtime_ns
+    except OSError:
+      return None
+
+    cached = self._file_versions.get(path)
+    if cached is not None and cached[0] == modified_at:
+      return cached[1]
+
+    with open(path, 'rb') as static_file:
+      version = hashlib.sha256(static_file.read()).hexdigest()[:12]
+    self._file_versions[path] = (modified_at, version)
+    return version
+
+  def add_static_file_version(self, endpoint, values):
+    """url_defaults hook: url_for('static', filename=...) becomes /static/<filename>?v=<hash of the file>."""
+
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+      version = self.static_file_version(current_app.static_folder, values['filename'])
+      if version is not None:
+        values['v'] = version
+
+  def is_current_version(self, response):
+    """Whether the static file response was requested with ?v= set to the file's current version."""
+
+    # Flask only serves (or answers 304 for) files it found inside the static folder, so filename is safe to look up then.
+    version = request.args.get('v')
+    if not version or response.status_code not in (200, 304):
+      return False
+    return version == self.static_file_version(current_app.static_folder, request.view_args['filename'])
+
+  def add_cache_headers(self, response):
+    """after_request hook that decides how each response may be cached."""
+
+    if request.endpoint == 'static':
+      response.cache_control.no_cache = None
+      if self.is_current_version(response):
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+      else:
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['STATIC_UNVERSIONED_MAX_AGE']
+      return response
+
+    if request.method not in ('GET', 'HEAD') or response.status_code != 200 or response.is_streamed:
+      response.cache_control.no_store = True
+      return response
+
+    # Whether a page is personal depends on the session cookie, so shared caches must key on it.
+    response.vary.add('Cookie')
+    if g.get('user') is not None or session:
+      response.cache_control.private = True
+    else:
+      response.cache_control.public = True
+      if g.get('last_modified') is not None:
+        response.last_modified = g.last_modified
+    # Caches may keep the page but must check it's still current (a cheap 304 if it is) before reusing it.
+    response.cache_control.no_cache = True
+
+    response.set_etag(self.page_etag(response))
+    return response.make_conditional(request)
+
+  def page_etag(self, response):
+    """ETag of a page's body, with the signed CSRF token its forms embed (the one Flask-WTF made for this request) replaced by the
+    session's raw token it was signed from, which only changes with the session. So that a page reused after a 304 never holds an expired
+    token, the ETag also changes every half of WTF_CSRF_TIME_LIMIT: the token of a page that's still current is never older than that."""
+
+    body = response.get_data()
+    field_name = current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')
+    signed_token = g.get(field_name)
+    if signed_token:
+      time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+      period = int(time.time() // (time_limit / 2)) if time_limit else 0
+      body = body.replace(signed_token.encode('ascii'), f"{session.get(field_name)}:{period}".encode('ascii'))
+    return generate_etag(body)
+
+http_caching = HTTPCaching()
@@ -0,0 +1,213 @@
+"""Request-level performance instrumentation. For every request it measures the wall time, the number of SQL queries and the time spent
+in the database (through SQLAlchemy engine events), and aggregates them per view function. Queries slower than SLOW_QUERY_SECONDS are
+logged, a random PROFILE_SAMPLE_RATE fraction of requests run under cProfile and have their profile logged if they turn out slower than
+SLOW_REQUEST_SECONDS, and everything is exposed at METRICS_ENDPOINT in the Prometheus text format. The metrics show how every page and
+the database are doing, so with METRICS_TOKEN set only scrapers sending it as a bearer token (Authorization: Bearer <token>) get them,
+and in production the endpoint only exists once a token is set. With SERVER_TIMING_HEADER set, each
+response also reports its own numbers in a Server-Timing header (shown by browsers' developer tools, and read by the load tests in
+benchmarks/load_test.py); it's off by default since it tells anyone how the database is doing.
+
+Metrics are kept per process, so with several gunicorn workers each one reports its own numbers (Prometheus adds them up)."""
+
+import cProfile
+import hmac
+import io
+import pstats
+import random
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds (in seconds) of the request duration histogram buckets.
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class EndpointStats:
+  """Totals for every request handled by one view function."""
+
+  def __init__(self):
+    self.requests_by_status = defaultdict(int)
+    self.duration_buckets = [0] * len(DURATION_BUCKETS)
+    self.duration_sum = 0.0
+    self.query_count = 0
+    self.db_seconds = 0.0
+
+  @property
+  def request_count(self):
+    return sum(self.requests_by_status.values())
+
+class RequestInstrumentation:
+  """Used like a Flask extension: create it once, then call init_app(app) to register its hooks and metrics endpoint. Metrics of other
+  services can be added to the metrics output: gauges (e.g. cache hit rates or queue depths) with add_gauge, and counters (totals that
+  only go up, like fetches or rejections) with add_counter."""
+
+  def __init__(self, app=None):
+    self._lock = threading.Lock()
+    self.endpoints = defaultdict(EndpointStats)
+    self.slow_queries = 0
+    self.profiled_requests = 0
+    # {name: (type, help text, function returning the value)} of the metrics added by other services.
+    self.service_metrics = {}
+
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.config.setdefault('SLOW_QUERY_SECONDS', 0.2)
+    app.config.setdefault('SLOW_REQUEST_SECONDS', 1.0)
+    app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+    app.config.setdefault('METRICS_ENDPOINT', '/metrics')
+    app.config.setdefault('METRICS_TOKEN', None)
+    app.config.setdefault('SERVER_TIMING_HEADER', False)
+
+    app.before_request(self.start_request)
+    app.after_request(self.finish_request)
+    if app.config['METRICS_ENDPOINT'] and (app.config['METRICS_TOKEN'] or not app.config.get('PRODUCTION')):
+      app.add_url_rule(app.config['METRICS_ENDPOINT'], 'metrics', self.metrics_view)
+    app.extensions['instrumentation'] = self
+
+  def add_gauge(self, name, help_text, get_value):
+    """Adds a gauge called name to the metrics output, whose value is get_value() at the time the metrics are scraped."""
+    self.service_metrics[name] = ('gauge', help_text, get_value)
+
+  def add_counter(self, name, help_text, get_value):
+    """Adds a counter called name to the metrics output, whose value is get_value() at the time the metrics are scraped. The value must
+    only ever go up, except for going back to 0 (e.g. when the process restarts), which Prometheus treats as a counter reset."""
+    self.service_metrics[name] = ('counter', help_text, get_value)
+
+  def start_request(self):
+    g.perf_start = time.perf_counter()
+    g.perf_query_count = 0
+    g.perf_db_seconds = 0.0
+    g.perf_profiler = None
+
+    sample_rate = current_app.config['PROFILE_SAMPLE_RATE']
+    if sample_rate and random.random() < sample_rate:
+      g.perf_profiler = cProfile.Profile()
+      g.perf_profiler.enable()
+
+  def finish_request(self, response):
+    if 'perf_start' not in g:
+      return response
+
+    duration = time.perf_counter() - g.perf_start
+    endpoint = request.endpoint or 'unmatched'
+
+    profiler = g.pop('perf_profiler', None)
+    if profiler is not None:
+      profiler.disable()
+      if duration >= current_app.config['SLOW_REQUEST_SECONDS']:
+        self.log_profile(profiler, endpoint, duration)
+
+    with self._lock:
+      stats = self.endpoints[endpoint]
+      stats.requests_by_status[(request.method, response.status_code)] += 1
+      for bucket_index, upper_bound in enumerate(DURATION_BUCKETS):
+        if duration <= upper_bound:
+          stats.duration_buckets[bucket_index] += 1
+      stats.duration_sum += duration
+      stats.query_count += g.perf_query_count
+      stats.db_seconds += g.perf_db_seconds
+
+    if current_app.config['SERVER_TIMING_HEADER']:
+      response.headers['Server-Timing'] = (f'app;dur={duration * 1000:.2f}, '
+                                            f'db;dur={g.perf_db_seconds * 1000:.2f};desc="{g.perf_query_count} queries"')
+    return response
+
+  def log_profile(self, profiler, endpoint, duration):
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(25)
+    with self._lock:
+      self.profiled_requests += 1
+    current_app.logger.warning(f"Slow request to {endpoint} ({duration * 1000:.0f} ms) profile:\n{output.getvalue()}")
+
+  def record_query(self, statement, duration):
+    """Called after every SQL statement. Adds it to the current request's totals and logs it if it was slow."""
+
+    if not has_request_context():
+      return
+
+    g.perf_query_count = g.get('perf_query_count', 0) + 1
+    g.perf_db_seconds = g.get('perf_db_seconds', 0.0) + duration
+    if duration >= current_app.config['SLOW_QUERY_SECONDS']:
+      with self._lock:
+        self.slow_queries += 1
+      current_app.logger.warning(f"Slow query in {request.endpoint} ({duration * 1000:.0f} ms): {statement}")
+
+  def metrics_view(self):
+    """Prometheus text exposition of the per-view metrics, for callers with the METRICS_TOKEN if one is set."""
+
+    token = current_app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+      return Response("Metrics need the metrics token\n", status=401, mimetype='text/plain',
+                      headers={'WWW-Authenticate': 'Bearer realm="metrics"'})
+    return Response(self.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+  def render_metrics(self):
+    lines = [
+      "# HELP hackornews_requests_total Requests handled, by view function, method and status code.",
+      "# TYPE hackornews_requests_total counter",
+    ]
+    with self._lock:
+      endpoints = sorted(self.endpoints.items())
+      for endpoint, stats in endpoints:
+        for (method, status), count in sorted(stats.requests_by_status.items()):
+          lines.append(f'hackornews_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+
+      lines += [
+        "# HELP hackornews_request_duration_seconds Wall time of requests, by view function.",
+        "# TYPE hackornews_request_duration_seconds histogram",
+      ]
+      for endpoint, stats in endpoints:
+        for upper_bound, count in zip(DURATION_BUCKETS, stats.duration_buckets):
+          lines.append(f'hackornews_request_duration_seconds_bucket{{endpoint="{endpoint}",le="{upper_bound}"}} {count}')
+        lines.append(f'hackornews_request_duration_seconds_bucket{{endpoint="{endpoint}",le="+Inf"}} {stats.request_count}')
+        lines.append(f'hackornews_request_duration_seconds_sum{{endpoint="{endpoint}"}} {stats.duration_sum:.6f}')
+        lines.append(f'hackornews_request_duration_seconds_count{{endpoint="{endpoint}"}} {stats.request_count}')
+
+      lines += [
+        "# HELP hackornews_request_queries_total SQL queries run while handling requests, by view function.",
+        "# TYPE hackornews_request_queries_total counter",
+      ]
+      lines += [f'hackornews_request_queries_total{{endpoint="{endpoint}"}} {stats.query_count}' for endpoint, stats in endpoints]
+      lines += [
+        "# HELP hackornews_request_db_seconds_total Time spent running SQL queries while handling requests, by view function.",
+        "# TYPE hackornews_request_db_seconds_total counter",
+      ]
+      lines += [f'hackornews_request_db_seconds_total{{endpoint="{endpoint}"}} {stats.db_seconds:.6f}' for endpoint, stats in endpoints]
+      lines += [
+        "# HELP hackornews_slow_queries_total Queries slower than SLOW_QUERY_SECONDS.",
+        "# TYPE hackornews_slow_queries_total counter",
+        f"hackornews_slow_queries_total {self.slow_queries}",
+        "# HELP hackornews_profiled_slow_requests_total Sampled requests whose cProfile output was logged for being slow.",
+        "# TYPE hackornews_profiled_slow_requests_total counter",
+        f"hackornews_profiled_slow_requests_total {self.profiled_requests}",
+      ]
+
+    for name, (metric_type, help_text, get_value) in sorted(self.service_metrics.items()):
+      lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}", f"{name} {get_value()}"]
+
+    return '\n'.join(lines) + '\n'
+
+instrumentation = RequestInstrumentation()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+  conn.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+  start_times = conn.info.get('query_start_times')
+  if start_times:
+    instrumentation.record_query(statement, time.perf_counter() - start_times.pop())
+
+@event.listens_for(Engine, 'handle_error')
+def discard_query_timer(exception_context):
+  """A failed statement never reaches after_cursor_execute, so drop its start time to keep the timers paired up."""
+
+  connection = exception_context.connection
+  if connection is not None and connection.info.get('query_start_times'):
+    connection.info['query_start_times'].pop()
@@ -0,0 +1,279 @@
+"""Background fetcher that enriches story links with what's at the URL: the page's title, description and favicon, and whether the link
+is dead. Views never fetch anything; they show whatever is in the link_metadata table (models/link_metadata.py), which the database
+queues new URLs into as stories are posted.
+
+Each worker process runs a thread that claims a batch of due URLs, fetches them on a bounded thread pool with hard timeouts, and saves
+the results. Fetching is polite across all the processes, since the database enforces it when URLs are claimed: at most one request at
+a time to each domain, and LINK_METADATA_DOMAIN_DELAY seconds between the end of one request to a domain and the start of the next,
+while other domains are fetched in parallel. Results are cached for LINK_METADATA_TTL
+and then revalidated with the ETag/Last-Modified of the last response, so an unchanged page costs a 304. Failures are retried with
+exponential backoff and a link that keeps failing, or answers 404/410, is marked dead. Cached anonymous pages (services/fragment_cache.py)
+pick up new metadata when they expire.
+
+Story URLs are user input, so fetches only go to public addresses (see services/outbound_http.py) unless
+LINK_METADATA_ALLOW_PRIVATE_ADDRESSES is set, e.g. for a local stand-in server. Like the email verifier, it uses requests on threads
+rather than an async client."""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+
+from models.init_db import db
+from models.hot_ranking import utc_now
+from models.link_metadata import LinkMetadata, LinkDomain
+from services.outbound_http import UnsafeURL, get_checked
+
+# How long a claimed URL, and its domain, are hidden from other processes' fetchers while this one works on it.
+CLAIM_LEASE = timedelta(minutes=10)
+# A link is considered dead once this many fetches in a row failed (or as soon as it answers 404 or 410).
+DEAD_AFTER_FAILURES = 5
+# Longest stored title and description.
+MAX_TEXT_LENGTH = 500
+
+class PageMetadataParser(HTMLParser):
+  """Collects the title, description and favicon link of an HTML page."""
+
+  def __init__(self):
+    super().__init__(convert_charrefs=True)
+    self.title = None
+    self.description = None
+    self.favicon_href = None
+    self._in_title = False
+    self._title_parts = []
+
+  def handle_starttag(self, tag, attrs):
+    attrs = {name: value or '' for name, value in attrs}
+    if tag == 'title' and self.title is None:
+      self._in_title = True
+    elif tag == 'meta':
+      name = (attrs.get('name') or attrs.get('property') or '').lower()
+      if name == 'og:title' and attrs.get('content'):
+        self.title = attrs['content']
+      elif name in ('description', 'og:description') and attrs.get('content') and self.description is None:
+        self.description = attrs['content']
+    elif tag == 'link' and 'icon' in attrs.get('rel', '').lower().split() and attrs.get('href') and self.favicon_href is None:
+      self.favicon_href = attrs['href']
+
+  def handle_data(self, data):
+    if self._in_title:
+      self._title_parts.append(data)
+
+  def handle_endtag(self, tag):
+    if tag == 'title' and self._in_title:
+      self._in_title = False
+      if self.title is None:
+        self.title = ''.join(self._title_parts)
+
+def clean_text(text):
+  if not text:
+    return None
+  return ' '.join(text.split())[:MAX_TEXT_LENGTH] or None
+
+def decode_page(body, encoding):
+  """Decodes a page body in the charset the server declared, or as UTF-8 if it declared none or one Python doesn't know."""
+
+  try:
+    return body.decode(encoding or 'utf-8', errors='replace')
+  except LookupError:
+    return body.decode('utf-8', errors='replace')
+
+class LinkMetadataFetcher:
+  """Used like a Flask extension: create it once, then call init_app(app) to configure it from the app's LINK_METADATA_* settings. As
+  with the hot ranking rebaser, the thread is started by the first request each process serves. Setting LINK_METADATA_FETCH_INTERVAL to
+  0 disables it (testing always does); run_once can then be called from a cron job or a benchmark instead.
+
+  fetched, not_modified and failed count fetches since the fetcher was last configured; last_batch_* describe the most recent batch."""
+
+  def __init__(self, app=None):
+    self.app = None
+    self._thread = None
+    self._thread_pid = None
+    self._start_lock = threading.Lock()
+    self._stopping = threading.Event()
+    self.configure()
+
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.config.setdefault('LINK_METADATA_FETCH_INTERVAL', 60)
+    app.config.setdefault('LINK_METADATA_BATCH_SIZE', 200)
+    app.config.setdefault('LINK_METADATA_WORKERS', 16)
+    app.config.setdefault('LINK_METADATA_DOMAIN_DELAY', 1.0)
+    app.config.setdefault('LINK_METADATA_TIMEOUT', 5.0)
+    app.config.setdefault('LINK_METADATA_MAX_BYTES', 256 * 1024)
+    app.config.setdefault('LINK_METADATA_TTL', 7 * 24 * 3600)
+    app.config.setdefault('LINK_METADATA_RETRY_AFTER', 15 * 60)
+    app.config.setdefault('LINK_METADATA_ALLOW_PRIVATE_ADDRESSES', False)
+    app.config.setdefault('LINK_METADATA_USER_AGENT', 'Hack-or-News-2 link preview')
+
+    self.configure(
+      batch_size = app.config['LINK_METADATA_BATCH_SIZE'],
+      workers = app.config['LINK_METADATA_WORKERS'],
+      domain_delay = app.config['LINK_METADATA_DOMAIN_DELAY'],
+      timeout = app.config['LINK_METADATA_TIMEOUT'],
+      max_bytes = app.config['LINK_METADATA_MAX_BYTES'],
+      ttl = app.config['LINK_METADATA_TTL'],
+      retry_after = app.config['LINK_METADATA_RETRY_AFTER'],
+      allow_private_addresses = app.config['LINK_METADATA_ALLOW_PRIVATE_ADDRESSES'],
+      user_agent = app.config['LINK_METADATA_USER_AGENT']
+    )
+    self.app = app
+    app.extensions['link_metadata_fetcher'] = self
+    if app.config['LINK_METADATA_FETCH_INTERVAL'] and not app.testing:
+      app.before_request(self._start_in_this_process)
+
+  def configure(self, batch_size=200, workers=16, domain_delay=1.0, timeout=5.0, max_bytes=256 * 1024, ttl=7 * 24 * 3600,
+                retry_after=15 * 60, allow_private_addresses=False, user_agent='Hack-or-News-2 link preview'):
+    self.batch_size = batch_size
+    self.workers = workers
+    self.domain_delay = domain_delay
+    self.timeout = timeout
+    self.max_bytes = max_bytes
+    self.ttl = timedelta(seconds=ttl)
+    self.retry_after = timedelta(seconds=retry_after)
+    self.allow_private_addresses = allow_private_addresses
+    self.user_agent = user_agent
+    self.fetched = 0
+    self.not_modified = 0
+    self.failed = 0
+    self.last_batch_size = 0
+    self.last_batch_seconds = 0.0
+
+  def _start_in_this_process(self):
+    if self._thread_pid != os.getpid():
+      self.start()
+
+  def start(self):
+    with self._start_lock:
+      if self._thread_pid == os.getpid() and self._thread.is_alive():
+        return
+      self._stopping.clear()
+      self._thread = threading.Thread(target=self._run, name='link-metadata-fetcher', daemon=True)
+      self._thread_pid = os.getpid()
+      self._thread.start()
+
+  def stop(self):
+    self._stopping.set()
+
+  def _run(self):
+    # A batch takes one URL per domain, so while there were URLs due the next batch starts as soon as the domains just fetched may be
+    # asked again.
+    wait_seconds = self.app.config['LINK_METADATA_FETCH_INTERVAL']
+    while not self._stopping.wait(wait_seconds):
+      claimed = self.run_once()
+      wait_seconds = self.domain_delay if claimed else self.app.config['LINK_METADATA_FETCH_INTERVAL']
+
+  def run_once(self):
+    """Claims up to batch_size due URLs, at most one per domain, fetches them and saves the results. Their domains may be asked again
+    domain_delay seconds later. Returns the number of URLs claimed. No database connection is held while fetching."""
+
+    with self.app.app_context():
+      try:
+        links = LinkMetadata.claim_due(self.batch_size, CLAIM_LEASE)
+        db.session.commit()
+        if not links:
+          return 0
+
+        start = time.perf_counter()
+        results = self.fetch_all(links)
+        self.last_batch_size = len(links)
+        self.last_batch_seconds = time.perf_counter() - start
+
+        LinkMetadata.store(results)
+        LinkDomain.release({link.domain for link in links}, timedelta(seconds=self.domain_delay))
+        db.session.commit()
+        return len(links)
+      except Exception as exc:
+        db.session.rollback()
+        print(f"ERROR: fetching link metadata failed: {exc}")
+        return 0
+      finally:
+        db.session.remove()
+
+  def fetch_all(self, links):
+    """Fetches links (ClaimedLinks, each from a different domain) on the thread pool. Returns the results to store."""
+
+    with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='link-metadata') as executor:
+      return list(executor.map(self.fetch, links))
+
+  def fetch(self, link):
+    """Fetches one ClaimedLink and returns the column values to store for it. Never raises: whatever goes wrong, with the URL, the server
+    or the page, counts as a failed fetch, so one bad link can't lose the rest of the batch."""
+
+    import requests
+
+    now = utc_now()
+    try:
+      return self._fetch(link, now)
+    except (UnsafeURL, requests.RequestException, OSError) as exc:
+      return self._failure(link, now, None, f"{type(exc).__name__}: {exc}")
+    except Exception as exc:
+      print(f"ERROR: fetching link metadata for {link.url} failed: {exc!r}")
+      return self._failure(link, now, None, f"{type(exc).__name__}: {exc}")
+
+  def _fetch(self, link, now):
+    final_url, response = self._get(link)
+    try:
+      body = response.raw.read(self.max_bytes, decode_content=True) if response.status_code == 200 else b''
+    finally:
+      response.close()
+
+    status_code = response.status_code
+    if status_code == 304:
+      self.not_modified += 1
+      return {'url': link.url, 'fetched_at': now, 'expires_at': now + self.ttl, 'failures': 0, 'error': None}
+    if status_code == 429 or status_code >= 500:
+      return self._failure(link, now, status_code, f"HTTP {status_code}")
+
+    self.fetched += 1
+    result = {'url': link.url, 'status_code': status_code, 'is_dead': status_code in (404, 410), 'fetched_at': now,
+              'expires_at': now + self.ttl, 'failures': 0, 'error': None, 'title': None, 'description': None, 'favicon_url': None,
+              'etag': None, 'last_modified': None}
+    if status_code == 200:
+      result.update(etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'))
+      if 'html' in response.headers.get('Content-Type', 'text/html'):
+        parser = PageMetadataParser()
+        parser.feed(decode_page(body, response.encoding))
+        result.update(title=clean_text(parser.title), description=clean_text(parser.description),
+                      favicon_url=urljoin(final_url, parser.favicon_href or '/favicon.ico'))
+    return result
+
+  def _failure(self, link, now, status_code, error):
+    """Result of a failed fetch: retried after retry_after, doubling with every failure in a row up to the ttl, and dead after
+    DEAD_AFTER_FAILURES of them. The metadata from the last successful fetch is kept."""
+
+    self.failed += 1
+    failures = link.failures + 1
+    retry_after = min(self.ttl, self.retry_after * 2 ** min(failures - 1, 16))
+    result = {'url': link.url, 'fetched_at': now, 'expires_at': now + retry_after, 'failures': failures, 'error': error[:500]}
+    if status_code is not None:
+      result['status_code'] = status_code
+    if failures >= DEAD_AFTER_FAILURES:
+      result['is_dead'] = True
+    return result
+
+  def _get(self, link):
+    """GETs link.url, conditionally if there are validators from the last fetch. Returns (final URL, streamed response)."""
+
+    headers = {'User-Agent': self.user_agent, 'Accept': 'text/html,application/xhtml+xml;q=0.9,*/*;q=0.5'}
+    if link.etag:
+      headers['If-None-Match'] = link.etag
+    if link.last_modified:
+      headers['If-Modified-Since'] = link.last_modified
+    return get_checked(link.url, headers, self.timeout, self.allow_private_addresses)
+
+  def stats(self):
+    return {
+      'fetched': self.fetched,
+      'not_modified': self.not_modified,
+      'failed': self.failed,
+      'last_batch_size': self.last_batch_size,
+      'last_batch_seconds': self.last_batch_seconds,
+    }
+
+link_metadata_fetcher = LinkMetadataFetcher()
@@ -0,0 +1,42 @@
+"""Lightweight in-process metrics shared by the services in this folder. Kept per worker process and cheap enough to update on every
+call, so they can stay enabled in production."""
+
+import threading
+from collections import deque
+
+class LatencyStats:
+  """Running count, total and maximum of a latency (in seconds), plus the most recent samples for estimating percentiles."""
+
+  def __init__(self, recent_samples=1024):
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+    self._recent = deque(maxlen=recent_samples)
+    self._lock = threading.Lock()
+
+  def observe(self, seconds):
+    with self._lock:
+      self.count += 1
+      self.total += seconds
+      if seconds > self.max:
+        self.max = seconds
+      self._recent.append(seconds)
+
+  def percentile(self, fraction):
+    """Returns the given percentile (0.0 - 1.0) of the recent samples, or 0.0 if nothing has been observed yet."""
+
+    with self._lock:
+      samples = sorted(self._recent)
+    if not samples:
+      return 0.0
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+  def summary(self):
+    return {
+      'count': self.count,
+      'mean': self.total / self.count if self.count else 0.0,
+      'p50': self.percentile(0.50),
+      'p95': self.percentile(0.95),
+      'p99': self.percentile(0.99),
+      'max': self.max
+    }
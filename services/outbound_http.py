@@ -0,0 +1,110 @@
+"""Requests to URLs that users gave us (story links, profile pictures), made by the background fetchers. Such a URL could point at the
+server's own network, e.g. a database or a cloud metadata endpoint, so unless private addresses are explicitly allowed (for a local
+stand-in server), every URL and every redirect hop has to resolve to public addresses only. The connection then goes to the address that
+was checked, not to whatever a second lookup of the name returns, so a host that changes its DNS answer in between (DNS rebinding) can't
+slip a private address in.
+
+requests is only imported once something is fetched, keeping it out of worker startup."""
+
+import ipaddress
+import socket
+import threading
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+MAX_REDIRECTS = 5
+
+class UnsafeURL(Exception):
+  """Raised for URLs that are never requested: not http(s), or pointing at a private, loopback or otherwise non-public address."""
+
+def resolve_checked(url, allow_private_addresses=False):
+  """Returns the addresses url's host resolves to. Raises UnsafeURL unless url is http(s) and, unless allow_private_addresses, its host
+  only resolves to public addresses."""
+
+  parts = urlsplit(url)
+  if parts.scheme not in ('http', 'https') or not parts.hostname:
+    raise UnsafeURL(f"not an http(s) URL: {url}")
+  try:
+    addresses = socket.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80), type=socket.SOCK_STREAM)
+  except socket.gaierror as exc:
+    raise UnsafeURL(f"can't resolve {parts.hostname}: {exc}") from exc
+  except ValueError as exc:
+    # An invalid port, e.g. http://example.com:99999/
+    raise UnsafeURL(f"not a valid URL: {url}") from exc
+  checked = []
+  for family, type, proto, canonname, sockaddr in addresses:
+    address = ipaddress.ip_address(sockaddr[0].split('%')[0])
+    if not address.is_global and not allow_private_addresses:
+      raise UnsafeURL(f"{parts.hostname} resolves to the non-public address {sockaddr[0]}")
+    checked.append(address)
+  if not checked:
+    raise UnsafeURL(f"can't resolve {parts.hostname}")
+  return checked
+
+def pinned_url(url, address):
+  """Returns url with its host name replaced by address, and the Host header to send with it. URLs whose host already is an address are
+  returned as they are, with no header."""
+
+  parts = urlsplit(url)
+  try:
+    ipaddress.ip_address(parts.hostname)
+    return url, None
+  except ValueError:
+    pass
+  host = f'[{address}]' if address.version == 6 else str(address)
+  port = f':{parts.port}' if parts.port else ''
+  return urlunsplit((parts.scheme, host + port, parts.path, parts.query, '')), parts.hostname + port
+
+_sessions = threading.local()
+
+def _session():
+  """This thread's requests session, whose connections are reused across fetches. Requests are sent to a checked address with the host
+  name in the Host header, so for https the session's adapter uses that name, not the address, for SNI and the certificate check."""
+
+  session = getattr(_sessions, 'session', None)
+  if session is None:
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    class PinnedAddressAdapter(HTTPAdapter):
+      def build_connection_pool_key_attributes(self, request, verify, cert=None):
+        host_params, pool_kwargs = super().build_connection_pool_key_attributes(request, verify, cert)
+        hostname = request.headers.get('Host', '').split(':')[0]
+        if host_params['scheme'] == 'https' and hostname:
+          pool_kwargs.update(server_hostname=hostname, assert_hostname=hostname)
+        return host_params, pool_kwargs
+
+    session = _sessions.session = requests.Session()
+    session.mount('http://', PinnedAddressAdapter())
+    session.mount('https://', PinnedAddressAdapter())
+  return session
+
+def get_checked(url, headers, timeout, allow_private_addresses=False):
+  """GETs url on this thread's requests session, connecting to the address its host was checked against, and following redirects by
+  hand so that every hop is checked. Returns (final URL, response) with the body not read yet; the caller must close the response.
+  Raises UnsafeURL or requests.RequestException."""
+
+  import requests
+
+  session = _session()
+  first_url = url
+  for _ in range(MAX_REDIRECTS + 1):
+    response = _get_from_any(session, url, resolve_checked(url, allow_private_addresses), headers, timeout)
+    if not response.is_redirect:
+      return url, response
+    url = urljoin(url, response.headers['Location'])
+    response.close()
+  raise requests.TooManyRedirects(f"more than {MAX_REDIRECTS} redirects from {first_url}")
+
+def _get_from_any(session, url, addresses, headers, timeout):
+  """GETs url from the first of addresses that accepts a connection, like a client resolving the name itself would."""
+
+  import requests
+
+  for number, address in enumerate(addresses):
+    request_url, host = pinned_url(url, address)
+    try:
+      return session.get(request_url, headers=dict(headers, Host=host) if host else headers, timeout=timeout, stream=True,
+                         allow_redirects=False)
+    except requests.ConnectionError:
+      if number == len(addresses) - 1:
+        raise
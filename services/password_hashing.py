@@ -0,0 +1,208 @@
+"""Password hashing service used by the User model. bcrypt is deliberately slow, which makes it the biggest CPU cost of signing up and
+logging in. The hasher runs bcrypt in a pool of worker processes behind a bounded queue so a burst of logins can't oversubscribe the CPU,
+calibrates the bcrypt work factor at startup so that one hash takes roughly a target amount of time on this hardware, and tells the User
+model when a stored hash was made with an outdated work factor so it can be transparently rehashed on the next successful login.
+
+Each app gets its own hasher (see AppPasswordHashers), so e.g. creating a testing app with bcrypt's cheapest work factor never changes
+the work factor of another app in the same process."""
+
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+from flask import current_app, has_app_context
+
+from services.metrics import LatencyStats
+
+# bcrypt only accepts work factors in this range.
+BCRYPT_MIN_ROUNDS = 4
+BCRYPT_MAX_ROUNDS = 31
+
+class HashingQueueFull(Exception):
+  """Raised when too many passwords are already waiting to be hashed or verified. The caller should ask the user to try again."""
+
+def _hash_password(password, rounds):
+  """Runs in a worker process. Returns the bcrypt hash of password as a string."""
+  return bcrypt.hashpw(password.encode('UTF-8'), bcrypt.gensalt(rounds=rounds)).decode('UTF-8')
+
+def _check_password(password_hash, password):
+  """Runs in a worker process. Compares password against password_hash in constant time."""
+  password_hash = password_hash.encode('UTF-8')
+  return hmac.compare_digest(bcrypt.hashpw(password.encode('UTF-8'), password_hash), password_hash)
+
+def rounds_of(password_hash):
+  """Returns the work factor a bcrypt hash was made with, e.g. 12 for '$2b$12$...'."""
+  return int(password_hash.split('$')[2])
+
+class PasswordHasher:
+  """Hashes and verifies passwords with bcrypt, with one configuration and its own pool of worker processes. init_app(app) configures
+  it from the app's PASSWORD_HASH_* settings and makes it that app's hasher:
+
+  PASSWORD_HASH_ROUNDS: fixed work factor. If None, the work factor is calibrated to PASSWORD_HASH_TARGET_SECONDS, but never goes below
+  PASSWORD_HASH_MIN_ROUNDS.
+  PASSWORD_HASH_WORKERS: number of worker processes. 0 hashes on the calling thread instead, which is what testing uses. None (the
+  default) shares the host's CPUs between the app processes: gunicorn.conf.py sets app_processes to the number of gunicorn workers, so
+  that together they run about one bcrypt process per CPU.
+  PASSWORD_HASH_MAX_QUEUE: maximum number of hashes that may be running or waiting at once. Further requests wait up to
+  PASSWORD_HASH_QUEUE_TIMEOUT seconds for a free slot before HashingQueueFull is raised."""
+
+  def __init__(self, app=None):
+    self._pool = None
+    self._pool_lock = threading.Lock()
+    self._depth_lock = threading.Lock()
+    self.app_processes = 1
+    self.configure(rounds=12, workers=0)
+
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.config.setdefault('PASSWORD_HASH_ROUNDS', None)
+    app.config.setdefault('PASSWORD_HASH_TARGET_SECONDS', 0.25)
+    app.config.setdefault('PASSWORD_HASH_MIN_ROUNDS', 12)
+    app.config.setdefault('PASSWORD_HASH_WORKERS', None)
+    app.config.setdefault('PASSWORD_HASH_MAX_QUEUE', 4 * (os.cpu_count() or 1))
+    app.config.setdefault('PASSWORD_HASH_QUEUE_TIMEOUT', 5.0)
+
+    rounds = app.config['PASSWORD_HASH_ROUNDS']
+    if rounds is None:
+      rounds = self.calibrate(app.config['PASSWORD_HASH_TARGET_SECONDS'], app.config['PASSWORD_HASH_MIN_ROUNDS'])
+
+    self.configure(
+      rounds = rounds,
+      workers = app.config['PASSWORD_HASH_WORKERS'],
+      max_queue = app.config['PASSWORD_HASH_MAX_QUEUE'],
+      queue_timeout = app.config['PASSWORD_HASH_QUEUE_TIMEOUT']
+    )
+    app.extensions['password_hasher'] = self
+
+  def configure(self, rounds, workers, max_queue=16, queue_timeout=5.0):
+    self.shutdown()
+    self.rounds = rounds
+    self.workers = workers
+    self.max_queue = max_queue
+    self.queue_timeout = queue_timeout
+    self._queue_slots = threading.BoundedSemaphore(max_queue)
+    self._queue_depth = 0
+    self.peak_queue_depth = 0
+    self.rejected = 0
+    self.rehashed = 0
+    self.hash_latency = LatencyStats()
+    self.verify_latency = LatencyStats()
+
+  @staticmethod
+  def calibrate(target_seconds, min_rounds=12):
+    """Returns the largest work factor whose hash is expected to take at most target_seconds on this machine (but at least min_rounds).
+    Each extra round doubles the cost, so a single measurement at min_rounds is enough to extrapolate from."""
+
+    min_rounds = max(min_rounds, BCRYPT_MIN_ROUNDS)
+    start = time.perf_counter()
+    _hash_password('calibration password', min_rounds)
+    seconds = time.perf_counter() - start
+
+    rounds = min_rounds
+    while rounds < BCRYPT_MAX_ROUNDS and seconds * 2 <= target_seconds:
+      rounds += 1
+      seconds *= 2
+    return rounds
+
+  def shutdown(self):
+    """Stops the worker processes. A new pool is started the next time a password is hashed."""
+
+    with self._pool_lock:
+      if self._pool is not None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+      self._pool = None
+
+  def hash(self, password):
+    """Returns the bcrypt hash of password made with the current work factor."""
+    return self._run(self.hash_latency, _hash_password, password, self.rounds)
+
+  def verify(self, password_hash, password):
+    """Returns True if password matches password_hash."""
+    return self._run(self.verify_latency, _check_password, password_hash, password)
+
+  def needs_rehash(self, password_hash):
+    """Returns True if password_hash was made with a lower work factor than the current one."""
+    return rounds_of(password_hash) < self.rounds
+
+  def rehash(self, password):
+    """Same as hash, but counted in the rehashed metric. Used when upgrading a hash made with an outdated work factor."""
+    self.rehashed += 1
+    return self.hash(password)
+
+  def pool_size(self):
+    """Number of worker processes the pool runs."""
+
+    if self.workers is not None:
+      return self.workers
+    return max(1, (os.cpu_count() or 1) // self.app_processes)
+
+  def _get_pool(self):
+    with self._pool_lock:
+      if self._pool is None:
+        # Started lazily so that worker processes are never inherited across a fork (e.g. gunicorn --preload). They are started by a
+        # forkserver rather than forked from this process, which has threads (database pools, background services) that may hold locks
+        # at the moment of a fork, leaving the copies of those locks in the child held forever.
+        self._pool = ProcessPoolExecutor(max_workers=self.pool_size(), mp_context=multiprocessing.get_context('forkserver'))
+      return self._pool
+
+  def _run(self, latency, function, *args):
+    if not self._queue_slots.acquire(timeout=self.queue_timeout):
+      self.rejected += 1
+      raise HashingQueueFull("Too many passwords are waiting to be hashed")
+
+    with self._depth_lock:
+      self._queue_depth += 1
+      self.peak_queue_depth = max(self.peak_queue_depth, self._queue_depth)
+    start = time.perf_counter()
+    try:
+      if self.workers == 0:
+        return function(*args)
+      return self._get_pool().submit(function, *args).result()
+    finally:
+      latency.observe(time.perf_counter() - start)
+      with self._depth_lock:
+        self._queue_depth -= 1
+      self._queue_slots.release()
+
+  def metrics(self):
+    """Latency and queue depth metrics since the hasher was last configured."""
+
+    return {
+      'rounds': self.rounds,
+      'workers': self.pool_size(),
+      'queue_depth': self._queue_depth,
+      'peak_queue_depth': self.peak_queue_depth,
+      'rejected': self.rejected,
+      'rehashed': self.rehashed,
+      'hash_latency': self.hash_latency.summary(),
+      'verify_latency': self.verify_latency.summary()
+    }
+
+class AppPasswordHashers:
+  """The password_hasher the rest of the app uses. Used like a Flask extension: create it once, then call init_app(app) to give the app
+  its own PasswordHasher, stored in app.extensions. Everything else (hash, verify, configure, metrics...) acts on the current app's
+  hasher, or on a default one outside an app context."""
+
+  def __init__(self):
+    self.default = PasswordHasher()
+
+  def init_app(self, app):
+    PasswordHasher().init_app(app)
+
+  def current(self):
+    """The PasswordHasher of the current app, or the default one."""
+
+    if has_app_context():
+      return current_app.extensions.get('password_hasher', self.default)
+    return self.default
+
+  def __getattr__(self, name):
+    return getattr(self.current(), name)
+
+password_hasher = AppPasswordHashers()
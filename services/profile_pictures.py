@@ -0,0 +1,296 @@
+"""Profile pictures are shown from local thumbnails rather than the URLs users give, so pages never make browsers download a huge or dead
+image from a third party. Each distinct remote URL is fetched once, in the background: the database queues it in profile_pictures
+(models/profile_picture.py) when a user signs up with it, and each worker process runs a thread that claims queued URLs, checks what they
+serve (an image content type, at most PROFILE_PICTURE_MAX_BYTES and PROFILE_PICTURE_MAX_PIXELS), and stores a WebP thumbnail of at most
+PROFILE_PICTURE_SIZE pixels a side under static/images/profile-pictures.
+
+Thumbnails are named by the SHA-256 of their contents, so identical images share a file, a file never changes once written, and its URL
+can be cached by browsers and the CDN for a year (see services/http_caching.py). Until a picture is ready, or if it turns out not to be a
+usable image, users get the default picture. The logged in user's cached snapshot (services/current_user.py) picks up a new thumbnail
+when it expires.
+
+Fetches only go to public addresses (see services/outbound_http.py) unless PROFILE_PICTURE_ALLOW_PRIVATE_ADDRESSES is set. Pillow is
+only imported once a picture is processed, keeping it out of worker startup."""
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from flask import url_for
+
+from models.init_db import db
+from models.hot_ranking import utc_now
+from models.profile_picture import ProfilePicture, PICTURE_PENDING, PICTURE_READY, PICTURE_INVALID
+from services.outbound_http import UnsafeURL, get_checked
+
+DEFAULT_PROFILE_PICTURE = 'images/default-profile-picture.jpg'
+# Where thumbnails are stored, relative to the app's static folder.
+THUMBNAIL_FOLDER = 'images/profile-pictures'
+# What a source must be, according to both its Content-Type and Pillow. SVG isn't accepted: it can't be downscaled without a renderer
+# and can carry scripts.
+IMAGE_CONTENT_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp'}
+IMAGE_FORMATS = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+# How long a claimed picture is hidden from other processes' processors while this one works on it.
+CLAIM_LEASE = timedelta(minutes=10)
+# Attempts at fetching a picture whose server is unreachable or failing before it's given up on.
+MAX_ATTEMPTS = 4
+
+class InvalidPicture(Exception):
+  """Raised when what a profile picture URL serves can't be used as a profile picture. Not worth retrying."""
+
+def is_remote_url(url):
+  return url is not None and url.lower().startswith(('http://', 'https://'))
+
+def profile_picture_src(user):
+  """The URL pages should show for a user's profile picture: its thumbnail if it's ready, the default picture if a remote picture isn't,
+  or the user's own URL if it's local (like the default picture). Loads user.profile_picture if it isn't already."""
+
+  if not is_remote_url(user.profile_picture_url):
+    return user.profile_picture_url or url_for('static', filename=DEFAULT_PROFILE_PICTURE)
+  picture = user.profile_picture
+  if picture is None or picture.status != PICTURE_READY:
+    return url_for('static', filename=DEFAULT_PROFILE_PICTURE)
+  # The name is the file's SHA-256, whose start is the version http_caching would add itself, so the file needn't be read for it.
+  return url_for('static', filename=f'{THUMBNAIL_FOLDER}/{picture.thumbnail_hash}.webp', v=picture.thumbnail_hash[:12])
+
+def profile_picture_pending(user):
+  """Whether user's picture is remote and not processed yet, so that profile_picture_src will change once it is. Loads
+  user.profile_picture if it isn't already."""
+
+  if not is_remote_url(user.profile_picture_url):
+    return False
+  return user.profile_picture is None or user.profile_picture.status == PICTURE_PENDING
+
+def make_thumbnail(data, size, max_pixels):
+  """Decodes an image and returns (WebP bytes, width, height) of a copy at most size pixels a side. Raises InvalidPicture if data isn't
+  an image in one of IMAGE_FORMATS or has more than max_pixels pixels."""
+
+  from PIL import Image, ImageOps, UnidentifiedImageError
+
+  # Pillow warns about images over ~90 megapixels; max_pixels is the limit that matters here.
+  warnings.filterwarnings('ignore', category=Image.DecompressionBombWarning)
+  try:
+    with Image.open(io.BytesIO(data)) as image:
+      if image.format not in IMAGE_FORMATS:
+        raise InvalidPicture(f"unsupported image format {image.format}")
+      # Checked before anything is decoded, so a small file claiming to be enormous costs nothing.
+      if image.width * image.height > max_pixels:
+        raise InvalidPicture(f"image is {image.width}x{image.height} pixels")
+      # JPEGs can be decoded at 1/2, 1/4 or 1/8 scale, much faster than decoding at full size and then shrinking.
+      image.draft('RGB', (size, size))
+      thumbnail = ImageOps.exif_transpose(image)
+      thumbnail.thumbnail((size, size))
+      has_alpha = thumbnail.mode in ('RGBA', 'LA', 'PA') or 'transparency' in thumbnail.info
+      thumbnail = thumbnail.convert('RGBA' if has_alpha else 'RGB')
+      output = io.BytesIO()
+      thumbnail.save(output, 'WEBP', quality=85)
+  except UnidentifiedImageError as exc:
+    raise InvalidPicture("not a recognizable image") from exc
+  except (Image.DecompressionBombError, OSError, SyntaxError, ValueError) as exc:
+    raise InvalidPicture(f"can't decode image: {exc}") from exc
+  return output.getvalue(), thumbnail.width, thumbnail.height
+
+class ProfilePictureProcessor:
+  """Used like a Flask extension: create it once, then call init_app(app) to configure it from the app's PROFILE_PICTURE_* settings. As
+  with the link metadata fetcher, the thread is started by the first request each process serves, and wakes up every
+  PROFILE_PICTURE_INTERVAL seconds or as soon as wake() is called (after a signup). Setting the interval to 0 disables it (testing always
+  does); run_once can then be called from a cron job or a benchmark instead.
+
+  ready, invalid and retried count pictures processed since the processor was last configured."""
+
+  def __init__(self, app=None):
+    self.app = None
+    self._thread = None
+    self._thread_pid = None
+    self._start_lock = threading.Lock()
+    self._stopping = threading.Event()
+    self._wake = threading.Event()
+    self.folder = None
+    self.configure()
+
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.config.setdefault('PROFILE_PICTURE_INTERVAL', 30)
+    app.config.setdefault('PROFILE_PICTURE_BATCH_SIZE', 50)
+    app.config.setdefault('PROFILE_PICTURE_WORKERS', 4)
+    app.config.setdefault('PROFILE_PICTURE_TIMEOUT', 10.0)
+    app.config.setdefault('PROFILE_PICTURE_MAX_BYTES', 5 * 1024 * 1024)
+    app.config.setdefault('PROFILE_PICTURE_MAX_PIXELS', 40 * 1000 * 1000)
+    app.config.setdefault('PROFILE_PICTURE_SIZE', 256)
+    app.config.setdefault('PROFILE_PICTURE_RETRY_AFTER', 5 * 60)
+    app.config.setdefault('PROFILE_PICTURE_ALLOW_PRIVATE_ADDRESSES', False)
+
+    self.configure(
+      folder = os.path.join(app.static_folder, THUMBNAIL_FOLDER),
+      batch_size = app.config['PROFILE_PICTURE_BATCH_SIZE'],
+      workers = app.config['PROFILE_PICTURE_WORKERS'],
+      timeout = app.config['PROFILE_PICTURE_TIMEOUT'],
+      max_bytes = app.config['PROFILE_PICTURE_MAX_BYTES'],
+      max_pixels = app.config['PROFILE_PICTURE_MAX_PIXELS'],
+      size = app.config['PROFILE_PICTURE_SIZE'],
+      retry_after = app.config['PROFILE_PICTURE_RETRY_AFTER'],
+      allow_private_addresses = app.config['PROFILE_PICTURE_ALLOW_PRIVATE_ADDRESSES']
+    )
+    self.app = app
+    app.extensions['profile_picture_processor'] = self
+    if app.config['PROFILE_PICTURE_INTERVAL'] and not app.testing:
+      app.before_request(self._start_in_this_process)
+
+  def configure(self, folder=None, batch_size=50, workers=4, timeout=10.0, max_bytes=5 * 1024 * 1024, max_pixels=40 * 1000 * 1000,
+                size=256, retry_after=5 * 60, allow_private_addresses=False):
+    if folder is not None:
+      self.folder = folder
+    self.batch_size = batch_size
+    self.workers = workers
+    self.timeout = timeout
+    self.max_bytes = max_bytes
+    self.max_pixels = max_pixels
+    self.size = size
+    self.retry_after = timedelta(seconds=retry_after)
+    self.allow_private_addresses = allow_private_addresses
+    self.ready = 0
+    self.invalid = 0
+    self.retried = 0
+
+  def _start_in_this_process(self):
+    if self._thread_pid != os.getpid():
+      self.start()
+
+  def start(self):
+    with self._start_lock:
+      if self._thread_pid == os.getpid() and self._thread.is_alive():
+        return
+      self._stopping.clear()
+      self._thread = threading.Thread(target=self._run, name='profile-picture-processor', daemon=True)
+      self._thread_pid = os.getpid()
+      self._thread.start()
+
+  def stop(self):
+    self._stopping.set()
+    self._wake.set()
+
+  def wake(self):
+    """Asks this process's thread to look for pending pictures now rather than at its next interval."""
+    self._wake.set()
+
+  def _run(self):
+    while True:
+      self._wake.wait(self.app.config['PROFILE_PICTURE_INTERVAL'])
+      self._wake.clear()
+      if self._stopping.is_set():
+        return
+      while self.run_once() == self.batch_size:
+        pass
+
+  def run_once(self):
+    """Claims up to batch_size pending pictures, processes them and saves the results. Returns the number of pictures claimed. No
+    database connection is held while fetching."""
+
+    with self.app.app_context():
+      try:
+        pictures = ProfilePicture.claim_due(self.batch_size, CLAIM_LEASE)
+        db.session.commit()
+        if not pictures:
+          return 0
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='profile-picture') as executor:
+          results = list(executor.map(self.process, pictures))
+
+        ProfilePicture.store(results)
+        db.session.commit()
+        return len(pictures)
+      except Exception as exc:
+        db.session.rollback()
+        print(f"ERROR: processing profile pictures failed: {exc}")
+        return 0
+      finally:
+        db.session.remove()
+
+  def process(self, picture):
+    """Fetches one ClaimedPicture and stores its thumbnail. Returns the column values to save for it. Never raises, so that one bad
+    picture can't lose the rest of the batch: anything unexpected, like an image that trips up the decoder in some other way, makes the
+    picture invalid."""
+
+    import requests
+
+    now = utc_now()
+    result = {'source_url': picture.source_url, 'attempts': picture.attempts + 1, 'processed_at': now}
+    try:
+      source_content_type, data = self._fetch(picture.source_url)
+      thumbnail, width, height = make_thumbnail(data, self.size, self.max_pixels)
+      thumbnail_hash = self._save(thumbnail)
+    except (InvalidPicture, UnsafeURL) as exc:
+      self.invalid += 1
+      result.update(status=PICTURE_INVALID, error=str(exc)[:500])
+      return result
+    except (requests.RequestException, OSError) as exc:
+      # Unreachable or failing server, or a full disk: worth another try later, with exponential backoff.
+      result['error'] = f"{type(exc).__name__}: {exc}"[:500]
+      if result['attempts'] >= MAX_ATTEMPTS:
+        self.invalid += 1
+        result['status'] = PICTURE_INVALID
+      else:
+        self.retried += 1
+        result['next_attempt_at'] = now + self.retry_after * 2 ** picture.attempts
+      return result
+    except Exception as exc:
+      print(f"ERROR: processing the profile picture {picture.source_url} failed: {exc!r}")
+      self.invalid += 1
+      result.update(status=PICTURE_INVALID, error=f"{type(exc).__name__}: {exc}"[:500])
+      return result
+
+    self.ready += 1
+    result.update(status=PICTURE_READY, thumbnail_hash=thumbnail_hash, width=width, height=height,
+                  source_content_type=source_content_type, source_bytes=len(data), error=None)
+    return result
+
+  def _fetch(self, url):
+    """Returns (content type, body) of url. Raises InvalidPicture if it isn't an image or is larger than max_bytes, which is checked
+    against Content-Length before anything is downloaded and enforced while downloading."""
+
+    import requests
+
+    _, response = get_checked(url, {'Accept': ', '.join(sorted(IMAGE_CONTENT_TYPES))}, self.timeout, self.allow_private_addresses)
+    try:
+      if response.status_code == 429 or response.status_code >= 500:
+        raise requests.HTTPError(f"HTTP {response.status_code}", response=response)
+      if response.status_code != 200:
+        raise InvalidPicture(f"HTTP {response.status_code}")
+      content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+      if content_type not in IMAGE_CONTENT_TYPES:
+        raise InvalidPicture(f"not an image: {content_type or 'no content type'}")
+      content_length = response.headers.get('Content-Length', '')
+      if content_length.isdigit() and int(content_length) > self.max_bytes:
+        raise InvalidPicture(f"image is {int(content_length)} bytes")
+      data = response.raw.read(self.max_bytes + 1, decode_content=True)
+      if len(data) > self.max_bytes:
+        raise InvalidPicture(f"image is over {self.max_bytes} bytes")
+    finally:
+      response.close()
+    return content_type, data
+
+  def _save(self, thumbnail):
+    """Writes a thumbnail under its content hash, unless that file already exists, and returns the hash. The file is written under a
+    temporary name and renamed into place, so it's never seen half written."""
+
+    thumbnail_hash = hashlib.sha256(thumbnail).hexdigest()
+    path = os.path.join(self.folder, f'{thumbnail_hash}.webp')
+    if not os.path.exists(path):
+      os.makedirs(self.folder, exist_ok=True)
+      with tempfile.NamedTemporaryFile(dir=self.folder, suffix='.tmp', delete=False) as temporary_file:
+        temporary_file.write(thumbnail)
+      os.chmod(temporary_file.name, 0o644)
+      os.replace(temporary_file.name, path)
+    return thumbnail_hash
+
+  def stats(self):
+    return {'ready': self.ready, 'invalid': self.invalid, 'retried': self.retried}
+
+profile_picture_processor = ProfilePictureProcessor()
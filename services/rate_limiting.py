@@ -0,0 +1,171 @@
+"""Rate limiting of the expensive unauthenticated endpoints. Every login attempt costs a bcrypt hash and every signup an SMTP conversation,
+so without a limit a credential stuffing burst turns into a CPU denial of service; every story export streams the whole stories table.
+Attempts are counted in token buckets: a bucket holds up to `count` tokens, refills at count tokens per `seconds`, and each attempt takes
+one; an empty bucket rejects the attempt. Login is limited per IP address and per username (so spreading a burst over many IPs doesn't
+help against one account), signup and story exports per IP address.
+
+The check runs at the top of the views, before the form is validated, so a rejected request costs a dictionary lookup, not a hash.
+
+Buckets live in a pluggable backend. The default MemoryRateLimitBackend keeps them in the worker process, which costs microseconds but
+means each gunicorn worker enforces its own limits. DatabaseRateLimitBackend shares them between every worker and server through an
+UNLOGGED PostgreSQL table (models/rate_limit.py), at the cost of one short query per check; it fails open if the database is unavailable.
+
+Behind a reverse proxy, request.remote_addr is the proxy's address unless the app is wrapped in werkzeug's ProxyFix."""
+
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from models.init_db import db
+from models.rate_limit import RateLimitBucket
+
+class MemoryRateLimitBackend:
+  """Token buckets in an in-process dictionary. Only the max_keys most recently used buckets are kept, so an attacker cycling through
+  addresses can't exhaust memory; evicting a bucket just refills it."""
+
+  def __init__(self, max_keys=100000, timer=time.monotonic):
+    self.max_keys = max_keys
+    self.timer = timer
+    self._buckets = OrderedDict()
+    self._lock = threading.Lock()
+
+  def consume(self, key, refill_rate, capacity, cost=1):
+    """Takes cost tokens from key's bucket. Returns (allowed, seconds until the tokens would have been available)."""
+
+    with self._lock:
+      now = self.timer()
+      tokens, updated_at = self._buckets.get(key, (capacity, now))
+      available = min(capacity, tokens + (now - updated_at) * refill_rate)
+      allowed = available >= cost
+      self._buckets[key] = (available - cost if allowed else available, now)
+      self._buckets.move_to_end(key)
+      while len(self._buckets) > self.max_keys:
+        self._buckets.popitem(last=False)
+
+    return allowed, 0.0 if allowed else (cost - available) / refill_rate
+
+  def clear(self):
+    with self._lock:
+      self._buckets.clear()
+
+class DatabaseRateLimitBackend:
+  """Token buckets in the rate_limit_buckets table, shared by every process using the database. Each check is one call of the
+  rate_limit_consume function on its own short transaction, independent of the request's session. Every prune_every checks, buckets
+  that haven't been touched for idle_seconds (long enough to have refilled completely) are deleted."""
+
+  def __init__(self, idle_seconds=24 * 3600, prune_every=1000):
+    self.idle_seconds = idle_seconds
+    self.prune_every = prune_every
+    self.checks = 0
+    self.errors = 0
+
+  def consume(self, key, refill_rate, capacity, cost=1):
+    self.checks += 1
+    try:
+      with db.engine.begin() as connection:
+        allowed, retry_after = connection.execute(
+          db.select(db.func.rate_limit_consume(key, refill_rate, capacity, cost).table_valued('allowed', 'retry_after'))
+        ).one()
+        if self.checks % self.prune_every == 0:
+          self.prune(connection)
+    except Exception as exc:
+      # A rate limiter outage shouldn't lock everyone out of their accounts.
+      self.errors += 1
+      print(f"ERROR: rate limit check for {key!r} failed: {exc}")
+      return True, 0.0
+    return allowed, retry_after
+
+  def prune(self, connection):
+    connection.execute(db.delete(RateLimitBucket).where(
+      RateLimitBucket.updated_at < db.func.extract('epoch', db.func.clock_timestamp()) - self.idle_seconds))
+
+  def clear(self):
+    with db.engine.begin() as connection:
+      connection.execute(db.delete(RateLimitBucket))
+
+class RateLimiter:
+  """Used like a Flask extension: create it once, then call init_app(app) to configure it from the app's RATE_LIMIT_* settings:
+
+  RATE_LIMIT_ENABLED: turns all the limits off when False.
+  RATE_LIMIT_BACKEND: 'memory' (per process, the default) or 'database' (shared, see DatabaseRateLimitBackend).
+  RATE_LIMIT_LOGIN_PER_IP, RATE_LIMIT_LOGIN_PER_USERNAME, RATE_LIMIT_SIGNUP_PER_IP, RATE_LIMIT_EXPORT_PER_IP: (count, seconds) pairs, e.g.
+  (20, 60) allows bursts of 20 attempts and 20 attempts a minute on average.
+
+  allowed and rejected count the checks of each limit since the process started."""
+
+  def __init__(self, app=None, backend=None):
+    self.backend = backend or MemoryRateLimitBackend()
+    self.enabled = True
+    self.limits = {}
+    self.allowed = defaultdict(int)
+    self.rejected = defaultdict(int)
+
+    if app is not None:
+      self.init_app(app)
+
+  def init_app(self, app):
+    app.config.setdefault('RATE_LIMIT_ENABLED', True)
+    app.config.setdefault('RATE_LIMIT_BACKEND', 'memory')
+    app.config.setdefault('RATE_LIMIT_MEMORY_MAX_KEYS', 100000)
+    app.config.setdefault('RATE_LIMIT_LOGIN_PER_IP', (20, 60))
+    app.config.setdefault('RATE_LIMIT_LOGIN_PER_USERNAME', (10, 300))
+    app.config.setdefault('RATE_LIMIT_SIGNUP_PER_IP', (10, 3600))
+    app.config.setdefault('RATE_LIMIT_EXPORT_PER_IP', (10, 3600))
+
+    if app.config['RATE_LIMIT_BACKEND'] == 'database':
+      backend = DatabaseRateLimitBackend()
+    else:
+      backend = MemoryRateLimitBackend(max_keys=app.config['RATE_LIMIT_MEMORY_MAX_KEYS'])
+
+    self.configure(
+      backend = backend,
+      enabled = app.config['RATE_LIMIT_ENABLED'],
+      limits = {
+        'login_ip': app.config['RATE_LIMIT_LOGIN_PER_IP'],
+        'login_username': app.config['RATE_LIMIT_LOGIN_PER_USERNAME'],
+        'signup_ip': app.config['RATE_LIMIT_SIGNUP_PER_IP'],
+        'export_ip': app.config['RATE_LIMIT_EXPORT_PER_IP'],
+      }
+    )
+    app.extensions['rate_limiter'] = self
+
+  def configure(self, backend, enabled=True, limits=None):
+    self.backend = backend
+    self.enabled = enabled
+    self.limits = dict(limits or {})
+    if isinstance(backend, DatabaseRateLimitBackend) and self.limits:
+      backend.idle_seconds = max(seconds for count, seconds in self.limits.values())
+
+  def check(self, limit, key):
+    """Takes one attempt from key's bucket of the named limit. Returns (allowed, seconds to wait before retrying)."""
+
+    if not self.enabled or limit not in self.limits:
+      return True, 0.0
+
+    count, seconds = self.limits[limit]
+    allowed, retry_after = self.backend.consume(f"{limit}:{key}", count / seconds, count)
+    if allowed:
+      self.allowed[limit] += 1
+    else:
+      self.rejected[limit] += 1
+    return allowed, retry_after
+
+  def check_login(self, ip_address, username):
+    """Checks a login attempt against the per-IP and then the per-username limit. Attempts already rejected by the IP limit don't also
+    use up the username's attempts."""
+
+    allowed, retry_after = self.check('login_ip', ip_address)
+    if allowed and username:
+      allowed, retry_after = self.check('login_username', username.strip().lower()[:100])
+    return allowed, retry_after
+
+  def check_signup(self, ip_address):
+    return self.check('signup_ip', ip_address)
+
+  def check_export(self, ip_address):
+    return self.check('export_ip', ip_address)
+
+  def stats(self):
+    return {'allowed': dict(self.allowed), 'rejected': dict(self.rejected)}
+
+rate_limiter = RateLimiter()
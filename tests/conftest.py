@@ -0,0 +1,73 @@
+"""Fixtures shared by the tests. Tests that use the app run against a local Postgres database, hackornews2_test by default (createdb
+hackornews2_test, or name another one in HACKORNEWS2_TEST_DB), which is emptied before each of them; without one, they're skipped.
+
+Run from the repository root: python -m pytest"""
+
+import os
+
+import pytest
+from flask.testing import FlaskClient
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from app import create_app
+from models.connect import connect_db
+from models.init_db import db
+from services.current_user import current_user_cache
+from services.fragment_cache import fragment_cache
+
+TEST_DB = os.environ.get('HACKORNEWS2_TEST_DB', 'hackornews2_test')
+# Tables whose rows come with the schema rather than from the app, and are never emptied.
+SCHEMA_TABLES = {'hot_ranking_epoch'}
+
+class RequestClient(FlaskClient):
+  """Test client that runs each request in an app context of its own, like a server would. Otherwise requests reuse the app context the
+  tests push, and with it g, the database session and anything cached in them."""
+
+  def open(self, *args, **kwargs):
+    with self.application.app_context():
+      return super().open(*args, **kwargs)
+
+@pytest.fixture(scope='session')
+def app():
+  """A testing app connected to the test database, with its schema migrated, and an app context pushed for the whole test session."""
+
+  app = create_app(TEST_DB, testing=True)
+  app.test_client_class = RequestClient
+  try:
+    connect_db(app)
+  except OperationalError as exc:
+    pytest.skip(f"needs a local Postgres database named {TEST_DB}: {exc.orig}")
+  with app.app_context():
+    yield app
+
+@pytest.fixture
+def clean_db(app):
+  """Empties every table (and the caches of what was in them) before the test."""
+
+  db.session.remove()
+  tables = ', '.join(table.name for table in db.metadatas[None].sorted_tables if table.name not in SCHEMA_TABLES)
+  db.session.execute(db.text(f"TRUNCATE {tables} RESTART IDENTITY CASCADE"))
+  db.session.commit()
+  current_user_cache.snapshots.clear()
+  fragment_cache.invalidate()
+  yield
+  db.session.remove()
+
+@pytest.fixture
+def count_queries(app):
+  """Returns a function that calls its argument and returns how many statements it sent to the primary database."""
+
+  def count_queries(function):
+    statements = []
+    def record(conn, cursor, statement, *args):
+      statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+      function()
+    finally:
+      event.remove(db.engine, 'before_cursor_execute', record)
+    return len(statements)
+
+  return count_queries
@@ -0,0 +1,43 @@
+"""Exports hold a database connection while they stream, so each process only streams a few at once, and anyone exporting the stories is
+rate limited."""
+
+import pytest
+
+from services.exports import export_slots
+from services.rate_limiting import rate_limiter, MemoryRateLimitBackend
+
+@pytest.fixture
+def limits(app):
+  """Sets the export limits to one export streaming at a time and three story exports a minute per IP address."""
+
+  export_slots.configure(max_concurrent=1, retry_after=7)
+  rate_limiter.configure(MemoryRateLimitBackend(), limits={'export_ip': (3, 60)})
+  yield
+  export_slots.init_app(app)
+  rate_limiter.init_app(app)
+
+def test_exports_beyond_the_concurrency_cap_get_a_503(app, clean_db, limits):
+  client = app.test_client()
+  streaming = client.get('/export/stories.csv')
+  assert streaming.status_code == 200
+
+  busy = client.get('/export/stories.ndjson')
+  assert busy.status_code == 503
+  assert busy.headers['Retry-After'] == '7'
+  assert export_slots.rejected == 1
+
+  # Closing a response, as the server does once the client is done with it, frees its slot.
+  assert streaming.get_data(as_text=True).startswith('id,title,')
+  streaming.close()
+  retried = client.get('/export/stories.ndjson')
+  assert retried.status_code == 200
+  retried.close()
+
+def test_story_exports_are_rate_limited(app, clean_db, limits):
+  client = app.test_client()
+  for _ in range(3):
+    client.get('/export/stories.csv').close()
+
+  limited = client.get('/export/stories.csv')
+  assert limited.status_code == 429
+  assert 0 < int(limited.headers['Retry-After']) <= 30
@@ -0,0 +1,66 @@
+"""Pages with forms can still be revalidated with a 304, and the fragment cache can't be filled with made up cursors."""
+
+import time
+from unittest import mock
+
+from models.init_db import db
+from models.story import Story, encode_cursor
+from models.user import User
+from services.fragment_cache import fragment_cache
+
+def add_user_with_stories(count):
+  user = User.create_user(username='cache_test', email='cache_test@example.com', profile_picture_url=None, password='correct horse')
+  db.session.flush()
+  db.session.add_all(Story(user_id=user.id, title=f'Story {number}', url=f'https://example.com/{number}') for number in range(count))
+  db.session.commit()
+  return user
+
+def start_of_next_token_period(app):
+  """A time soon after now at which the ETag's CSRF token period starts, so a second later is still in the same period."""
+  half_time_limit = app.config.get('WTF_CSRF_TIME_LIMIT', 3600) / 2
+  return (time.time() // half_time_limit + 1) * half_time_limit
+
+def test_page_with_forms_is_revalidated_with_a_304(app, clean_db):
+  add_user_with_stories(3)
+  client = app.test_client()
+  client.post('/login', data={'username': 'cache_test', 'password': 'correct horse'})
+  client.get('/')
+
+  # CSRF tokens are signed with the current second, so the pages differ, but not their ETags.
+  now = start_of_next_token_period(app)
+  with mock.patch('time.time', return_value=now):
+    first = client.get('/')
+  with mock.patch('time.time', return_value=now + 1):
+    second = client.get('/')
+  assert b'name="csrf_token"' in first.data
+  assert first.data != second.data
+  assert first.headers['ETag'] == second.headers['ETag']
+  with mock.patch('time.time', return_value=now + 2):
+    assert client.get('/', headers={'If-None-Match': first.headers['ETag']}).status_code == 304
+
+def test_etag_changes_before_the_csrf_token_expires(app, clean_db):
+  add_user_with_stories(3)
+  client = app.test_client()
+  client.post('/login', data={'username': 'cache_test', 'password': 'correct horse'})
+  client.get('/')
+
+  now = start_of_next_token_period(app)
+  with mock.patch('time.time', return_value=now):
+    first = client.get('/')
+  with mock.patch('time.time', return_value=now + app.config.get('WTF_CSRF_TIME_LIMIT', 3600) / 2):
+    later = client.get('/', headers={'If-None-Match': first.headers['ETag']})
+  assert later.status_code == 200
+
+def test_fragments_are_keyed_by_the_parsed_cursor(app, clean_db):
+  add_user_with_stories(30)
+  client = app.test_client()
+  client.get('/')
+  story = db.session.scalars(db.select(Story).order_by(Story.created_at.desc(), Story.id.desc()).offset(19).limit(1)).one()
+  cursor = encode_cursor(story.created_at, story.id)
+  fragments = len(fragment_cache.fragments)
+
+  assert client.get(f'/?after={cursor}').status_code == 200
+  assert client.get(f'/?after={cursor}==').status_code == 200
+  assert len(fragment_cache.fragments) == fragments + 1
+  assert client.get('/?after=not-a-cursor').status_code == 302
+  assert len(fragment_cache.fragments) == fragments + 1
@@ -0,0 +1,17 @@
+"""The metrics of other services are exported with the Prometheus type that matches them: totals as counters, levels as gauges."""
+
+import re
+
+def metric_types(metrics):
+  return dict(re.findall(r'^# TYPE (\S+) (\S+)$', metrics, re.MULTILINE))
+
+def test_service_totals_are_counters_and_levels_are_gauges(app):
+  types = metric_types(app.test_client().get('/metrics').get_data(as_text=True))
+
+  for name in ['hackornews_rate_limit_allowed_total', 'hackornews_rate_limit_rejected_total', 'hackornews_link_metadata_fetches_total',
+               'hackornews_link_metadata_failures_total', 'hackornews_profile_pictures_ready_total',
+               'hackornews_profile_pictures_invalid_total']:
+    assert types[name] == 'counter'
+  assert types['hackornews_password_hash_queue_depth'] == 'gauge'
+  assert types['hackornews_current_user_cache_hit_rate'] == 'gauge'
+  assert all(metric_type == 'counter' for name, metric_type in types.items() if name.endswith('_total'))
@@ -0,0 +1,154 @@
+"""Upgrading a database with the original schema, and the data in it, gives the same schema as creating a new one. Each test builds its
+database in a schema of its own inside a transaction that is rolled back, so the test database is left alone."""
+
+import re
+
+import pytest
+
+from models.init_db import db
+from models.migrations import MIGRATIONS, apply_migrations
+
+# The schema before there were migrations, as the original models created it.
+ORIGINAL_SCHEMA = """
+  CREATE TABLE users (
+    id serial PRIMARY KEY,
+    username varchar(50) NOT NULL UNIQUE,
+    email text NOT NULL UNIQUE,
+    profile_picture_url text,
+    password text NOT NULL,
+    created_at timestamp
+  );
+  CREATE TABLE stories (
+    id serial PRIMARY KEY,
+    user_id integer NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+    title text NOT NULL,
+    author text,
+    url text NOT NULL,
+    created_at timestamp,
+    updated_at timestamp
+  );
+  CREATE TABLE favorites (
+    user_id integer REFERENCES users (id) ON DELETE CASCADE,
+    story_id integer REFERENCES stories (id) ON DELETE CASCADE,
+    created_at timestamp,
+    PRIMARY KEY (user_id, story_id)
+  );
+  CREATE TABLE bookmarks (
+    user_id integer REFERENCES users (id) ON DELETE CASCADE,
+    story_id integer REFERENCES stories (id) ON DELETE CASCADE,
+    created_at timestamp,
+    PRIMARY KEY (user_id, story_id)
+  );
+  CREATE TABLE comments (
+    id serial,
+    user_id integer REFERENCES users (id) ON DELETE CASCADE,
+    story_id integer REFERENCES stories (id) ON DELETE CASCADE,
+    content text NOT NULL,
+    created_at timestamp,
+    updated_at timestamp,
+    PRIMARY KEY (id, user_id, story_id)
+  );
+"""
+
+ORIGINAL_DATA = """
+  INSERT INTO users (username, email, profile_picture_url, password, created_at) VALUES
+    ('alice', 'alice@example.com', 'https://pictures.example.com/alice.png', 'hash', now()),
+    ('bob', 'bob@example.com', '/static/images/default-profile-picture.jpg', 'hash', now());
+  INSERT INTO stories (user_id, title, author, url, created_at, updated_at) VALUES
+    (1, 'Markets rally', 'Reporter', 'https://www.nytimes.com/markets', now() - interval '2 hours', now()),
+    (2, 'Old story without a creation time', NULL, 'https://example.org/old', NULL, now() - interval '1 day');
+  INSERT INTO favorites VALUES (1, 1, now()), (2, 1, now()), (1, 2, now());
+  INSERT INTO bookmarks VALUES (2, 1, now());
+  INSERT INTO comments (user_id, story_id, content, created_at, updated_at) VALUES
+    (1, 1, 'First', now(), now()), (2, 1, 'Second', now(), now()), (2, 2, 'Third', now(), now());
+"""
+
+# Everything that makes up a schema: columns, constraints, indexes, triggers and functions (except those of extensions), without the
+# schema's name.
+SCHEMA_DESCRIPTION = """
+  SELECT 'column ' || table_name || '.' || column_name || ' ' || data_type || ' ' || is_nullable || ' ' || coalesce(generation_expression, '')
+  FROM information_schema.columns WHERE table_schema = :schema
+  UNION ALL
+  SELECT 'constraint ' || conrelid::regclass::text || ' ' || conname || ' ' || pg_get_constraintdef(pg_constraint.oid)
+  FROM pg_constraint JOIN pg_namespace ON pg_namespace.oid = connamespace WHERE nspname = :schema
+  UNION ALL
+  SELECT 'index ' || indexdef FROM pg_indexes WHERE schemaname = :schema
+  UNION ALL
+  SELECT 'trigger ' || pg_get_triggerdef(pg_trigger.oid)
+  FROM pg_trigger JOIN pg_class ON pg_class.oid = tgrelid JOIN pg_namespace ON pg_namespace.oid = relnamespace
+  WHERE nspname = :schema AND NOT tgisinternal
+  UNION ALL
+  SELECT 'function ' || proname || ' ' || regexp_replace(prosrc, '\\s+', ' ', 'g')
+  FROM pg_proc JOIN pg_namespace ON pg_namespace.oid = pronamespace
+  WHERE nspname = :schema AND NOT EXISTS (SELECT FROM pg_depend WHERE objid = pg_proc.oid AND deptype = 'e')
+"""
+
+@pytest.fixture
+def connection(app):
+  """A connection whose tables are looked up in, and created in, an empty schema first. Everything it does is rolled back."""
+
+  with db.engine.connect() as connection:
+    transaction = connection.begin()
+    connection.execute(db.text("CREATE SCHEMA migration_test"))
+    connection.execute(db.text("SET LOCAL search_path TO migration_test, public"))
+    yield connection
+    transaction.rollback()
+
+def describe_schema(connection, schema):
+  rows = connection.execute(db.text(SCHEMA_DESCRIPTION), {'schema': schema}).scalars()
+  return sorted(re.sub(rf'\b{schema}\.', '', row) for row in rows)
+
+def query(connection, sql):
+  return connection.execute(db.text(sql)).all()
+
+def test_upgrading_the_original_schema_matches_a_new_database(connection):
+  connection.execute(db.text(ORIGINAL_SCHEMA))
+
+  assert apply_migrations(connection) == MIGRATIONS
+  assert describe_schema(connection, 'migration_test') == describe_schema(connection, 'public')
+
+def test_upgrading_the_original_schema_backfills_existing_rows(connection):
+  connection.execute(db.text(ORIGINAL_SCHEMA))
+  connection.execute(db.text(ORIGINAL_DATA))
+
+  apply_migrations(connection)
+
+  assert query(connection, "SELECT story_id, favorite_count, bookmark_count, comment_count FROM story_engagement ORDER BY story_id") == [
+    (1, 2, 1, 2), (2, 1, 0, 1)]
+  assert query(connection, "SELECT count(*) FROM stories WHERE created_at IS NULL") == [(0,)]
+  assert query(connection, "SELECT id, path, depth FROM comments ORDER BY id") == [(1, [1], 0), (2, [2], 0), (3, [3], 0)]
+  hot_scores = dict(query(connection, "SELECT story_id, hot_score FROM story_engagement"))
+  assert set(hot_scores) == {1, 2} and hot_scores[1] > hot_scores[2]
+  assert query(connection, "SELECT url, domain FROM link_metadata ORDER BY url") == [
+    ('https://example.org/old', 'example.org'), ('https://www.nytimes.com/markets', 'nytimes.com')]
+  assert query(connection, "SELECT domain FROM link_domains ORDER BY domain") == [('example.org',), ('nytimes.com',)]
+  assert query(connection, "SELECT source_url, status FROM profile_pictures") == [('https://pictures.example.com/alice.png', 'pending')]
+
+def test_upgraded_database_keeps_derived_data_up_to_date(connection):
+  connection.execute(db.text(ORIGINAL_SCHEMA))
+  connection.execute(db.text(ORIGINAL_DATA))
+  apply_migrations(connection)
+
+  connection.execute(db.text("INSERT INTO comments (user_id, story_id, parent_id, content) VALUES (1, 1, 1, 'Reply')"))
+  connection.execute(db.text("DELETE FROM favorites WHERE story_id = 1 AND user_id = 2"))
+
+  assert query(connection, "SELECT path, depth FROM comments WHERE content = 'Reply'") == [([1, 4], 1)]
+  assert query(connection, "SELECT descendant_count FROM comments WHERE id = 1") == [(1,)]
+  assert query(connection, "SELECT favorite_count, comment_count FROM story_engagement WHERE story_id = 1") == [(1, 3)]
+
+def test_migrating_again_is_a_no_op(connection):
+  connection.execute(db.text(ORIGINAL_SCHEMA))
+  apply_migrations(connection)
+
+  assert apply_migrations(connection) == []
+  assert query(connection, "SELECT version FROM schema_migrations") == [(migration.version,) for migration in MIGRATIONS]
+
+def test_upgrading_a_database_from_before_migrations_that_is_up_to_date_works(connection):
+  """Databases set up by create-tables, before there were migrations, have none recorded but may already have the schema of the
+  first one."""
+
+  connection.execute(db.text(ORIGINAL_SCHEMA))
+  MIGRATIONS[0].upgrade(connection)
+
+  assert apply_migrations(connection) == MIGRATIONS
+  assert describe_schema(connection, 'migration_test') == describe_schema(connection, 'public')
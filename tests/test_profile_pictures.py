@@ -0,0 +1,94 @@
+"""The profile picture processor fetches each distinct URL once, makes one thumbnail file per distinct image, and rejects whatever isn't a
+usable image. The pictures are served by a local stand-in web server, so no traffic leaves the machine."""
+
+import io
+import os
+
+import pytest
+from PIL import Image
+
+from benchmarks.standins import StandInHTTPServer
+from models.init_db import db
+from models.profile_picture import ProfilePicture, PICTURE_READY, PICTURE_INVALID
+from services.profile_pictures import profile_picture_processor
+
+MAX_BYTES = 100 * 1024
+MAX_PIXELS = 1000 * 1000
+
+def encode(image, format):
+  output = io.BytesIO()
+  image.save(output, format)
+  return output.getvalue()
+
+PHOTO = encode(Image.linear_gradient('L').resize((400, 300)).convert('RGB'), 'JPEG')
+
+# {path: (content type, body)} served by the stand-in. Paths starting with /missing are 404s.
+FILES = {
+  '/photo.jpg': ('image/jpeg', PHOTO),
+  '/same-photo-elsewhere.jpg': ('image/jpeg', PHOTO),
+  '/huge.jpg': ('image/jpeg', PHOTO + bytes(MAX_BYTES)),
+  '/too-many-pixels.png': ('image/png', encode(Image.new('1', (2000, 2000)), 'PNG')),
+  '/drawing.svg': ('image/svg+xml', b'<svg xmlns="http://www.w3.org/2000/svg"><script>alert(1)</script></svg>'),
+  '/not-really.png': ('image/png', b'<html>this is not a picture</html>'),
+  '/page.jpg': ('text/html', b'<html>a page</html>'),
+}
+
+@pytest.fixture
+def stand_in():
+  with StandInHTTPServer(files=FILES) as server:
+    yield server
+
+@pytest.fixture
+def processor(app, tmp_path):
+  """The app's processor, storing thumbnails in a temporary folder and allowed to fetch from the stand-in on localhost."""
+
+  profile_picture_processor.configure(folder=str(tmp_path), workers=2, max_bytes=MAX_BYTES, max_pixels=MAX_PIXELS,
+                                      allow_private_addresses=True)
+  yield profile_picture_processor
+  profile_picture_processor.init_app(app)
+
+def sign_up_users(urls):
+  """Adds a user for each of urls with it as their profile picture, which queues each distinct one for processing."""
+
+  db.session.execute(db.text(
+    "INSERT INTO users (username, email, password, profile_picture_url) "
+    "SELECT 'picture_test' || n, 'picture_test' || n || '@example.com', 'not a real hash', url "
+    "FROM unnest(CAST(:urls AS text[])) WITH ORDINALITY AS picture_urls (url, n)"
+  ), {'urls': urls})
+  db.session.commit()
+
+def process_all(processor):
+  while processor.run_once():
+    pass
+  db.session.expire_all()
+
+@pytest.mark.parametrize('path, error', [
+  ('/huge.jpg', f"image is {len(FILES['/huge.jpg'][1])} bytes"),
+  ('/too-many-pixels.png', "image is 2000x2000 pixels"),
+  ('/drawing.svg', "not an image: image/svg+xml"),
+  ('/not-really.png', "not a recognizable image"),
+  ('/page.jpg', "not an image: text/html"),
+  ('/missing.png', "HTTP 404"),
+], ids=['too large', 'too many pixels', 'svg', 'undecodable', 'html', 'not found'])
+def test_unusable_pictures_are_invalid(clean_db, stand_in, processor, tmp_path, path, error):
+  sign_up_users([stand_in.url + path])
+
+  process_all(processor)
+
+  picture = db.session.get(ProfilePicture, stand_in.url + path)
+  assert (picture.status, picture.error, picture.thumbnail_hash) == (PICTURE_INVALID, error, None)
+  assert stand_in.requests == 1
+  assert os.listdir(tmp_path) == []
+
+def test_each_url_is_fetched_once_and_identical_images_share_a_thumbnail(clean_db, stand_in, processor, tmp_path):
+  sign_up_users([stand_in.url + '/photo.jpg'] * 5 + [stand_in.url + '/same-photo-elsewhere.jpg'])
+
+  process_all(processor)
+
+  pictures = ProfilePicture.query.order_by(ProfilePicture.source_url).all()
+  assert [(picture.source_url, picture.status) for picture in pictures] == [
+    (stand_in.url + '/photo.jpg', PICTURE_READY), (stand_in.url + '/same-photo-elsewhere.jpg', PICTURE_READY)]
+  assert stand_in.requests == 2
+  assert pictures[0].thumbnail_hash == pictures[1].thumbnail_hash
+  assert (pictures[0].width, pictures[0].height) == (256, 192)
+  assert os.listdir(tmp_path) == [f'{pictures[0].thumbnail_hash}.webp']
@@ -0,0 +1,82 @@
+"""The story listings load a page, with everything they show, in the same single query whatever its size (no N+1 queries)."""
+
+import pytest
+
+from models.init_db import db
+from models.story import Story
+
+PAGE_SIZES = [1, 20, 100]
+
+def add_stories(count):
+  """Adds a user and count stories posted by them, every other one favorited and every third one bookmarked by them. Returns the user's
+  id."""
+
+  user_id = db.session.execute(db.text(
+    "INSERT INTO users (username, email, password) VALUES ('feed_test', 'feed_test@example.com', 'not a real hash') RETURNING id"
+  )).scalar()
+  db.session.execute(db.text(
+    "INSERT INTO stories (user_id, title, author, url, created_at, updated_at) "
+    "SELECT :user_id, 'Story ' || n, 'Author ' || n, 'https://example.com/' || n, now() - n * interval '1 second', now() "
+    "FROM generate_series(1, :count) AS n"
+  ), {'user_id': user_id, 'count': count})
+  db.session.execute(db.text("INSERT INTO favorites (user_id, story_id) SELECT :user_id, id FROM stories WHERE id % 2 = 0"),
+                     {'user_id': user_id})
+  db.session.execute(db.text("INSERT INTO bookmarks (user_id, story_id) SELECT :user_id, id FROM stories WHERE id % 3 = 0"),
+                     {'user_id': user_id})
+  db.session.commit()
+  return user_id
+
+def read_listing(feed):
+  """Reads everything a listing template shows of each story on a page."""
+
+  for story in feed.stories:
+    engagement = story.engagement
+    (story.title, story.user.username, engagement.favorite_count, engagement.bookmark_count, engagement.comment_count, story.is_favorited,
+     story.is_bookmarked, story.link_metadata and story.link_metadata.title)
+
+@pytest.mark.parametrize('logged_in', [False, True], ids=['anonymous', 'logged in'])
+@pytest.mark.parametrize('per_page', PAGE_SIZES)
+def test_feed_page_is_one_query(clean_db, count_queries, logged_in, per_page):
+  user_id = add_stories(2 * max(PAGE_SIZES) + 1)
+  viewer_id = user_id if logged_in else None
+
+  pages = []
+  def load_two_pages():
+    first_page = Story.get_feed(per_page=per_page, viewer_id=viewer_id)
+    read_listing(first_page)
+    second_page = Story.get_feed(cursor=first_page.next_cursor, per_page=per_page, viewer_id=viewer_id)
+    read_listing(second_page)
+    pages.extend([first_page, second_page])
+
+  db.session.expunge_all()
+  assert count_queries(load_two_pages) == 2
+  assert [len(page.stories) for page in pages] == [per_page, per_page]
+  for story in pages[0].stories + pages[1].stories:
+    assert story.is_favorited == (logged_in and story.id % 2 == 0)
+    assert story.is_bookmarked == (logged_in and story.id % 3 == 0)
+
+@pytest.mark.parametrize('per_page', PAGE_SIZES)
+def test_hot_feed_page_is_one_query(clean_db, count_queries, per_page):
+  user_id = add_stories(max(PAGE_SIZES) + 1)
+
+  pages = []
+  def load_page():
+    pages.append(Story.get_hot_feed(per_page=per_page, viewer_id=user_id))
+    read_listing(pages[0])
+
+  db.session.expunge_all()
+  assert count_queries(load_page) == 1
+  assert len(pages[0].stories) == per_page
+
+@pytest.mark.parametrize('per_page', PAGE_SIZES)
+def test_user_stories_page_is_one_query(clean_db, count_queries, per_page):
+  user_id = add_stories(max(PAGE_SIZES) + 1)
+
+  pages = []
+  def load_page():
+    pages.append(Story.get_user_stories(user_id, per_page=per_page, viewer_id=user_id))
+    read_listing(pages[0])
+
+  db.session.expunge_all()
+  assert count_queries(load_page) == 1
+  assert len(pages[0].stories) == per_page
@@ -0,0 +1,36 @@
+"""A story's page loads the story, with everything shown about it, and a page of its discussion in two queries (no lazy loads)."""
+
+import pytest
+
+from models.init_db import db
+from models.story import Story
+from models.user import User
+
+def add_story_with_comments(count):
+  """Adds a user and a story posted by them, favorited by them and with count comments by them. Returns the story's id."""
+
+  user = User.create_user(username='page_test', email='page_test@example.com', profile_picture_url=None, password='correct horse')
+  db.session.flush()
+  story = Story(user_id=user.id, title='Story', url='https://example.com/story')
+  db.session.add(story)
+  db.session.flush()
+  db.session.execute(db.text("INSERT INTO favorites (user_id, story_id) VALUES (:user_id, :story_id)"),
+                     {'user_id': user.id, 'story_id': story.id})
+  db.session.execute(db.text(
+    "INSERT INTO comments (user_id, story_id, content) SELECT :user_id, :story_id, 'Comment ' || n FROM generate_series(1, :count) AS n"
+  ), {'user_id': user.id, 'story_id': story.id, 'count': count})
+  db.session.commit()
+  return story.id
+
+@pytest.mark.parametrize('logged_in', [False, True], ids=['anonymous', 'logged in'])
+def test_story_page_is_two_queries(app, clean_db, count_queries, logged_in):
+  story_id = add_story_with_comments(30)
+  client = app.test_client()
+  if logged_in:
+    client.post('/login', data={'username': 'page_test', 'password': 'correct horse'})
+
+  responses = []
+  assert count_queries(lambda: responses.append(client.get(f'/stories/{story_id}'))) == 2
+  page = responses[0].get_data(as_text=True)
+  assert 'Posted by page_test' in page and 'Comment 1<' in page
+  assert ('fa-solid fa-star' in page) == logged_in
@@ -0,0 +1,101 @@
+"""Favoriting a story is idempotent and safe under concurrency: double clicks change it once, and however many users toggle the same story
+at the same time, none of their requests fail and its favorite_count ends up equal to its number of favorites."""
+
+import random
+import threading
+
+import pytest
+
+from models.init_db import db
+from models.favorite import Favorite
+
+THREADS = 8
+
+def add_users_and_story(user_count):
+  """Adds user_count users and a story posted by the first one. Returns (user ids, story id)."""
+
+  user_ids = db.session.execute(db.text(
+    "INSERT INTO users (username, email, password) SELECT 'toggle_test' || n, 'toggle_test' || n || '@example.com', 'not a real hash' "
+    "FROM generate_series(1, :count) AS n RETURNING id"
+  ), {'count': user_count}).scalars().all()
+  story_id = db.session.execute(db.text(
+    "INSERT INTO stories (user_id, title, url, created_at, updated_at) "
+    "VALUES (:user_id, 'Toggle test', 'https://example.com/toggles', now(), now()) RETURNING id"
+  ), {'user_id': user_ids[0]}).scalar()
+  db.session.commit()
+  return user_ids, story_id
+
+def run_threads(app, target, count):
+  """Runs target(index) in count threads at once, each in an app context (and so with a database session) of its own."""
+
+  start = threading.Barrier(count)
+  def run(index):
+    with app.app_context():
+      start.wait()
+      target(index)
+      db.session.remove()
+
+  threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+def favorites(story_id):
+  """Returns the story's favorite_count and the ids of the users who favorited it."""
+
+  favorite_count = db.session.execute(db.text("SELECT favorite_count FROM story_engagement WHERE story_id = :story_id"),
+                                      {'story_id': story_id}).scalar()
+  user_ids = set(db.session.execute(db.text("SELECT user_id FROM favorites WHERE story_id = :story_id"),
+                                    {'story_id': story_id}).scalars())
+  db.session.commit()
+  return favorite_count, user_ids
+
+@pytest.mark.parametrize('is_set', [True, False], ids=['favorite', 'unfavorite'])
+def test_double_click_changes_the_story_once(app, clean_db, is_set):
+  user_ids, story_id = add_users_and_story(1)
+  if not is_set:
+    Favorite.set_state(user_ids[0], story_id, True)
+    db.session.commit()
+
+  results = []
+  def click(index):
+    results.append(Favorite.set_state(user_ids[0], story_id, is_set))
+    db.session.commit()
+  run_threads(app, click, THREADS)
+
+  assert len(results) == THREADS
+  assert sum(result.changed for result in results) == 1
+  assert {result.is_set for result in results} == {is_set}
+  assert favorites(story_id) == ((1, set(user_ids)) if is_set else (0, set()))
+
+def test_concurrent_toggles_keep_the_count_equal_to_the_favorites(app, clean_db):
+  """Each thread favorites and unfavorites the story for users of its own, and for one user they all share, like someone clicking in
+  several tabs; only the shared user's final state can't be predicted."""
+
+  user_ids, story_id = add_users_and_story(1 + 5 * THREADS)
+  shared_user_id = user_ids[0]
+  final_states = {}
+  errors = []
+
+  def toggle(index):
+    rng = random.Random(index)
+    thread_user_ids = user_ids[1 + index::THREADS] + [shared_user_id]
+    for _ in range(50):
+      user_id = rng.choice(thread_user_ids)
+      is_set = rng.random() < 0.5
+      try:
+        Favorite.set_state(user_id, story_id, is_set)
+        db.session.commit()
+      except Exception as exc:
+        db.session.rollback()
+        errors.append(exc)
+        continue
+      if user_id != shared_user_id:
+        final_states[user_id] = is_set
+  run_threads(app, toggle, THREADS)
+
+  favorite_count, favorited = favorites(story_id)
+  assert errors == []
+  assert favorite_count == len(favorited)
+  assert favorited - {shared_user_id} == {user_id for user_id, is_set in final_states.items() if is_set}
@@ -0,0 +1,9 @@
+"""Entry point for production servers: gunicorn -c gunicorn.conf.py wsgi:app (gunicorn.conf.py names it, so plain `gunicorn` works
+too). Set APP_ENV=production for the lean boot described in create_app, and create or upgrade the schema when deploying, before
+starting the new version, with `flask --app wsgi migrate` (see models/migrations.py)."""
+
+from app import create_app
+from models.connect import connect_db
+
+app = create_app('hackornews2')
+connect_db(app)